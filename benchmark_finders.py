@@ -0,0 +1,139 @@
+import argparse
+import datetime
+import time
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from models import base, Tracks, Races, Horses, Jockeys, Entries
+from db_utils import find_race_instance_from_item, find_horse_instance_from_item, find_jockey_instance_from_item, \
+    find_entry_instance_from_item, find_horse_instance_from_item_and_race
+from utils import get_name_key, get_first_initial, get_horse_name_key
+
+
+def create_benchmark_rows(session, row_count):
+
+    # One track, a race per row and a horse, jockey and entry in each race
+    track = Tracks(code='BNC', name='Benchmark Downs')
+    session.add(track)
+    session.flush()
+    card_date = datetime.date(2020, 1, 1)
+    for row_index in range(row_count):
+        race = Races(track_id=track.track_id, race_number=row_index % 12 + 1,
+                     card_date=card_date + datetime.timedelta(days=row_index // 12))
+        horse_name = f'HORSE {row_index}'
+        horse = Horses(horse_name=horse_name, horse_name_key=get_horse_name_key(horse_name))
+        first_name = f'JOHN{row_index}'
+        jockey = Jockeys(first_name=first_name, last_name='SMITH', first_initial=get_first_initial(first_name),
+                         last_name_key=get_name_key('SMITH'))
+        session.add_all([race, horse, jockey])
+        session.flush()
+        session.add(Entries(race_id=race.race_id, horse_id=horse.horse_id, jockey_id=jockey.jockey_id))
+    session.commit()
+
+
+def get_benchmark_lookups(session, lookup_count):
+
+    # (finder, old style query) pairs for a mix of the finders import_data calls most
+    lookups = []
+    entries = session.query(Entries).join(Races).join(Horses).join(Jockeys).limit(lookup_count).all()
+    for entry in entries:
+        race = entry.race
+        race_item = {'track_id': race.track_id, 'race_number': race.race_number, 'card_date': race.card_date}
+        horse_item = {'horse_name': entry.horse.horse_name}
+        jockey_item = {'first_name': entry.jockey.first_name, 'last_name': entry.jockey.last_name}
+        entry_item = {'race_id': entry.race_id, 'horse_id': entry.horse_id}
+        lookups.extend([
+            (
+                lambda session, item=race_item: find_race_instance_from_item(item, session),
+                lambda session, item=race_item: session.query(Races).filter(
+                    Races.track_id == item['track_id'],
+                    Races.race_number == item['race_number'],
+                    Races.card_date == item['card_date']
+                ).first()
+            ),
+            (
+                lambda session, item=horse_item: find_horse_instance_from_item(item, session),
+                lambda session, item=horse_item: session.query(Horses).filter(
+                    Horses.horse_name_key == get_horse_name_key(item['horse_name'])
+                ).first()
+            ),
+            (
+                lambda session, item=horse_item, race=race: find_horse_instance_from_item_and_race(item, race, session),
+                lambda session, item=horse_item, race=race: session.query(Horses).join(Entries).join(Races).filter(
+                    Horses.horse_name_key == get_horse_name_key(item['horse_name']),
+                    Races.race_id == race.race_id
+                ).first()
+            ),
+            (
+                lambda session, item=jockey_item: find_jockey_instance_from_item(item, session),
+                lambda session, item=jockey_item: session.query(Jockeys).filter(
+                    Jockeys.first_name == item['first_name'],
+                    Jockeys.last_name == item['last_name']
+                ).first()
+            ),
+            (
+                lambda session, item=entry_item: find_entry_instance_from_item(item, session),
+                lambda session, item=entry_item: session.query(Entries).filter(
+                    Entries.race_id == item['race_id'],
+                    Entries.horse_id == item['horse_id']
+                ).first()
+            ),
+        ])
+
+    # Return lookups
+    return lookups
+
+
+def time_lookups(session, lookups, lookup_index, repeat_count):
+
+    # Microseconds per lookup over repeat_count passes
+    start_time = time.perf_counter()
+    for repeat in range(repeat_count):
+        for lookup in lookups:
+            if lookup[lookup_index](session) is None:
+                raise ValueError('benchmark lookup found nothing')
+    return (time.perf_counter() - start_time) / (len(lookups) * repeat_count) * 1000000
+
+
+def benchmark_finders(row_count, lookup_count, repeat_count):
+    """
+    Times the finders against the same lookups written as plain session.query().filter().first() calls on an in
+    memory sqlite database, so the difference is the per call query building and compilation the baked finders skip
+    """
+
+    # Set up the database
+    engine = create_engine('sqlite://')
+    base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    create_benchmark_rows(session, row_count)
+    lookups = get_benchmark_lookups(session, lookup_count)
+
+    # Warm up both (the first baked call builds and compiles)
+    time_lookups(session, lookups, 0, 1)
+    time_lookups(session, lookups, 1, 1)
+
+    # Time them
+    baked_time = time_lookups(session, lookups, 0, repeat_count)
+    unbaked_time = time_lookups(session, lookups, 1, repeat_count)
+    print(f'{len(lookups) * repeat_count} lookups per run')
+    print(f'plain queries: {unbaked_time:.1f} us per lookup')
+    print(f'baked finders: {baked_time:.1f} us per lookup ({unbaked_time / baked_time:.1f}x)')
+
+    # Clean up
+    session.close()
+    engine.dispose()
+
+
+if __name__ == '__main__':
+
+    # Argument Parsing
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('--rows', help="Races (and horses, jockeys and entries) to create", type=int,
+                            required=False, default=2000, metavar='ROWS')
+    arg_parser.add_argument('--lookups', help="Entries to look up per pass", type=int,
+                            required=False, default=200, metavar='LOOKUPS')
+    arg_parser.add_argument('--repeat', help="Passes over the lookups", type=int,
+                            required=False, default=5, metavar='REPEAT')
+    args = arg_parser.parse_args()
+
+    # Run benchmark
+    benchmark_finders(args.rows, args.lookups, args.repeat)
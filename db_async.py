@@ -0,0 +1,67 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from db_utils import get_db_session, unit_of_work, load_item_into_database, load_items_into_database, \
+    find_instance_from_item, find_horse_instance_from_item_and_race, DATABASE_ENGINE_OPTIONS
+
+# One worker per pooled connection so a running task never waits on the pool
+database_executor = ThreadPoolExecutor(
+    max_workers=DATABASE_ENGINE_OPTIONS.get('pool_size', 5),
+    thread_name_prefix='database'
+)
+
+
+def run_in_unit_of_work(function, *args, database='main'):
+
+    # Every task gets its own session (sessions can't be shared between threads)
+    session = get_db_session(database=database)
+
+    # Keep loaded attributes readable once the instances leave the session
+    session.expire_on_commit = False
+
+    # Run the whole function as one transaction
+    try:
+        with unit_of_work(session):
+            result = function(*args, session)
+    finally:
+        session.close()
+
+    # Return whatever the function returned (instances come back detached)
+    return result
+
+
+async def run_with_db_session(function, *args, database='main'):
+    """
+    Runs function(*args, session) on the database thread pool in its own session (on database) and unit of work so
+    the event loop can keep fetching and parsing while the database works
+    """
+
+    # Hand off to the database threads
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        database_executor, partial(run_in_unit_of_work, function, *args, database=database)
+    )
+
+
+async def async_load_item_into_database(item, item_type, database='main'):
+
+    # Return instance
+    return await run_with_db_session(load_item_into_database, item, item_type, database=database)
+
+
+async def async_load_items_into_database(items, item_type, database='main'):
+
+    # Return instances
+    return await run_with_db_session(load_items_into_database, items, item_type, database=database)
+
+
+async def async_find_instance_from_item(item, item_type, database='main'):
+
+    # Return instance
+    return await run_with_db_session(find_instance_from_item, item, item_type, database=database)
+
+
+async def async_find_horse_instance_from_item_and_race(item, race, database='main'):
+
+    # Return instance
+    return await run_with_db_session(find_horse_instance_from_item_and_race, item, race, database=database)
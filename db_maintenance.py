@@ -0,0 +1,402 @@
+from sqlalchemy import inspect, func, and_, or_, not_, text, select
+from sqlalchemy.schema import CreateIndex
+from db_utils import get_model_from_item_type, get_derived_keys_from_item, is_partitioned_table, \
+    upsert_latest_entry_pools
+from models import Horses, EntryPools, Probables
+import settings
+import datetime
+import re
+
+
+def process_in_batches(session, model, process_function, filters=(), batch_size=1000, description=None):
+    """
+    Runs process_function(instance) over every row of model that matches filters. Rows are read in primary key
+    batches and each batch is committed and expunged before the next one is read, so memory stays flat however big
+    the table is. process_function returns whether it changed the row. Returns (rows read, rows changed)
+    """
+
+    # Model info
+    primary_key = inspect(model).primary_key[0]
+    primary_key_attribute = inspect(model).get_property_by_column(primary_key).key
+    if description is None:
+        description = model.__tablename__
+
+    # Walk the table
+    read_count = 0
+    changed_count = 0
+    last_id = None
+    while True:
+
+        # Get batch
+        query = session.query(model).filter(*filters).order_by(primary_key)
+        if last_id is not None:
+            query = query.filter(primary_key > last_id)
+        instances = query.limit(batch_size).all()
+        if len(instances) == 0:
+            break
+        last_id = getattr(instances[-1], primary_key_attribute)
+
+        # Process batch
+        for instance in instances:
+            if process_function(instance):
+                changed_count += 1
+        read_count += len(instances)
+
+        # Write batch and let go of it
+        session.commit()
+        session.expunge_all()
+
+        # Report
+        print(f'{description}: read {read_count} rows, changed {changed_count}')
+
+    # Return counts
+    return read_count, changed_count
+
+
+def update_in_batches(session, model, values, filters=(), batch_size=10000, description=None):
+    """
+    Set based UPDATE ... WHERE for fixes that can be written in SQL. The update runs over primary key ranges of
+    batch_size with a commit after each one so a multi million row table is never locked in one transaction.
+    Returns the number of rows updated
+    """
+
+    # Model info
+    primary_key = inspect(model).primary_key[0]
+    if description is None:
+        description = model.__tablename__
+
+    # Get the primary key range
+    min_id, max_id = session.query(func.min(primary_key), func.max(primary_key)).filter(*filters).one()
+    if min_id is None:
+        return 0
+
+    # Update one range at a time
+    updated_count = 0
+    for range_start in range(min_id, max_id + 1, batch_size):
+        updated_count += session.query(model).filter(
+            *filters,
+            primary_key >= range_start,
+            primary_key < range_start + batch_size
+        ).update(values, synchronize_session=False)
+        session.commit()
+
+        # Report
+        print(f'{description}: updated {updated_count} rows (through id {min(range_start + batch_size - 1, max_id)})')
+
+    # Return count
+    return updated_count
+
+
+def fix_horse_registry(session):
+
+    # Variables
+    registries = ['Q', 'G', 'T', 'K']
+    types = ['MX', 'TB', 'QH']
+
+    # Swap registry and type where they were scraped into each others columns
+    update_in_batches(
+        session,
+        Horses,
+        {
+            Horses.equibase_horse_registry: Horses.equibase_horse_type,
+            Horses.equibase_horse_type: Horses.equibase_horse_registry,
+        },
+        filters=(
+            Horses.equibase_horse_type.in_(registries),
+            Horses.equibase_horse_registry.in_(types),
+        ),
+        description='fixing horse registries'
+    )
+
+    # Report the rows that are neither way around
+    def report_weird_horse(horse):
+        print(f'{horse.horse_id} is weird with type:'
+              f'{horse.equibase_horse_type} and reg:{horse.equibase_horse_registry}')
+        return False
+
+    process_in_batches(
+        session,
+        Horses,
+        report_weird_horse,
+        filters=(
+            Horses.equibase_horse_type.isnot(None),
+            Horses.equibase_horse_registry.isnot(None),
+            not_(or_(
+                and_(Horses.equibase_horse_type.in_(registries), Horses.equibase_horse_registry.in_(types)),
+                and_(Horses.equibase_horse_type.in_(types), Horses.equibase_horse_registry.in_(registries)),
+            ))
+        ),
+        description='checking horse registries'
+    )
+
+
+def backfill_derived_keys(session, batch_size=1000):
+
+    # Item type -> (derived column that is empty on old rows, columns it is computed from)
+    derived_key_sources = {
+        'horse': ('horse_name_key', ('horse_name',)),
+        'jockey': ('last_name_key', ('first_name', 'last_name')),
+        'trainer': ('last_name_key', ('first_name', 'last_name')),
+    }
+
+    # Fill derived keys on rows written before the columns existed
+    for item_type, (derived_column, source_columns) in derived_key_sources.items():
+        model = get_model_from_item_type(item_type)
+
+        # Fill keys on one row
+        def fill_derived_keys(instance):
+            source_item = {source_column: getattr(instance, source_column) for source_column in source_columns}
+            for key, value in get_derived_keys_from_item(source_item, item_type).items():
+                setattr(instance, key, value)
+            return True
+
+        # Walk the rows that are missing them
+        process_in_batches(
+            session,
+            model,
+            fill_derived_keys,
+            filters=(
+                getattr(model, derived_column).is_(None),
+                getattr(model, source_columns[-1]).isnot(None),
+            ),
+            batch_size=batch_size,
+            description=f'filling derived keys on {model.__tablename__}'
+        )
+
+
+def backfill_latest_entry_pools(session, batch_size=1000):
+    """
+    Fills latest_entry_pools from entry_pools (for odds loaded before the table existed or merged in from staging).
+    Entries are walked in id ranges of batch_size and only the newest snapshot of each entry and pool type is read.
+    Returns the number of rows written
+    """
+
+    # Get the entry id range
+    entry_pools = EntryPools.__table__
+    min_id, max_id = session.execute(
+        select([func.min(entry_pools.c.entry_id), func.max(entry_pools.c.entry_id)])
+    ).first()
+    if min_id is None:
+        return 0
+
+    # One range at a time
+    written_count = 0
+    for range_start in range(min_id, max_id + 1, batch_size):
+
+        # Newest scrape of each entry and pool type in the range
+        range_filter = and_(entry_pools.c.entry_id >= range_start, entry_pools.c.entry_id < range_start + batch_size)
+        latest = select([
+            entry_pools.c.entry_id,
+            entry_pools.c.pool_type,
+            func.max(entry_pools.c.scrape_time).label('scrape_time')
+        ]).where(range_filter).group_by(entry_pools.c.entry_id, entry_pools.c.pool_type).alias('latest')
+        rows = session.execute(
+            select([entry_pools]).select_from(entry_pools.join(latest, and_(
+                entry_pools.c.entry_id == latest.c.entry_id,
+                entry_pools.c.pool_type == latest.c.pool_type,
+                entry_pools.c.scrape_time == latest.c.scrape_time
+            )))
+        ).fetchall()
+
+        # Write them
+        written_count += upsert_latest_entry_pools([dict(row) for row in rows], session)
+        session.commit()
+
+        # Report
+        last_entry_id = min(range_start + batch_size - 1, max_id)
+        print(f'latest entry pools: wrote {written_count} rows (through entry {last_entry_id})')
+
+    # Return count
+    return written_count
+
+
+def get_partitioned_table_models():
+
+    # Append only odds tables that are only ever read by race and scrape time
+    return [EntryPools, Probables]
+
+
+def get_month_start(date_time):
+
+    # First instant of the month
+    return datetime.datetime(date_time.year, date_time.month, 1)
+
+
+def add_months(month_start, months):
+
+    # Month arithmetic on month starts
+    month_index = month_start.month - 1 + months
+    return datetime.datetime(month_start.year + month_index // 12, month_index % 12 + 1, 1)
+
+
+def get_legacy_partition_upper_bound(connection, table_name):
+
+    # Upper bound of the partition holding the rows from before partitioning
+    partition_bound = connection.execute(
+        text("SELECT pg_get_expr(relpartbound, oid) FROM pg_class WHERE relname = :partition_name"),
+        partition_name=f'{table_name}_legacy'
+    ).scalar()
+    if partition_bound is None:
+        return
+    bound_search = re.search(r"TO \('([^']+)'\)", partition_bound)
+    if bound_search is None:
+        return
+    return datetime.datetime.fromisoformat(bound_search.group(1))
+
+
+def prepare_table_for_partitioning(engine, model):
+    """
+    Does the slow part of partitioning without blocking the loaders. A NOT VALID check proves the rows fit the old
+    rows partition (validating it only takes SHARE UPDATE EXCLUSIVE) and the partition's primary key index is built
+    concurrently. Returns the upper bound of the old rows partition
+    """
+
+    # Table info
+    table_name = model.__tablename__
+    legacy_name = f'{table_name}_legacy'
+    primary_key_name = inspect(model).primary_key[0].name
+
+    # Old rows stay where they are (through next month so loads can keep landing there while this runs)
+    boundary = add_months(get_month_start(datetime.datetime.utcnow()), 2)
+    with engine.connect() as connection:
+        newest_scrape_time = connection.execute(f'SELECT max(scrape_time) FROM {table_name}').scalar()
+    if newest_scrape_time is not None and newest_scrape_time >= boundary:
+        boundary = add_months(get_month_start(newest_scrape_time), 1)
+
+    # Check the bounds without holding up writes (new rows are checked from the start)
+    with engine.begin() as connection:
+        connection.execute(f'ALTER TABLE {table_name} DROP CONSTRAINT IF EXISTS {legacy_name}_scrape_time_check')
+        connection.execute(
+            f"ALTER TABLE {table_name} ADD CONSTRAINT {legacy_name}_scrape_time_check "
+            f"CHECK (scrape_time IS NOT NULL AND scrape_time < '{boundary.isoformat()}') NOT VALID"
+        )
+    with engine.begin() as connection:
+        connection.execute(f'ALTER TABLE {table_name} VALIDATE CONSTRAINT {legacy_name}_scrape_time_check')
+
+    # The partition needs the parents primary key (which has to include scrape_time), build its index alongside writes
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {legacy_name}_pkey')
+        connection.execute(
+            f'CREATE UNIQUE INDEX CONCURRENTLY {legacy_name}_pkey ON {table_name} ({primary_key_name}, scrape_time)'
+        )
+
+    # Return bound
+    return boundary
+
+
+def partition_table_by_scrape_time(connection, model, boundary):
+    """
+    Turns a table prepared by prepare_table_for_partitioning into one range partitioned by month of scrape_time. The
+    existing table becomes the partition for everything before boundary and an empty default partition catches rows
+    no month partition covers yet. Nothing here scans or rebuilds the old rows, the validated check and the prebuilt
+    index stand in for that, so the ACCESS EXCLUSIVE lock is only held briefly
+    """
+
+    # Table info
+    table_name = model.__tablename__
+    legacy_name = f'{table_name}_legacy'
+    primary_key_name = inspect(model).primary_key[0].name
+
+    # Move the existing table and its key and index names out of the way
+    primary_key_constraint = connection.execute(
+        text("SELECT conname FROM pg_constraint WHERE conrelid = CAST(:table_name AS regclass) AND contype = 'p'"),
+        table_name=table_name
+    ).scalar()
+    id_sequence = connection.execute(
+        text('SELECT pg_get_serial_sequence(:table_name, :column_name)'),
+        table_name=table_name,
+        column_name=primary_key_name
+    ).scalar()
+    connection.execute(f'ALTER TABLE {table_name} RENAME TO {legacy_name}')
+    for index in model.__table__.indexes:
+        connection.execute(f'ALTER INDEX IF EXISTS {index.name} RENAME TO {index.name}_legacy')
+
+    # Swap in the new primary key (the validated check already proves scrape_time has no nulls)
+    connection.execute(f'ALTER TABLE {legacy_name} ALTER COLUMN scrape_time SET NOT NULL')
+    if primary_key_constraint is not None:
+        connection.execute(f'ALTER TABLE {legacy_name} DROP CONSTRAINT {primary_key_constraint}')
+    connection.execute(
+        f'ALTER TABLE {legacy_name} ADD CONSTRAINT {legacy_name}_pkey PRIMARY KEY USING INDEX {legacy_name}_pkey'
+    )
+
+    # Partitioned parent with the same columns and defaults (ids keep coming from the same sequence)
+    connection.execute(
+        f'CREATE TABLE {table_name} (LIKE {legacy_name} INCLUDING DEFAULTS) PARTITION BY RANGE (scrape_time)'
+    )
+    if id_sequence is not None:
+        connection.execute(f'ALTER SEQUENCE {id_sequence} OWNED BY {table_name}.{primary_key_name}')
+
+    # Keys and indexes on the empty parent first so attaching reuses the old table's (unique ones have to include
+    # scrape_time, the natural keys already do)
+    connection.execute(f'ALTER TABLE {table_name} ADD PRIMARY KEY ({primary_key_name}, scrape_time)')
+    for foreign_key in model.__table__.foreign_keys:
+        connection.execute(
+            f'ALTER TABLE {table_name} ADD FOREIGN KEY ({foreign_key.parent.name}) '
+            f'REFERENCES {foreign_key.column.table.name} ({foreign_key.column.name})'
+        )
+    for index in model.__table__.indexes:
+        connection.execute(CreateIndex(index))
+
+    # Attach the old rows and add the catch all
+    connection.execute(
+        f"ALTER TABLE {table_name} ATTACH PARTITION {legacy_name} "
+        f"FOR VALUES FROM (MINVALUE) TO ('{boundary.isoformat()}')"
+    )
+    connection.execute(f'ALTER TABLE {legacy_name} DROP CONSTRAINT {legacy_name}_scrape_time_check')
+    connection.execute(f'CREATE TABLE {table_name}_default PARTITION OF {table_name} DEFAULT')
+
+
+def create_scrape_time_partitions(connection, model, months_ahead):
+
+    # Table info
+    table_name = model.__tablename__
+
+    # Start with this month (or where the pre partitioning rows end)
+    this_month = get_month_start(datetime.datetime.utcnow())
+    month = this_month
+    legacy_upper_bound = get_legacy_partition_upper_bound(connection, table_name)
+    if legacy_upper_bound is not None and legacy_upper_bound > month:
+        month = legacy_upper_bound
+
+    # Create every missing month through months_ahead
+    while month <= add_months(this_month, months_ahead):
+        partition_name = f'{table_name}_{month:%Y_%m}'
+        partition_exists = connection.execute(
+            text('SELECT count(*) FROM pg_class WHERE relname = :partition_name'),
+            partition_name=partition_name
+        ).scalar() > 0
+        if not partition_exists:
+            connection.execute(
+                f"CREATE TABLE {partition_name} PARTITION OF {table_name} "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+            )
+            print(f'created partition {partition_name}')
+        month = add_months(month, 1)
+
+
+def partition_odds_tables(engine, months_ahead=None):
+    """
+    Opt in monthly range partitioning of entry_pools and probables on scrape_time (postgres 12 or newer). The first
+    run converts the tables (checking and indexing the old rows while loads keep running, then swapping the tables in
+    one short transaction), every run creates the month partitions through months_ahead so schedule it monthly.
+    Loaders don't change, inserts and COPY go through the parent. Drop an old month with DROP TABLE on its partition
+    """
+
+    # Postgres only
+    if engine.dialect.name != 'postgresql':
+        print(f'partitioning is only supported on postgres, not {engine.dialect.name}')
+        return
+
+    # How far ahead to keep partitions ready
+    if months_ahead is None:
+        months_ahead = getattr(settings, 'ODDS_PARTITION_MONTHS_AHEAD', 3)
+
+    # Each table on its own (the conversion itself is one short transaction)
+    for model in get_partitioned_table_models():
+        if not is_partitioned_table(engine, model.__tablename__):
+            boundary = prepare_table_for_partitioning(engine, model)
+            with engine.begin() as connection:
+                partition_table_by_scrape_time(connection, model, boundary)
+            print(f'partitioned {model.__tablename__} by month of scrape_time')
+        with engine.begin() as connection:
+            create_scrape_time_partitions(connection, model, months_ahead)
@@ -0,0 +1,172 @@
+from sqlalchemy import inspect, and_, exists
+from db_utils import get_db_session, shutdown_session_and_engine, get_model_from_item_type, \
+    load_items_into_database, unit_of_work
+from models import base
+
+
+def get_staging_merge_plan():
+
+    # Item types in foreign key order with the columns that point at earlier types
+    return [
+        ('track', {}),
+        ('horse', {}),
+        ('jockey', {}),
+        ('trainer', {}),
+        ('owner', {}),
+        ('race', {'track_id': 'track'}),
+        ('entry', {'race_id': 'race', 'horse_id': 'horse', 'trainer_id': 'trainer', 'jockey_id': 'jockey',
+                   'owner_id': 'owner'}),
+        ('entry_pool', {'entry_id': 'entry'}),
+        ('payoff', {'race_id': 'race'}),
+        ('probable', {'race_id': 'race'}),
+        ('probable_matrix', {'race_id': 'race'}),
+        ('pick', {'race_id': 'race'}),
+        ('workout', {'horse_id': 'horse', 'track_id': 'track'}),
+        ('analysis_probability', {'entry_id': 'entry'}),
+        ('fractional_time', {'race_id': 'race'}),
+        ('point_of_call', {'entry_id': 'entry'}),
+        ('betting_result', {}),
+        ('database_statistic', {}),
+    ]
+
+
+def get_primary_key_attribute(model):
+
+    # Attribute name of the (single column) primary key
+    mapper = inspect(model)
+    return mapper.get_property_by_column(mapper.primary_key[0]).key
+
+
+def create_item_from_staged_instance(instance, primary_key_attribute):
+
+    # Staged nulls never erase data that is already in the main database
+    item = dict()
+    for column_attribute in inspect(instance).mapper.column_attrs:
+        value = getattr(instance, column_attribute.key)
+        if column_attribute.key != primary_key_attribute and value is not None:
+            item[column_attribute.key] = value
+
+    # Return item
+    return item
+
+
+def delete_merged_staged_rows(merged_ids, staging_session, batch_size=1000):
+
+    # Children first, and parents only once nothing left in staging points at them (so skipped rows can still be
+    # merged on a later run)
+    for item_type, foreign_keys in reversed(get_staging_merge_plan()):
+        model = get_model_from_item_type(item_type)
+        primary_key = getattr(model, get_primary_key_attribute(model))
+        referencing_columns = [
+            getattr(get_model_from_item_type(child_type), foreign_key)
+            for child_type, child_foreign_keys in get_staging_merge_plan()
+            for foreign_key, referenced_type in child_foreign_keys.items() if referenced_type == item_type
+        ]
+        type_ids = merged_ids.get(item_type, [])
+        for batch_start in range(0, len(type_ids), batch_size):
+            staging_session.query(model).filter(and_(
+                primary_key.in_(type_ids[batch_start:batch_start + batch_size]),
+                *[~exists().where(column == primary_key) for column in referencing_columns]
+            )).delete(synchronize_session=False)
+            staging_session.commit()
+
+
+def merge_staging_into_main(batch_size=1000, clear_staging=True):
+    """
+    Moves everything in the staging database into the main database. Rows are read in primary key batches, their
+    foreign keys are translated to main database ids and each batch is resolved set-wise on natural keys through
+    load_items_into_database (one lookup and one multi row insert per batch). Rows that can't be resolved stay in
+    staging (the rest is cleared if clear_staging), returns how many were skipped
+    """
+
+    # Connect to both databases
+    staging_session = get_db_session(database='staging')
+    main_session = get_db_session()
+
+    # Staging id -> main id for every type something else points at, and the staged ids of everything merged
+    id_maps = dict()
+    merged_ids = dict()
+    skipped_count = 0
+    referenced_types = set(
+        referenced_type for item_type, foreign_keys in get_staging_merge_plan()
+        for referenced_type in foreign_keys.values()
+    )
+
+    # Merge each type in order
+    for item_type, foreign_keys in get_staging_merge_plan():
+
+        # Type info
+        model = get_model_from_item_type(item_type)
+        primary_key_attribute = get_primary_key_attribute(model)
+        primary_key = getattr(model, primary_key_attribute)
+        if item_type in referenced_types:
+            id_maps[item_type] = dict()
+        merged_ids[item_type] = []
+
+        # Walk the staged rows in primary key batches
+        merged_count = 0
+        last_id = None
+        while True:
+
+            # Get batch
+            query = staging_session.query(model).order_by(primary_key)
+            if last_id is not None:
+                query = query.filter(primary_key > last_id)
+            staged_instances = query.limit(batch_size).all()
+            if len(staged_instances) == 0:
+                break
+            last_id = getattr(staged_instances[-1], primary_key_attribute)
+
+            # Translate to main database items
+            staged_ids = []
+            items = []
+            for staged_instance in staged_instances:
+                item = create_item_from_staged_instance(staged_instance, primary_key_attribute)
+                for foreign_key, referenced_type in foreign_keys.items():
+                    if foreign_key in item:
+                        item[foreign_key] = id_maps[referenced_type].get(item[foreign_key], None)
+
+                # Skip orphans (whatever they pointed at never made it into staging)
+                if None in item.values():
+                    print(f'skipping staged {item_type} {getattr(staged_instance, primary_key_attribute)}')
+                    item = None
+                staged_ids.append(getattr(staged_instance, primary_key_attribute))
+                items.append(item)
+
+            # Resolve the whole batch against the main database
+            with unit_of_work(main_session):
+                instances = load_items_into_database(items, item_type, main_session)
+
+                # Remember where things ended up (before the commit expires the instances)
+                for staged_id, instance in zip(staged_ids, instances):
+                    if instance is None:
+                        skipped_count += 1
+                        continue
+                    merged_ids[item_type].append(staged_id)
+                    if item_type in referenced_types:
+                        id_maps[item_type][staged_id] = getattr(instance, primary_key_attribute)
+
+            # Keep memory flat
+            merged_count += len([instance for instance in instances if instance is not None])
+            staging_session.expunge_all()
+            main_session.expunge_all()
+
+        # Report
+        print(f'merged {merged_count} staged {item_type} rows')
+
+    # Only remove what was merged when something was left behind
+    if clear_staging and skipped_count > 0:
+        delete_merged_staged_rows(merged_ids, staging_session, batch_size)
+
+    # Close everything out
+    staging_engine = staging_session.get_bind()
+    shutdown_session_and_engine(staging_session)
+    shutdown_session_and_engine(main_session)
+
+    # Start staging over when everything made it in
+    if clear_staging and skipped_count == 0:
+        base.metadata.drop_all(bind=staging_engine)
+        base.metadata.create_all(staging_engine)
+
+    # Return rows left behind
+    return skipped_count
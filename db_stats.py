@@ -4,10 +4,10 @@ from db_utils import load_item_into_database
 from sqlalchemy import or_, and_
 
 
-def log_total_number_of_races(session):
+def log_total_number_of_races(session, read_session):
 
     # Get total number of races in the database
-    number_of_races = session.query(Races.race_id).count()
+    number_of_races = read_session.query(Races.race_id).count()
 
     # If it returns a value enter it into the database
     if number_of_races:
@@ -23,10 +23,10 @@ def log_total_number_of_races(session):
         stat = load_item_into_database(stat_item, 'database_statistic', session)
 
 
-def log_total_number_of_drf_entry_races(session):
+def log_total_number_of_drf_entry_races(session, read_session):
 
     # Get total number of races in the database
-    number_of_races = session.query(Races.race_id)\
+    number_of_races = read_session.query(Races.race_id)\
         .filter(Races.drf_entries == True)\
         .count()
 
@@ -43,9 +43,9 @@ def log_total_number_of_drf_entry_races(session):
         stat = load_item_into_database(stat_item, 'database_statistic', session)
 
 
-def log_total_number_of_equibase_chart_scraped_races(session):
+def log_total_number_of_equibase_chart_scraped_races(session, read_session):
     # Get total number of races in the database
-    number_of_races = session.query(Races.race_id) \
+    number_of_races = read_session.query(Races.race_id) \
         .filter(Races.equibase_chart_scrape == True) \
         .count()
 
@@ -63,9 +63,9 @@ def log_total_number_of_equibase_chart_scraped_races(session):
         stat = load_item_into_database(stat_item, 'database_statistic', session)
 
 
-def log_total_number_of_horse_detail_races(session):
+def log_total_number_of_horse_detail_races(session, read_session):
     # Get total number of races in the database
-    number_of_races = session.query(Races.race_id) \
+    number_of_races = read_session.query(Races.race_id) \
         .filter(Races.equibase_horse_results == True) \
         .count()
 
@@ -83,10 +83,10 @@ def log_total_number_of_horse_detail_races(session):
         stat = load_item_into_database(stat_item, 'database_statistic', session)
 
 
-def log_total_number_of_missing_equibase_ids(session):
+def log_total_number_of_missing_equibase_ids(session, read_session):
 
     # Get total number of races in the database
-    number_of_horses = session.query(
+    number_of_horses = read_session.query(
         Horses, Races, Tracks, Entries
     ).filter(
         Horses.horse_id == Entries.horse_id
@@ -115,10 +115,10 @@ def log_total_number_of_missing_equibase_ids(session):
         stat = load_item_into_database(stat_item, 'database_statistic', session)
 
 
-def log_total_number_of_remaining_detail_scrapes(session):
+def log_total_number_of_remaining_detail_scrapes(session, read_session):
 
     # Get horse count
-    number_of_horses = session.query(Horses, Races, Entries).filter(
+    number_of_horses = read_session.query(Horses, Races, Entries).filter(
         Races.race_id == Entries.race_id,
         Horses.horse_id == Entries.horse_id,
         Races.drf_entries == True,
@@ -150,10 +150,10 @@ def log_total_number_of_remaining_detail_scrapes(session):
         stat = load_item_into_database(stat_item, 'database_statistic', session)
 
 
-def log_total_number_of_remaining_chart_downloads(session):
+def log_total_number_of_remaining_chart_downloads(session, read_session):
 
     # Get horse count
-    number_of_charts = session.query(Races.card_date, Races.track_id).filter(
+    number_of_charts = read_session.query(Races.card_date, Races.track_id).filter(
             or_(
                 Races.equibase_chart_download_date.is_(None),
                 Races.equibase_chart_download_date < datetime.datetime(year=1910, month=1, day=1)
@@ -175,12 +175,21 @@ def log_total_number_of_remaining_chart_downloads(session):
         stat = load_item_into_database(stat_item, 'database_statistic', session)
 
 
-def record_all_statistics(session):
-
-    log_total_number_of_remaining_chart_downloads(session)
-    log_total_number_of_horse_detail_races(session)
-    log_total_number_of_missing_equibase_ids(session)
-    log_total_number_of_equibase_chart_scraped_races(session)
-    log_total_number_of_drf_entry_races(session)
-    log_total_number_of_races(session)
-    log_total_number_of_remaining_detail_scrapes(session)
\ No newline at end of file
+def record_all_statistics(session, read_session=None):
+    """
+    Counts run on read_session (see get_read_session) so they don't hold up loaders on the write pool, the
+    statistics are written with session
+    """
+
+    # Count on the write session if there is no read session
+    if read_session is None:
+        read_session = session
+
+    # Record statistics
+    log_total_number_of_remaining_chart_downloads(session, read_session)
+    log_total_number_of_horse_detail_races(session, read_session)
+    log_total_number_of_missing_equibase_ids(session, read_session)
+    log_total_number_of_equibase_chart_scraped_races(session, read_session)
+    log_total_number_of_drf_entry_races(session, read_session)
+    log_total_number_of_races(session, read_session)
+    log_total_number_of_remaining_detail_scrapes(session, read_session)
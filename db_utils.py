@@ -2,19 +2,168 @@ from sqlalchemy import create_engine
 from sqlalchemy.engine.url import URL
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.sql import null
+from sqlalchemy.sql.elements import Null
+import settings
 from settings import DATABASE
-from sqlalchemy.ext.declarative import declarative_base
 from models import Races, Horses, Entries, EntryPools, Payoffs, Probables, Tracks, Jockeys, Owners, Trainers, \
-    Picks, BettingResults, Workouts, base, AnalysisProbabilities, PointsOfCall, FractionalTimes, DatabaseStatistics
-from sqlalchemy import func
-
-
-def db_connect():
+    Picks, BettingResults, Workouts, base, AnalysisProbabilities, PointsOfCall, FractionalTimes, DatabaseStatistics, \
+    ProbableMatrices, LatestEntryPools
+from sqlalchemy import func, inspect, event, text, or_, and_, select, bindparam, exists, true, false, union_all
+from sqlalchemy.ext import baked
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.orm import Session
+from entity_cache import entity_cache, get_instance_from_values
+from track_registry import track_registry
+from finder_profiler import finder_profiler
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.schema import CreateIndex
+from utils import get_name_key, get_first_initial, get_horse_name_key
+from contextlib import contextmanager
+import csv
+import datetime
+import decimal
+import io
+import os
+import threading
+
+# Engine settings (override any of them with DATABASE_ENGINE_OPTIONS in settings.py)
+DATABASE_ENGINE_OPTIONS = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+}
+DATABASE_ENGINE_OPTIONS.update(getattr(settings, 'DATABASE_ENGINE_OPTIONS', {}))
+
+# Local sqlite staging database (WAL mode) for backfills and offline replays
+STAGING_DATABASE = {
+    'drivername': 'sqlite',
+    'database': getattr(
+        settings,
+        'STAGING_DATABASE_PATH',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'staging.db')
+    ),
+}
+
+# Read only engine for statistics, backlog and analysis queries (READ_DATABASE can point at a replica, by default
+# it is the main database through a separate, smaller pool with a statement timeout in milliseconds)
+READ_DATABASE = getattr(settings, 'READ_DATABASE', DATABASE)
+READ_DATABASE_ENGINE_OPTIONS = {
+    'pool_size': 2,
+    'max_overflow': 3,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+}
+READ_DATABASE_ENGINE_OPTIONS.update(getattr(settings, 'READ_DATABASE_ENGINE_OPTIONS', {}))
+READ_STATEMENT_TIMEOUT = getattr(settings, 'READ_STATEMENT_TIMEOUT', 600000)
+
+# Process wide engines and session factory
+engine_lock = threading.RLock()
+process_engines = dict()
+schema_checked = set()
+checked_unique_indexes = dict()
+session_factory = sessionmaker()
+
+
+def db_connect(database=DATABASE, engine_options=None, read_only=False):
     """
     Performs database connection using database settings from settings.py.
     Returns sqlalchemy engine instance
     """
-    return create_engine(URL(**DATABASE))
+
+    # Get options
+    url = URL(**database)
+    if engine_options is None:
+        engine_options = DATABASE_ENGINE_OPTIONS
+    engine_options = dict(engine_options)
+
+    # sqlite doesn't use a sized pool
+    if url.drivername.startswith('sqlite'):
+        engine_options.pop('pool_size', None)
+        engine_options.pop('max_overflow', None)
+
+    # Create engine
+    engine = create_engine(url, **engine_options)
+    if url.drivername.startswith('sqlite'):
+        configure_sqlite_engine(engine, read_only)
+    elif read_only and url.drivername.startswith('postgresql'):
+        configure_postgresql_read_engine(engine)
+
+    # Return engine
+    return engine
+
+
+def configure_sqlite_engine(engine, read_only=False):
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+
+        # Let sqlalchemy manage transactions (pysqlite's own handling breaks savepoints)
+        dbapi_connection.isolation_level = None
+
+        # WAL lets readers work while a backfill writes
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        if read_only:
+            cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def begin_sqlite_transaction(connection):
+
+        # Emit our own BEGIN since pysqlite no longer does (IMMEDIATE takes the write lock up front so two sessions
+        # that read and then write wait on each other instead of failing with database is locked, readers never
+        # write so they don't take it)
+        if read_only:
+            connection.execute('BEGIN')
+        else:
+            connection.execute('BEGIN IMMEDIATE')
+
+
+def configure_postgresql_read_engine(engine):
+
+    @event.listens_for(engine, 'connect')
+    def set_read_only_session(dbapi_connection, connection_record):
+
+        # Long reads give up instead of running forever and nothing on this pool can write
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'SET statement_timeout = {int(READ_STATEMENT_TIMEOUT)}')
+        cursor.execute('SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY')
+        cursor.close()
+        dbapi_connection.commit()
+
+
+def get_engine(database='main'):
+
+    # Database settings
+    database_settings = {
+        'main': (DATABASE, DATABASE_ENGINE_OPTIONS),
+        'staging': (STAGING_DATABASE, {}),
+        'read': (READ_DATABASE, READ_DATABASE_ENGINE_OPTIONS, True),
+    }
+    if database not in database_settings:
+        raise ValueError(f'{database} is not a known database')
+
+    # Create each engine once per process
+    with engine_lock:
+        if database not in process_engines:
+            process_engines[database] = db_connect(*database_settings[database])
+
+    # Return engine
+    return process_engines[database]
+
+
+def dispose_engine():
+
+    # Close every pooled connection (call once when the process is done)
+    with engine_lock:
+        for engine in process_engines.values():
+            engine.dispose()
+        process_engines.clear()
+        schema_checked.clear()
+        checked_unique_indexes.clear()
 
 
 def create_drf_live_table(engine, destroy_flag):
@@ -24,37 +173,273 @@ def create_drf_live_table(engine, destroy_flag):
     base.metadata.create_all(engine)
 
 
-def get_db_session(destroy_flag=False):
+def upgrade_database_schema(engine):
+    """
+    Brings an existing database up to date with models.py by creating missing tables, adding missing columns and
+    building missing indexes (concurrently on postgres so ingest can keep running)
+    """
 
-    # Connect to the database
-    engine = db_connect()
-    create_drf_live_table(engine, destroy_flag)
-    session_maker_class = sessionmaker(bind=engine)
-    session = session_maker_class()
+    # Create any missing tables
+    base.metadata.create_all(engine)
 
-    # Return session
-    return session
+    # Inspect what is already there
+    inspector = inspect(engine)
+    for table in base.metadata.sorted_tables:
+
+        # Add missing columns
+        existing_columns = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=engine.dialect)
+                engine.execute(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+                print(f'added column {table.name}.{column.name}')
+
+        # Add missing indexes
+        existing_indexes = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+
+            # Compile the index ddl (partitioned tables can't build indexes concurrently)
+            index_ddl = str(CreateIndex(index).compile(dialect=engine.dialect))
+            if engine.dialect.name == 'postgresql' and not is_partitioned_table(engine, table.name):
+                index_ddl = index_ddl.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+
+            # Create the index outside of a transaction
+            with engine.connect() as connection:
+                connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+                try:
+                    connection.execute(index_ddl)
+                    print(f'created index {index.name}')
+                except SQLAlchemyError as error:
+                    # Usually duplicate natural keys that need to be cleaned up before the unique index can exist
+                    print(f'could not create index {index.name} on {table.name}: {error.orig}')
+
+                    # Only clear away what the failed build left behind (never an index that was already there)
+                    if is_invalid_index(connection, index.name):
+                        connection.execute(f'DROP INDEX IF EXISTS {index.name}')
+
+
+def is_partitioned_table(connection, table_name):
+
+    # Postgres marks partitioned parents with relkind p
+    if connection.dialect.name != 'postgresql':
+        return False
+    return connection.execute(
+        text("SELECT count(*) FROM pg_class WHERE relname = :table_name AND relkind = 'p'"),
+        table_name=table_name
+    ).scalar() > 0
+
+
+def is_invalid_index(connection, index_name):
+
+    # Failed concurrent builds leave an index postgres marks as not valid
+    if connection.dialect.name != 'postgresql':
+        return False
+    return connection.execute(
+        text(
+            'SELECT count(*) FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+            'WHERE pg_class.relname = :index_name AND NOT pg_index.indisvalid'
+        ),
+        index_name=index_name
+    ).scalar() > 0
+
+
+def get_missing_columns(engine):
+
+    # Mapped columns the database doesn't have (create_all only creates missing tables)
+    inspector = inspect(engine)
+    missing_columns = []
+    for table in base.metadata.sorted_tables:
+        existing_columns = set(column['name'] for column in inspector.get_columns(table.name))
+        missing_columns.extend(
+            f'{table.name}.{column.name}' for column in table.columns if column.name not in existing_columns
+        )
+
+    # Return missing columns
+    return missing_columns
+
+
+def check_database_schema(engine, database='main'):
+
+    # Refuse to load into a database that is missing mapped columns (every query on those tables would fail)
+    missing_columns = get_missing_columns(engine)
+    if len(missing_columns) > 0:
+        raise RuntimeError(
+            f'the {database} database is missing the columns {", ".join(missing_columns)}, '
+            f'run import_data.py --mode upgrade_database first'
+        )
+
+
+def get_db_session(destroy_flag=False, database='main', check_schema=True):
+
+    # Get the shared engine
+    engine = get_engine(database)
+
+    # Only check the schema once per process (upgrade_database skips the check, it adds the missing columns)
+    with engine_lock:
+        if destroy_flag or database not in schema_checked:
+            create_drf_live_table(engine, destroy_flag)
+            if check_schema:
+                check_database_schema(engine, database)
+                schema_checked.add(database)
+
+    # Return session from the shared factory
+    return session_factory(bind=engine, info={'database': database})
+
+
+def get_read_session(database='main'):
+    """
+    Session for long read only queries (statistics, backlogs, analysis) on the read engine so they never hold
+    connections or locks the loaders need. Reads may lag the main database when READ_DATABASE is a replica, so hand
+    back ids or values rather than instances and recheck before writing. Only main has a read engine, other databases
+    get a regular session
+    """
 
+    # Regular session for databases without a read engine
+    if database != 'main':
+        return get_db_session(database=database)
 
-def shutdown_session_and_engine(session):
+    # Return session on the read engine (it shares the main database's caches)
+    return session_factory(bind=get_engine('read'), info={'database': 'main', 'read_only': True})
 
-    # Get engine from session
-    engine = session.get_bind()
 
-    # Close everything out
+def shutdown_session_and_engine(session):
+
+    # Close the session (its connection goes back to the pool, the engine lives until dispose_engine)
     session.close()
-    engine.dispose()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def clear_entity_cache_after_rollback(session, previous_transaction):
+
+    # Rolled back rows may still be in the caches
+    entity_cache.clear()
+    track_registry.invalidate(session.info.get('database', 'main'))
+
+
+def get_entity_cache_item_type(model):
+
+    # Item types the entity cache holds
+    return {Horses: 'horse', Jockeys: 'jockey', Trainers: 'trainer', Owners: 'owner'}.get(model)
+
+
+@event.listens_for(Session, 'after_flush')
+def invalidate_entity_cache_after_flush(session, flush_context):
+
+    # Rows changed or deleted through the ORM outside the loaders can't be served from the cache anymore
+    for instance in list(session.dirty) + list(session.deleted):
+        item_type = get_entity_cache_item_type(type(instance))
+        if item_type is not None and inspect(instance).identity is not None:
+            entity_cache.invalidate(get_entity_cache_type(item_type, session), instance)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def invalidate_entity_cache_after_bulk_write(update_context):
+
+    # Bulk writes don't say which rows they touched so drop the whole type
+    item_type = get_entity_cache_item_type(update_context.mapper.class_)
+    if item_type is not None:
+        entity_cache.invalidate_type(get_entity_cache_type(item_type, update_context.session))
+
+
+def commit_session(session):
+
+    # Inside a unit of work only flush, the unit of work commits once when it finishes
+    if session.info.get('unit_of_work', False):
+        session.flush()
+    else:
+        session.commit()
+
+
+@contextmanager
+def unit_of_work(session):
+    """
+    Groups everything loaded inside the block (usually a race card) into one transaction. The loaders only flush
+    while it is active and a single commit happens at the end, anything raised rolls the whole block back.
+    """
+
+    # Nested units of work join the outer one
+    if session.info.get('unit_of_work', False):
+        yield session
+        return
+
+    # Start unit of work
+    session.info['unit_of_work'] = True
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.info['unit_of_work'] = False
+
+
+@contextmanager
+def race_savepoint(session, raise_errors=False, on_commit=None):
+    """
+    Wraps a single race inside a unit of work in a savepoint so a bad race only rolls back itself. on_commit is called
+    once the savepoint has been released (never for a race that rolled back)
+    """
+
+    # Create savepoint
+    savepoint = session.begin_nested()
+    try:
+        yield savepoint
+        savepoint.commit()
+    except (KeyboardInterrupt, SystemExit):  # handle control c
+        savepoint.rollback()
+        raise
+    except Exception as error:
+        savepoint.rollback()
+        if raise_errors:
+            raise
+        else:
+            print(f'rolled back race because of {error!r}')
+    else:
+        if on_commit is not None:
+            on_commit()
 
 
 def find_track_instance_from_item(item, session):
+
+    # Work out which key the item identifies the track by
     if 'code' in item:
-        return session.query(Tracks).filter(
-            Tracks.code == item['code']
-        ).first()
+        index_name = 'code'
     elif 'name' in item:
-        return session.query(Tracks).filter(
-            Tracks.name == item['name']
-        ).first()
+        index_name = 'name'
+    elif 'equibase_chart_name' in item:
+        index_name = 'equibase_chart_name'
+    else:
+        return
+
+    # Check the in memory registry first
+    track = track_registry.get(session, index_name, item[index_name])
+    if track is not None:
+        return track
+
+    # Fall back to the database for tracks added since the registry was loaded
+    track = query_track_instance_from_item(item, session)
+    if track is not None:
+        track_registry.invalidate(session.info.get('database', 'main'))
+    return track
+
+
+def query_track_instance_from_item(item, session):
+    if 'code' in item:
+        return find_first_instance(
+            session,
+            Tracks,
+            code=item['code']
+        )
+    elif 'name' in item:
+        return find_first_instance(
+            session,
+            Tracks,
+            name=item['name']
+        )
     elif 'equibase_chart_name' in item:
         return session.query(Tracks).filter(
             func.replace(func.replace(Tracks.equibase_chart_name, "'", ''), '&', '') ==
@@ -64,152 +449,380 @@ def find_track_instance_from_item(item, session):
         return
 
 
+# Finder queries are baked so each one is built and compiled once per process
+finder_bakery = baked.bakery(size=500)
+
+
+def find_first_instance(session, model, **filter_values):
+    """
+    Returns the first instance of model whose attributes equal filter_values. The query is baked per model and set of
+    attributes so only the values are bound on each call
+    """
+
+    with finder_profiler.profile(f'{model.__tablename__} (first)', session):
+        # Nulls need IS NULL which a bound parameter can't express
+        attribute_names = tuple(filter_values.keys())
+        if any(value is None or isinstance(value, Null) for value in filter_values.values()):
+            return session.query(model).filter(*[
+                getattr(model, attribute_name) == value for attribute_name, value in filter_values.items()
+            ]).first()
+
+        # Build (or reuse) the baked query
+        baked_query = finder_bakery(lambda session: session.query(model), model, attribute_names)
+        baked_query.add_criteria(
+            lambda query: query.filter(*[
+                getattr(model, attribute_name) == bindparam(attribute_name) for attribute_name in attribute_names
+            ]),
+            model,
+            attribute_names
+        )
+
+        # Return instance
+        return baked_query(session).params(**filter_values).first()
+
+
 def find_race_instance_from_item(item, session):
-    return session.query(Races).filter(
-        Races.track_id == item['track_id'],
-        Races.race_number == item['race_number'],
-        Races.card_date == item['card_date']
-    ).first()
+    return find_first_instance(
+        session,
+        Races,
+        track_id=item['track_id'],
+        race_number=item['race_number'],
+        card_date=item['card_date']
+    )
 
 
 def find_jockey_instance_from_item(item, session):
-    if len(item['first_name']) == 1:
-        return session.query(Jockeys).filter(
-            Jockeys.first_name.startswith(item['first_name']),
-            Jockeys.last_name == item['last_name']
-        ).first()
+    if is_initial_only_item(item, 'jockey'):
+        return find_person_instance_from_initial_item(item, 'jockey', session)
     else:
-        return session.query(Jockeys).filter(
-            Jockeys.first_name == item['first_name'],
-            Jockeys.last_name == item['last_name']
-        ).first()
+        return find_first_instance(
+            session,
+            Jockeys,
+            first_name=item['first_name'],
+            last_name=item['last_name']
+        )
 
 
 def find_trainer_instance_from_item(item, session):
-    if len(item['first_name']) == 1:
-        return session.query(Trainers).filter(
-            Trainers.first_name.startswith(item['first_name']),
-            Trainers.last_name == item['last_name']
-        ).first()
+    if is_initial_only_item(item, 'trainer'):
+        return find_person_instance_from_initial_item(item, 'trainer', session)
     else:
-        return session.query(Trainers).filter(
-            Trainers.first_name == item['first_name'],
-            Trainers.last_name == item['last_name']
-        ).first()
+        return find_first_instance(
+            session,
+            Trainers,
+            first_name=item['first_name'],
+            last_name=item['last_name']
+        )
+
+
+def is_initial_only_item(item, item_type):
+
+    # Equibase entries and charts only give the first initial of jockeys and trainers
+    first_name = item.get('first_name', None)
+    if isinstance(first_name, Null):
+        first_name = None
+    if item_type not in ('jockey', 'trainer') or len(first_name or '') != 1:
+        return False
+
+    # Without a last name key there is nothing to match the initial against so the name has to match exactly
+    last_name = item.get('last_name', None)
+    return get_name_key(None if isinstance(last_name, Null) else last_name) is not None
+
+
+def get_initial_key_from_item(item):
+
+    # (last name key, first initial) the same way they are stored
+    return get_name_key(item['last_name']), get_first_initial(item['first_name'])
+
+
+def find_initial_candidates_from_items(items, item_type, session, batch_size=500):
+    """
+    Returns a dict of (last name key, first initial) -> every person it could refer to, built from indexed lookups
+    on last_name_key and first_initial
+    """
+
+    # Init return dict
+    candidates = dict()
+
+    # Get model info
+    model = get_model_from_item_type(item_type)
+    primary_key = inspect(model).primary_key[0]
+
+    # Query in batches
+    initial_keys = list(dict.fromkeys(get_initial_key_from_item(item) for item in items))
+    for batch_start in range(0, len(initial_keys), batch_size):
+        batch_keys = initial_keys[batch_start:batch_start + batch_size]
+        batch_key_set = set(batch_keys)
+        query = session.query(model).filter(
+            model.last_name_key.in_(set(initial_key[0] for initial_key in batch_keys)),
+            model.first_initial.in_(set(initial_key[1] for initial_key in batch_keys))
+        ).order_by(primary_key)
+        for instance in query:
+            initial_key = (instance.last_name_key, instance.first_initial)
+            if initial_key in batch_key_set:
+                candidates.setdefault(initial_key, []).append(instance)
+
+    # Return candidates
+    return candidates
+
+
+# (item type, first initial, last name) -> number of times an initial matched more than one person
+ambiguous_initial_statistics = dict()
+
+# Guards the process wide counters (the async loaders update them from several database threads)
+statistics_lock = threading.Lock()
+
+
+def get_ambiguous_initial_statistics():
+
+    # Return a copy of the counters
+    with statistics_lock:
+        return dict(ambiguous_initial_statistics)
+
+
+def select_initial_candidate(item, item_type, candidates):
+    """
+    Picks the person an initial refers to. People stored with a full first name win over ones only ever seen as an
+    initial, more than one match is reported and nothing is returned (and False comes back as the second value)
+    """
+
+    # Prefer people with a full first name
+    full_name_candidates = [candidate for candidate in candidates if len(candidate.first_name or '') > 1]
+    if len(full_name_candidates) > 0:
+        candidates = full_name_candidates
+
+    # Unique match (or none)
+    if len(candidates) == 0:
+        return None, True
+    if len(candidates) == 1:
+        return candidates[0], True
+
+    # Report ambiguous initials
+    statistic_key = (item_type, item['first_name'], item['last_name'])
+    with statistics_lock:
+        first_report = statistic_key not in ambiguous_initial_statistics
+        ambiguous_initial_statistics[statistic_key] = ambiguous_initial_statistics.get(statistic_key, 0) + 1
+    if first_report:
+        candidate_names = ', '.join(f'{candidate.first_name} {candidate.last_name}' for candidate in candidates)
+        print(f'{item_type} {item["first_name"]} {item["last_name"]} is ambiguous between {candidate_names}')
+    return None, False
+
+
+def find_person_instance_from_initial_item(item, item_type, session):
+
+    # Look up candidates
+    candidates = find_initial_candidates_from_items([item], item_type, session)
+
+    # Return the unique match
+    instance, unique = select_initial_candidate(item, item_type, candidates.get(get_initial_key_from_item(item), []))
+    return instance
 
 
 def find_horse_instance_from_item(item, session):
     if item.get('horse_id', None) is not None:
-        return session.query(Horses).filter(
-            Horses.horse_id == item['horse_id']
-        ).first()
+        return find_first_instance(
+            session,
+            Horses,
+            horse_id=item['horse_id']
+        )
     elif item.get('horse_name', None) is not None:
-        return session.query(Horses).filter(
-            Horses.horse_name == item['horse_name']
-        ).first()
+        horse_name_key = get_horse_name_key(item['horse_name'])
+        if horse_name_key is None:
+            # Names without a key only match themselves
+            return find_first_instance(
+                session,
+                Horses,
+                horse_name=item['horse_name']
+            )
+        return find_first_instance(
+            session,
+            Horses,
+            horse_name_key=horse_name_key
+        )
     else:
         return None
 
 
 def find_horse_instance_from_item_and_race(item, race, session):
-    return session.query(Horses).join(Entries).join(Races).filter(
-        Horses.horse_name == item['horse_name'],
-        Races.race_id == race.race_id,
+
+    # Names without a key only match themselves
+    horse_name_key = get_horse_name_key(item['horse_name'])
+    if horse_name_key is None:
+        return session.query(Horses).join(Entries).join(Races).filter(
+            Horses.horse_name == item['horse_name'],
+            Races.race_id == race.race_id,
+        ).first()
+
+    # Baked lookup on the key
+    baked_query = finder_bakery(lambda session: session.query(Horses).join(Entries).join(Races))
+    baked_query += lambda query: query.filter(
+        Horses.horse_name_key == bindparam('horse_name_key'),
+        Races.race_id == bindparam('race_id')
+    )
+    return baked_query(session).params(
+        horse_name_key=horse_name_key,
+        race_id=race.race_id
     ).first()
 
 
 def find_entry_instance_from_item(item, session):
-    return session.query(Entries).filter(
-        Entries.race_id == item['race_id'],
-        Entries.horse_id == item['horse_id']
-    ).first()
+    return find_first_instance(
+        session,
+        Entries,
+        race_id=item['race_id'],
+        horse_id=item['horse_id']
+    )
 
 
 def find_owner_instance_from_item(item, session):
-    return session.query(Owners).filter(
-        Owners.first_name == item['first_name'],
-        Owners.last_name == item['last_name']
-    ).first()
+    return find_first_instance(
+        session,
+        Owners,
+        first_name=item['first_name'],
+        last_name=item['last_name']
+    )
 
 
 def find_entry_pool_instance_from_item(item, session):
-    return session.query(EntryPools).filter(
-        EntryPools.entry_id == item['entry_id'],
-        EntryPools.scrape_time == item['scrape_time'],
-        EntryPools.pool_type == item['pool_type']
-    ).first()
+    return find_first_instance(
+        session,
+        EntryPools,
+        entry_id=item['entry_id'],
+        scrape_time=item['scrape_time'],
+        pool_type=item['pool_type']
+    )
 
 
 def find_payoff_instance_from_item(item, session):
-    return session.query(Payoffs).filter(
-        Payoffs.race_id == item['race_id'],
-        Payoffs.wager_type == item['wager_type']
-    ).first()
+    return find_first_instance(
+        session,
+        Payoffs,
+        race_id=item['race_id'],
+        wager_type=item['wager_type']
+    )
 
 
 def find_probable_instance_from_item(item, session):
-    return session.query(Probables).filter(
-        Probables.race_id == item['race_id'],
-        Probables.probable_type == item['probable_type'],
-        Probables.program_numbers == item['program_numbers'],
-        Probables.scrape_time == item['scrape_time']
-    ).first()
+    return find_first_instance(
+        session,
+        Probables,
+        race_id=item['race_id'],
+        probable_type=item['probable_type'],
+        program_numbers=item['program_numbers'],
+        scrape_time=item['scrape_time']
+    )
+
+
+def find_probable_matrix_instance_from_item(item, session):
+    return find_first_instance(
+        session,
+        ProbableMatrices,
+        race_id=item['race_id'],
+        scrape_time=item['scrape_time'],
+        probable_type=item['probable_type']
+    )
 
 
 def find_pick_instance_from_item(item, session):
-    return session.query(Picks).filter(
-        Picks.bettor_family == item['bettor_family'],
-        Picks.bettor_name == item['bettor_name'],
-        Picks.race_id == item['race_id'],
-        Picks.bet_type == item['bet_type'],
-        Picks.bet_win_text == item['bet_win_text']
-    ).first()
+    return find_first_instance(
+        session,
+        Picks,
+        bettor_family=item['bettor_family'],
+        bettor_name=item['bettor_name'],
+        race_id=item['race_id'],
+        bet_type=item['bet_type'],
+        bet_win_text=item['bet_win_text']
+    )
 
 
 def find_workout_instance_from_item(item, session):
-    return session.query(Workouts).filter(
-        Workouts.horse_id == item['horse_id'],
-        Workouts.workout_date == item['workout_date'],
-        Workouts.track_id == item['track_id'],
-    ).first()
+    return find_first_instance(
+        session,
+        Workouts,
+        horse_id=item['horse_id'],
+        workout_date=item['workout_date'],
+        track_id=item['track_id']
+    )
 
 
 def find_analysis_probability_instance_from_item(item, session):
-    return session.query(AnalysisProbabilities).filter(
-        AnalysisProbabilities.entry_id == item['entry_id'],
-        AnalysisProbabilities.analysis_type == item['analysis_type'],
-        AnalysisProbabilities.finish_place == item['finish_place'],
-    ).first()
+    return find_first_instance(
+        session,
+        AnalysisProbabilities,
+        entry_id=item['entry_id'],
+        analysis_type=item['analysis_type'],
+        finish_place=item['finish_place']
+    )
 
 
 def find_betting_result_instance_from_item(item, session):
-    return session.query(BettingResults).filter(
-        BettingResults.time_frame_text == item['time_frame_text'],
-        BettingResults.track_id == item['track_id'],
-        BettingResults.bet_type_text == item['bet_type_text'],
-        BettingResults.strategy == item['strategy']
-    ).first()
+    return find_first_instance(
+        session,
+        BettingResults,
+        time_frame_text=item['time_frame_text'],
+        track_id=item['track_id'],
+        bet_type_text=item['bet_type_text'],
+        strategy=item['strategy']
+    )
 
 
 def find_fractional_time_instance_from_item(item, session):
-    return session.query(FractionalTimes).filter(
-        FractionalTimes.race_id == item['race_id'],
-        FractionalTimes.point == item['point'],
-    ).first()
+    return find_first_instance(
+        session,
+        FractionalTimes,
+        race_id=item['race_id'],
+        point=item['point']
+    )
 
 
 def find_point_of_call_instance_from_item(item, session):
-    return session.query(PointsOfCall).filter(
-        PointsOfCall.entry_id == item['entry_id'],
-        PointsOfCall.point == item['point'],
-    ).first()
+    return find_first_instance(
+        session,
+        PointsOfCall,
+        entry_id=item['entry_id'],
+        point=item['point']
+    )
 
 
 def find_database_statistic_instance_from_item(item, session):
-    return session.query(DatabaseStatistics).filter(
-        DatabaseStatistics.statistic_name == item['statistic_name'],
-        DatabaseStatistics.statistic_date == item['statistic_date'],
-    ).first()
+    return find_first_instance(
+        session,
+        DatabaseStatistics,
+        statistic_name=item['statistic_name'],
+        statistic_date=item['statistic_date']
+    )
+
+
+def get_entity_cache_type(item_type, session):
+
+    # Cache entries are kept apart per database (ids in staging mean nothing in main)
+    return session.info.get('database', 'main'), item_type
+
+
+def get_entity_cache_key_from_item(item, item_type):
+
+    # Only entities that repeat across races and polls are cached
+    if item_type == 'horse':
+        if item.get('horse_id', None) is not None:
+            cache_key = ('horse_id', item['horse_id'])
+        else:
+            horse_name = item.get('horse_name', None)
+            cache_key = ('horse_name_key', None if isinstance(horse_name, Null) else get_horse_name_key(horse_name))
+    elif item_type in ('jockey', 'trainer', 'owner'):
+        # Initials are resolved against every candidate each time so new people show up as ambiguous
+        if is_initial_only_item(item, item_type):
+            return
+        cache_key = (item.get('first_name', None), item.get('last_name', None))
+    else:
+        return
+
+    # Nulls go to the database
+    for value in cache_key:
+        if value is None or isinstance(value, Null):
+            return
+
+    # Return key
+    return cache_key
 
 
 def find_instance_from_item(item, item_type, session):
@@ -226,6 +839,7 @@ def find_instance_from_item(item, item_type, session):
         'entry_pool': find_entry_pool_instance_from_item,
         'payoff': find_payoff_instance_from_item,
         'probable': find_probable_instance_from_item,
+        'probable_matrix': find_probable_matrix_instance_from_item,
         'pick': find_pick_instance_from_item,
         'workout': find_workout_instance_from_item,
         'betting_result': find_betting_result_instance_from_item,
@@ -235,11 +849,24 @@ def find_instance_from_item(item, item_type, session):
         'database_statistic': find_database_statistic_instance_from_item,
     }
 
+    # Check the entity cache first
+    cache_key = get_entity_cache_key_from_item(item, item_type)
+    if cache_key is not None:
+        instance = entity_cache.get(get_entity_cache_type(item_type, session), cache_key, session)
+        if instance is not None:
+            return instance
+
+    # Query the database
+    with finder_profiler.profile(item_type, session):
+        instance = instance_finder[item_type](item, session)
+    if instance is not None and cache_key is not None:
+        entity_cache.put(get_entity_cache_type(item_type, session), cache_key, instance)
+
     # Return instance
-    return instance_finder[item_type](item, session)
+    return instance
 
 
-def create_new_instance_from_item(item, item_type, session):
+def get_model_from_item_type(item_type):
 
     # Model Dict
     model_dict = {
@@ -253,6 +880,7 @@ def create_new_instance_from_item(item, item_type, session):
         'entry_pool': EntryPools,
         'payoff': Payoffs,
         'probable': Probables,
+        'probable_matrix': ProbableMatrices,
         'pick': Picks,
         'workout': Workouts,
         'analysis_probability': AnalysisProbabilities,
@@ -262,22 +890,265 @@ def create_new_instance_from_item(item, item_type, session):
         'database_statistic': DatabaseStatistics
     }
 
+    # Return model
+    return model_dict[item_type]
+
+
+def get_natural_key_columns_from_item_type(item_type):
+
+    # Natural Key Dict (mirrors the columns the find_*_instance_from_item functions filter on)
+    natural_key_dict = {
+        'race': ('track_id', 'race_number', 'card_date'),
+        'horse': ('horse_name_key',),
+        'jockey': ('first_name', 'last_name'),
+        'trainer': ('first_name', 'last_name'),
+        'entry': ('race_id', 'horse_id'),
+        'owner': ('first_name', 'last_name'),
+        'entry_pool': ('entry_id', 'scrape_time', 'pool_type'),
+        'payoff': ('race_id', 'wager_type'),
+        'probable': ('race_id', 'probable_type', 'program_numbers', 'scrape_time'),
+        'probable_matrix': ('race_id', 'scrape_time', 'probable_type'),
+        'pick': ('bettor_family', 'bettor_name', 'race_id', 'bet_type', 'bet_win_text'),
+        'workout': ('horse_id', 'workout_date', 'track_id'),
+        'analysis_probability': ('entry_id', 'analysis_type', 'finish_place'),
+        'betting_result': ('time_frame_text', 'track_id', 'bet_type_text', 'strategy'),
+        'fractional_time': ('race_id', 'point'),
+        'point_of_call': ('entry_id', 'point'),
+        'database_statistic': ('statistic_name', 'statistic_date'),
+    }
+
+    # Return natural key (tracks have no single natural key)
+    return natural_key_dict.get(item_type)
+
+
+def get_natural_key_from_item(item, item_type):
+    """
+    Returns the natural key values of an item as a tuple, or None if the item can only be resolved through
+    its find_*_instance_from_item function (tracks, horses with an id, people with only a first initial)
+    """
+
+    # Get key columns
+    key_columns = get_natural_key_columns_from_item_type(item_type)
+    if key_columns is None:
+        return
+
+    # Exceptions
+    if item_type == 'horse' and item.get('horse_id', None) is not None:
+        return
+    if item_type in ('jockey', 'trainer') and len(item.get('first_name', None) or '') == 1:
+        return
+
+    # Assemble key (nulls are matched with IS NULL by the finders so leave those to them)
+    item = dict(item, **get_derived_keys_from_item(item, item_type))
+    mapper_columns = get_model_from_item_type(item_type).__mapper__.columns
+    natural_key = tuple(
+        get_natural_key_value(item.get(key_column, None), mapper_columns[key_column]) for key_column in key_columns
+    )
+    for value in natural_key:
+        if value is None or isinstance(value, Null):
+            return
+
+    # Return key
+    return natural_key
+
+
+def get_natural_key_value(value, column):
+
+    # Only text needs converting (parsers sometimes hand back dates and numbers as strings)
+    if not isinstance(value, str):
+        return value
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+
+    # Convert to what the column reads back as so the key matches the stored row
+    try:
+        if python_type is datetime.datetime:
+            return datetime.datetime.fromisoformat(value)
+        elif python_type is datetime.date:
+            return datetime.date.fromisoformat(value)
+        elif python_type in (int, float, decimal.Decimal):
+            return python_type(value)
+    except (ValueError, decimal.InvalidOperation):
+        pass
+
+    # Return value as is
+    return value
+
+
+def find_instances_from_natural_keys(natural_keys, item_type, session, batch_size=500):
+
+    with finder_profiler.profile(f'{item_type} (batch)', session):
+        # Init return dict
+        instances = dict()
+
+        # Get model info
+        model = get_model_from_item_type(item_type)
+        key_columns = get_natural_key_columns_from_item_type(item_type)
+
+        # Query in batches (each column is filtered with IN and the exact keys are matched here)
+        natural_keys = list(dict.fromkeys(natural_keys))
+        for batch_start in range(0, len(natural_keys), batch_size):
+            batch_keys = natural_keys[batch_start:batch_start + batch_size]
+            batch_key_set = set(batch_keys)
+            query = session.query(model).filter(*[
+                getattr(model, key_column).in_(set(natural_key[index] for natural_key in batch_keys))
+                for index, key_column in enumerate(key_columns)
+            ])
+            for instance in query:
+                natural_key = tuple(getattr(instance, key_column) for key_column in key_columns)
+                if natural_key in batch_key_set and natural_key not in instances:
+                    instances[natural_key] = instance
+
+        # Return instances keyed by natural key
+        return instances
+
+
+def get_derived_keys_from_item(item, item_type):
+
+    # Lookup keys stored next to the values they are computed from (recomputed whenever those are written)
+    derived_keys = dict()
+    if item_type == 'horse':
+        if 'horse_name' in item:
+            horse_name = item['horse_name']
+            derived_keys['horse_name_key'] = get_horse_name_key(None if isinstance(horse_name, Null) else horse_name)
+    elif item_type in ('jockey', 'trainer'):
+        if 'first_name' in item:
+            first_name = item['first_name']
+            derived_keys['first_initial'] = get_first_initial(None if isinstance(first_name, Null) else first_name)
+        if 'last_name' in item:
+            last_name = item['last_name']
+            derived_keys['last_name_key'] = get_name_key(None if isinstance(last_name, Null) else last_name)
+
+    # Return derived keys
+    return derived_keys
+
+
+def create_new_instances_from_items(items, item_type, session, batch_size=500):
+
+    # Get table info
+    model = get_model_from_item_type(item_type)
+    mapper_columns = model.__mapper__.columns
+
+    # Group rows by the columns they fill so a multi row insert never overrides column defaults
+    row_groups = dict()
+    for item in items:
+        item = dict(item, **get_derived_keys_from_item(item, item_type))
+        row = {mapper_columns[key].key: value for key, value in item.items()}
+        row_groups.setdefault(tuple(sorted(row.keys())), []).append(row)
+
+    # One multi row INSERT per group and batch
+    for rows in row_groups.values():
+        for batch_start in range(0, len(rows), batch_size):
+            session.execute(model.__table__.insert().values(rows[batch_start:batch_start + batch_size]))
+
+
+def create_new_instance_from_item(item, item_type, session):
+
+    # Fill in derived keys
+    item.update(get_derived_keys_from_item(item, item_type))
+
     # Fix any nulls
     for key, value in item.items():
         if value is None:
             item[key] = null()
 
     # Create Instance
-    instance = model_dict[item_type](**item)
+    instance = get_model_from_item_type(item_type)(**item)
 
     # Add and commit
     session.add(instance)
-    session.commit()
+    session.flush()
+    if item_type == 'track':
+        track_registry.invalidate(session.info.get('database', 'main'))
+    cache_key = get_entity_cache_key_from_item(item, item_type)
+    if cache_key is not None:
+        entity_cache.put(get_entity_cache_type(item_type, session), cache_key, instance)
+    commit_session(session)
 
     # Return Instance
     return instance
 
 
+# Per item type counters of updates that changed something vs ones that were skipped as no-ops
+update_statistics = dict()
+
+
+def count_update(item_type, applied):
+
+    # Increment counter
+    with statistics_lock:
+        counters = update_statistics.setdefault(item_type, {'applied': 0, 'skipped': 0})
+        if applied:
+            counters['applied'] += 1
+        else:
+            counters['skipped'] += 1
+
+
+def get_update_statistics():
+
+    # Return a copy of the counters
+    with statistics_lock:
+        return {item_type: dict(counters) for item_type, counters in update_statistics.items()}
+
+
+def update_instance_from_item(instance, item, item_type):
+
+    # Track changes
+    changed = False
+
+    # Set the new attributes (and the keys derived from them)
+    for key, value in dict(item, **get_derived_keys_from_item(item, item_type)).items():
+
+        # Exceptions
+        if item_type == 'race':
+            # Never move the off_time later
+            if key == 'off_time':
+                if instance.off_time is not None:
+                    if value > instance.off_time:
+                        continue
+        if item_type == 'horse':
+            # Keep the first spelling seen instead of flipping between sources
+            if key == 'horse_name' and instance.horse_name is not None and not isinstance(value, Null):
+                if instance.horse_name_key is not None and instance.horse_name_key == get_horse_name_key(value):
+                    continue
+
+        # Nothing to do if the value is the same (null() and None are both null)
+        if isinstance(value, Null):
+            value = None
+        if getattr(instance, key) == value:
+            continue
+        if value is None:
+            value = null()
+
+        # Set the attributes
+        setattr(instance, key, value)
+        changed = True
+
+    # Return whether anything changed
+    return changed
+
+
+def resolve_initial_only_item(item, item_type, candidates):
+    """
+    Matches an initial only item against the candidate map. Returns the instance (None for a new person) and the item
+    to write with the full first name of the match filled in, or None for the item if the initial is ambiguous
+    """
+
+    # Pick the candidate
+    instance, unique = select_initial_candidate(item, item_type, candidates.get(get_initial_key_from_item(item), []))
+    if not unique:
+        return None, None
+
+    # Never overwrite a full first name with the initial
+    if instance is not None:
+        item = dict(item, first_name=instance.first_name)
+
+    # Return instance and item
+    return instance, item
+
+
 def load_item_into_database(item, item_type, session):
 
     # Check if item exists
@@ -285,7 +1156,13 @@ def load_item_into_database(item, item_type, session):
         return
 
     # Get Existing Record
-    instance = find_instance_from_item(item, item_type, session)
+    if is_initial_only_item(item, item_type):
+        candidates = find_initial_candidates_from_items([item], item_type, session)
+        instance, item = resolve_initial_only_item(item, item_type, candidates)
+        if item is None:
+            return
+    else:
+        instance = find_instance_from_item(item, item_type, session)
 
     # If its new, create a new one in the database
     if instance is None:
@@ -296,23 +1173,611 @@ def load_item_into_database(item, item_type, session):
     else:
 
         # Set the new attributes
-        for key, value in item.items():
-
-            # Exceptions
-            if item_type == 'race':
-                # Never move the off_time later
-                if key == 'off_time':
-                    if instance.off_time is not None:
-                        if value > instance.off_time:
-                            continue
-            if value is None:
-                value = null()
-
-            # Set the attributes
-            setattr(instance, key, value)
-
-        # Commit changes
-        session.commit()
+        changed = update_instance_from_item(instance, item, item_type)
+        count_update(item_type, changed)
+
+        # Only write if something actually changed
+        if changed:
+            entity_cache.invalidate(get_entity_cache_type(item_type, session), instance)
+            if item_type == 'track':
+                track_registry.invalidate(session.info.get('database', 'main'))
+            commit_session(session)
 
     # Return race instance
     return instance
+
+
+def load_items_into_database(items, item_type, session):
+
+    # Init return list (same order as the items passed in)
+    instances = [None] * len(items)
+    items = list(items)
+    key_columns = get_natural_key_columns_from_item_type(item_type)
+
+    # Group items by natural key
+    keyed_indexes = dict()
+    initial_indexes = []
+    for index, item in enumerate(items):
+
+        # Check if item exists
+        if item is None:
+            continue
+
+        # Items without a natural key go through the single item path
+        natural_key = get_natural_key_from_item(item, item_type)
+        if is_initial_only_item(item, item_type):
+            initial_indexes.append(index)
+        elif natural_key is None:
+            instances[index] = load_item_into_database(item, item_type, session)
+        else:
+            # Write the key as it was matched (text dates and numbers converted to the column types)
+            items[index] = dict(item, **dict(zip(key_columns, natural_key)))
+            keyed_indexes.setdefault(natural_key, []).append(index)
+
+    # Initial only people are matched against one candidate map for the whole batch
+    if len(initial_indexes) > 0:
+        load_initial_only_items_into_database(items, initial_indexes, instances, item_type, session)
+
+    # Nothing else to do
+    if len(keyed_indexes) == 0:
+        return instances
+
+    # Check the entity cache first
+    existing_instances = dict()
+    for natural_key, indexes in keyed_indexes.items():
+        cache_key = get_entity_cache_key_from_item(items[indexes[0]], item_type)
+        if cache_key is not None:
+            instance = entity_cache.get(get_entity_cache_type(item_type, session), cache_key, session)
+            if instance is not None:
+                existing_instances[natural_key] = instance
+
+    # Get the rest of the existing records in one pass
+    existing_instances.update(find_instances_from_natural_keys(
+        [natural_key for natural_key in keyed_indexes if natural_key not in existing_instances],
+        item_type,
+        session
+    ))
+
+    # Insert the new ones in one pass (first item per key, the rest are applied as updates below)
+    new_keys = [natural_key for natural_key in keyed_indexes if natural_key not in existing_instances]
+    taken_keys = set()
+    if len(new_keys) > 0:
+        taken_keys = create_new_instances_in_savepoints(
+            {natural_key: items[keyed_indexes[natural_key][0]] for natural_key in new_keys},
+            item_type,
+            session
+        )
+        new_instances = find_instances_from_natural_keys(new_keys, item_type, session)
+    else:
+        new_instances = dict()
+
+    # Apply updates and assemble return list
+    written = len(new_keys) > 0
+    for natural_key, indexes in keyed_indexes.items():
+        if natural_key in existing_instances or natural_key in taken_keys:
+            instance = existing_instances.get(natural_key, None) or new_instances.get(natural_key, None)
+            update_indexes = indexes
+        else:
+            instance = new_instances.get(natural_key, None)
+            update_indexes = indexes[1:]
+        if instance is None:
+            continue
+        changed = False
+        for index in update_indexes:
+            item_changed = update_instance_from_item(instance, items[index], item_type)
+            count_update(item_type, item_changed)
+            changed = changed or item_changed
+
+        # Keep the entity cache in line
+        cache_key = get_entity_cache_key_from_item(items[indexes[0]], item_type)
+        if changed:
+            entity_cache.invalidate(get_entity_cache_type(item_type, session), instance)
+            written = True
+        elif cache_key is not None:
+            entity_cache.put(get_entity_cache_type(item_type, session), cache_key, instance)
+
+        # Every item with this key gets the same instance
+        for index in indexes:
+            instances[index] = instance
+
+    # Commit changes (only if something was written)
+    if written:
+        commit_session(session)
+
+    # Return instances
+    return instances
+
+
+def create_new_instances_in_savepoints(keyed_items, item_type, session):
+    """
+    Inserts one item per natural key in a savepoint. If another process inserted some of the keys since they were
+    looked up, the items are retried one at a time and the keys that were already taken are returned so the caller
+    can update those rows instead
+    """
+
+    # Init return set
+    taken_keys = set()
+
+    # All at once
+    try:
+        with session.begin_nested():
+            create_new_instances_from_items(list(keyed_items.values()), item_type, session)
+        return taken_keys
+    except IntegrityError:
+        pass
+
+    # One at a time
+    for natural_key, item in keyed_items.items():
+        try:
+            with session.begin_nested():
+                create_new_instances_from_items([item], item_type, session)
+        except IntegrityError:
+            taken_keys.add(natural_key)
+
+    # Return the keys that were taken
+    return taken_keys
+
+
+def load_initial_only_items_into_database(items, indexes, instances, item_type, session):
+
+    # Build the candidate map once
+    candidates = find_initial_candidates_from_items([items[index] for index in indexes], item_type, session)
+
+    # Resolve each item
+    written = False
+    for index in indexes:
+        instance, item = resolve_initial_only_item(items[index], item_type, candidates)
+        if item is None:
+            continue
+
+        # New person (added to the map so repeats in the batch find it)
+        if instance is None:
+            instance = create_new_instance_from_item(dict(item), item_type, session)
+            candidates.setdefault(get_initial_key_from_item(item), []).append(instance)
+
+        # Existing person
+        else:
+            changed = update_instance_from_item(instance, item, item_type)
+            count_update(item_type, changed)
+            if changed:
+                entity_cache.invalidate(get_entity_cache_type(item_type, session), instance)
+                written = True
+
+        # Set return
+        instances[index] = instance
+
+    # Commit changes (only if something was written)
+    if written:
+        commit_session(session)
+
+
+def get_upsert_index(item_type):
+
+    # Core upserts need a unique index on the natural key, and types with update rules stay on the ORM path
+    if item_type in ('race', 'horse', 'jockey', 'trainer'):
+        return
+    key_columns = get_natural_key_columns_from_item_type(item_type)
+    if key_columns is None:
+        return
+    model = get_model_from_item_type(item_type)
+    mapper_columns = model.__mapper__.columns
+    index_columns = tuple(mapper_columns[key_column].name for key_column in key_columns)
+    for index in model.__table__.indexes:
+        if index.unique and set(column.name for column in index.columns) == set(index_columns):
+            # Index name and its columns in natural key order
+            return index.name, index_columns
+
+
+def has_unique_index(session, index_name):
+    """
+    Whether a unique index from models.py exists and is valid in the sessions (postgres) database. ON CONFLICT needs
+    it and databases that haven't been through --mode upgrade_database may not have it. Checked once per process
+    """
+
+    # Look it up once
+    cache_key = (session.info.get('database', 'main'), index_name)
+    with engine_lock:
+        if cache_key not in checked_unique_indexes:
+            index_valid = session.execute(
+                text(
+                    'SELECT bool_or(pg_index.indisvalid) FROM pg_index '
+                    'JOIN pg_class ON pg_class.oid = pg_index.indexrelid WHERE pg_class.relname = :index_name'
+                ),
+                {'index_name': index_name}
+            ).scalar()
+            checked_unique_indexes[cache_key] = index_valid is True
+            if not checked_unique_indexes[cache_key]:
+                print(f'{index_name} is missing, writes fall back to the ORM until --mode upgrade_database creates it')
+
+    # Return whether it exists
+    return checked_unique_indexes[cache_key]
+
+
+def find_primary_keys_from_natural_keys(natural_keys, item_type, session, batch_size=500):
+
+    # Init return dict
+    primary_keys = dict()
+
+    # Get table info
+    model = get_model_from_item_type(item_type)
+    mapper_columns = model.__mapper__.columns
+    key_columns = [mapper_columns[key_column] for key_column in get_natural_key_columns_from_item_type(item_type)]
+    primary_key = model.__table__.primary_key.columns.values()[0]
+
+    # Query in batches (each column is filtered with IN and the exact keys are matched here)
+    natural_keys = list(dict.fromkeys(natural_keys))
+    for batch_start in range(0, len(natural_keys), batch_size):
+        batch_keys = natural_keys[batch_start:batch_start + batch_size]
+        batch_key_set = set(batch_keys)
+        query = select([primary_key] + key_columns).where(and_(*[
+            key_column.in_(set(natural_key[index] for natural_key in batch_keys))
+            for index, key_column in enumerate(key_columns)
+        ]))
+        for row in session.execute(query):
+            natural_key = tuple(row[1:])
+            if natural_key in batch_key_set and natural_key not in primary_keys:
+                primary_keys[natural_key] = row[0]
+
+    # Return primary keys keyed by natural key
+    return primary_keys
+
+
+def upsert_items_into_database(items, item_type, session, batch_size=500):
+    """
+    Writes items straight from their dicts and returns their primary keys (in the order of the items) without
+    building ORM instances. On postgres each batch is one INSERT ... ON CONFLICT DO UPDATE that only touches rows that
+    actually differ, everything else goes through load_items_into_database
+    """
+
+    with finder_profiler.profile(f'{item_type} (upsert)', session):
+        # Init return list
+        primary_keys = [None] * len(items)
+
+        # Use the ORM path where the Core one doesn't apply
+        upsert_index = get_upsert_index(item_type)
+        if session.get_bind().dialect.name != 'postgresql' or upsert_index is None \
+                or not has_unique_index(session, upsert_index[0]):
+            for index, instance in enumerate(load_items_into_database(items, item_type, session)):
+                if instance is not None:
+                    primary_keys[index] = inspect(instance).identity[0]
+            return primary_keys
+        index_columns = upsert_index[1]
+
+        # Get table info
+        model = get_model_from_item_type(item_type)
+        table = model.__table__
+        mapper_columns = model.__mapper__.columns
+        primary_key = table.primary_key.columns.values()[0]
+
+        # Merge items by natural key (one statement can't touch a row twice, later values win like sequential updates)
+        keyed_indexes = dict()
+        keyed_rows = dict()
+        for index, item in enumerate(items):
+            if item is None:
+                continue
+            natural_key = get_natural_key_from_item(item, item_type)
+            if natural_key is None:
+                instance = load_item_into_database(item, item_type, session)
+                if instance is not None:
+                    primary_keys[index] = inspect(instance).identity[0]
+                continue
+            keyed_indexes.setdefault(natural_key, []).append(index)
+            keyed_rows.setdefault(natural_key, dict()).update(
+                {mapper_columns[key].key: value for key, value in item.items()}
+            )
+
+        # Make sure everything the rows point at has been written
+        session.flush()
+
+        # Group rows by the columns they fill so a multi row insert never overrides column defaults
+        row_groups = dict()
+        for natural_key, row in keyed_rows.items():
+            row_groups.setdefault(tuple(sorted(row.keys())), []).append(row)
+
+        # One upsert per group and batch
+        written_keys = dict()
+        for row_columns, rows in row_groups.items():
+            update_columns = [column for column in row_columns if column not in index_columns]
+            for batch_start in range(0, len(rows), batch_size):
+                statement = postgresql_insert(table).values(rows[batch_start:batch_start + batch_size])
+                if len(update_columns) > 0:
+                    statement = statement.on_conflict_do_update(
+                        index_elements=list(index_columns),
+                        set_={column: statement.excluded[column] for column in update_columns},
+                        where=or_(*[
+                            table.c[column].is_distinct_from(statement.excluded[column]) for column in update_columns
+                        ])
+                    )
+                else:
+                    statement = statement.on_conflict_do_nothing(index_elements=list(index_columns))
+                statement = statement.returning(primary_key, *[table.c[column] for column in index_columns])
+                for row in session.execute(statement):
+                    written_keys[tuple(row[1:])] = row[0]
+
+        # Rows that were already up to date aren't returned so look those up
+        missing_keys = [natural_key for natural_key in keyed_indexes if natural_key not in written_keys]
+        found_keys = find_primary_keys_from_natural_keys(missing_keys, item_type, session) if missing_keys else dict()
+
+        # Assemble return list
+        for natural_key, indexes in keyed_indexes.items():
+            primary_key_value = written_keys.get(natural_key, found_keys.get(natural_key, None))
+            for index in indexes:
+                primary_keys[index] = primary_key_value
+
+        # Instances already in the session and cached values may be stale now
+        cache_item_type = get_entity_cache_item_type(model)
+        cache_type = get_entity_cache_type(cache_item_type, session) if cache_item_type is not None else None
+        for natural_key, primary_key_value in written_keys.items():
+            instance = session.identity_map.get(identity_key(model, (primary_key_value,)))
+            if instance is not None:
+                session.expire(instance)
+            if cache_type is not None:
+                entity_cache.invalidate_primary_key(cache_type, (primary_key_value,))
+
+        # Commit changes (only if something was written)
+        if len(written_keys) > 0:
+            commit_session(session)
+
+        # Return primary keys
+        return primary_keys
+
+
+def upsert_race_from_item(item, session):
+    """
+    Writes a race in one round trip and returns its instance. On postgres this is a single INSERT ... ON CONFLICT DO
+    UPDATE that applies the same rules as update_instance_from_item (off_time only ever moves earlier, rows that
+    wouldn't change aren't touched) with the existing row selected in the same statement when nothing was written.
+    Other databases go through load_item_into_database
+    """
+
+    with finder_profiler.profile('race (upsert)', session):
+        # Check if item exists
+        if item is None:
+            return
+
+        # Use the ORM path where the Core one doesn't apply
+        natural_key = get_natural_key_from_item(item, 'race')
+        if session.get_bind().dialect.name != 'postgresql' or natural_key is None or \
+                not has_unique_index(session, 'ix_races_natural_key'):
+            return load_item_into_database(item, 'race', session)
+
+        # Get table info (with the key written and matched as its normalized values)
+        table = Races.__table__
+        mapper_columns = Races.__mapper__.columns
+        index_columns = [mapper_columns[key].name for key in get_natural_key_columns_from_item_type('race')]
+        row = {mapper_columns[key].name: None if isinstance(value, Null) else value for key, value in item.items()}
+        row.update(zip(index_columns, natural_key))
+        update_columns = [column for column in row if column not in index_columns]
+
+        # Insert or update the race (never moving off_time later and skipping rows that are already up to date)
+        insert_statement = postgresql_insert(table).values(row)
+        set_values = {column: insert_statement.excluded[column] for column in update_columns}
+        if 'off_time' in set_values:
+            set_values['off_time'] = func.least(table.c.off_time, insert_statement.excluded.off_time)
+        if len(update_columns) > 0:
+            insert_statement = insert_statement.on_conflict_do_update(
+                index_elements=index_columns,
+                set_=set_values,
+                where=or_(*[table.c[column].is_distinct_from(set_values[column]) for column in update_columns])
+            )
+        else:
+            insert_statement = insert_statement.on_conflict_do_nothing(index_elements=index_columns)
+        upserted = insert_statement.returning(*table.columns).cte('upserted_race')
+
+        # Fall back to the existing row when the upsert didn't return one
+        statement = union_all(
+            select([true().label('written')] + list(upserted.columns)),
+            select([false().label('written')] + list(table.columns)).where(and_(
+                *[table.c[column] == row[column] for column in index_columns],
+                ~exists(select([upserted.c.race_id]))
+            ))
+        )
+        result_row = session.execute(statement).first()
+        if result_row is None:
+            return
+        values = {key: result_row[column.name] for key, column in mapper_columns.items()}
+
+        # Instances already in the session are stale if the row was written
+        if result_row['written']:
+            instance = session.identity_map.get(identity_key(Races, (values['race_id'],)))
+            if instance is not None:
+                session.expire(instance)
+            commit_session(session)
+
+        # Return race instance
+        return get_instance_from_values(Races, values, session)
+
+
+def upsert_latest_entry_pools(entry_pool_items, session, batch_size=500):
+    """
+    Keeps latest_entry_pools at the newest snapshot of each entry and pool type. A row is only replaced by a newer
+    scrape so late or replayed polls never move the current odds back. On postgres each batch is one INSERT ... ON
+    CONFLICT DO UPDATE, other databases compare against the stored rows. Returns the number of rows written
+    """
+
+    # Newest item per entry and pool type
+    latest_rows = dict()
+    for item in entry_pool_items:
+        if item is None or item.get('entry_id', None) is None or item.get('scrape_time', None) is None:
+            continue
+        primary_key = (item['entry_id'], item['pool_type'])
+        if primary_key not in latest_rows or latest_rows[primary_key]['scrape_time'] < item['scrape_time']:
+            latest_rows[primary_key] = {
+                column.key: None if isinstance(item.get(column.key, None), Null) else item.get(column.key, None)
+                for column in LatestEntryPools.__table__.columns
+            }
+    if len(latest_rows) == 0:
+        return 0
+
+    # Make sure the entries have been written
+    session.flush()
+
+    # Write rows
+    table = LatestEntryPools.__table__
+    rows = list(latest_rows.values())
+    written_count = 0
+    if session.get_bind().dialect.name == 'postgresql':
+        for batch_start in range(0, len(rows), batch_size):
+            statement = postgresql_insert(table).values(rows[batch_start:batch_start + batch_size])
+            statement = statement.on_conflict_do_update(
+                index_elements=[table.c.entry_id, table.c.pool_type],
+                set_={
+                    column.name: statement.excluded[column.name] for column in table.columns
+                    if not column.primary_key
+                },
+                where=or_(table.c.scrape_time.is_(None), table.c.scrape_time < statement.excluded.scrape_time)
+            )
+            written_count += session.execute(statement).rowcount
+    else:
+        stored_scrape_times = dict()
+        for batch_start in range(0, len(rows), batch_size):
+            batch_entry_ids = set(row['entry_id'] for row in rows[batch_start:batch_start + batch_size])
+            for entry_id, pool_type, scrape_time in session.execute(
+                    select([table.c.entry_id, table.c.pool_type, table.c.scrape_time]).where(
+                        table.c.entry_id.in_(batch_entry_ids)
+                    )
+            ):
+                stored_scrape_times[(entry_id, pool_type)] = scrape_time
+        for primary_key, row in latest_rows.items():
+            if primary_key not in stored_scrape_times:
+                session.execute(table.insert().values(row))
+            elif stored_scrape_times[primary_key] is None or stored_scrape_times[primary_key] < row['scrape_time']:
+                session.execute(table.update().where(and_(
+                    table.c.entry_id == row['entry_id'],
+                    table.c.pool_type == row['pool_type']
+                )).values(row))
+            else:
+                continue
+            written_count += 1
+
+    # Instances already in the session may be stale now
+    for primary_key in latest_rows:
+        instance = session.identity_map.get(identity_key(LatestEntryPools, primary_key))
+        if instance is not None:
+            session.expire(instance)
+
+    # Commit changes (only if something was written)
+    if written_count > 0:
+        commit_session(session)
+
+    # Return count
+    return written_count
+
+
+def get_latest_entry_pools_for_race(session, race_id):
+
+    # Current odds of every entry in the race
+    return session.query(LatestEntryPools).join(Entries).filter(
+        Entries.race_id == race_id
+    ).order_by(LatestEntryPools.entry_id, LatestEntryPools.pool_type).all()
+
+
+def get_copy_value(value):
+
+    # Convert python values to postgres csv COPY text
+    if value is None or isinstance(value, Null):
+        return '\\N'
+    elif isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    else:
+        return value
+
+
+def copy_rows_into_table(rows, table_name, columns, session):
+
+    # Write the rows to an in memory csv file
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([get_copy_value(value) for value in row])
+    buffer.seek(0)
+
+    # Stream it through COPY on the sessions connection (so it is part of the current transaction)
+    column_names = ', '.join(column.name for column in columns)
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY {table_name} ({column_names}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+    finally:
+        cursor.close()
+
+
+def copy_new_rows_into_table(rows, table, columns, session):
+
+    # COPY can't skip rows that are already there so stage them in a temp table first (it goes away with the
+    # transaction, so a failed COPY or insert is left to the rollback and its error comes through as it is)
+    staging_table_name = f'{table.name}_append'
+    column_names = ', '.join(column.name for column in columns)
+    session.execute(
+        f'CREATE TEMP TABLE {staging_table_name} ON COMMIT DROP AS '
+        f'SELECT {column_names} FROM {table.name} WITH NO DATA'
+    )
+    copy_rows_into_table(rows, staging_table_name, columns, session)
+    written_count = session.execute(
+        f'INSERT INTO {table.name} ({column_names}) SELECT {column_names} FROM {staging_table_name} '
+        f'ON CONFLICT DO NOTHING'
+    ).rowcount
+
+    # Drop it now so the same transaction can append to the table again
+    session.execute(f'DROP TABLE {staging_table_name}')
+
+    # Return number of rows written
+    return written_count
+
+
+def append_items_to_database(items, item_type, session):
+    """
+    Appends rows that are only ever inserted (odds snapshots) without building ORM objects. On postgres all the rows
+    go through one COPY FROM STDIN, other databases get an executemany INSERT. Rows that are already stored (a replayed
+    scrape) are skipped, returns the number of rows written
+    """
+
+    # Check for items
+    items = [item for item in items if item is not None]
+    if len(items) == 0:
+        return 0
+
+    # Columns filled by any item or by a python side default
+    model = get_model_from_item_type(item_type)
+    item_keys = set()
+    for item in items:
+        item_keys.update(item.keys())
+    columns = [
+        (attribute_key, column) for attribute_key, column in model.__mapper__.columns.items()
+        if attribute_key in item_keys or (column.default is not None and column.default.is_scalar)
+    ]
+
+    # Assemble rows
+    rows = []
+    for item in items:
+        row = []
+        for attribute_key, column in columns:
+            if attribute_key in item:
+                value = item[attribute_key]
+            elif column.default is not None and column.default.is_scalar:
+                value = column.default.arg
+            else:
+                value = None
+            row.append(None if isinstance(value, Null) else value)
+        rows.append(row)
+
+    # Make sure everything the rows point at has been written
+    session.flush()
+
+    # Write rows
+    table = model.__table__
+    if session.get_bind().dialect.name == 'postgresql':
+        written_count = copy_new_rows_into_table(rows, table, [column for attribute_key, column in columns], session)
+    else:
+        written_count = session.execute(table.insert().prefix_with('OR IGNORE', dialect='sqlite'), [
+            {column.key: value for (attribute_key, column), value in zip(columns, row)} for row in rows
+        ]).rowcount
+
+    # Commit changes
+    commit_session(session)
+
+    # Return number of rows written
+    return written_count
@@ -205,6 +205,51 @@ def create_owner_item_from_drf_data(runner):
     return item
 
 
+def get_also_ran_horse_names_from_drf_data(data):
+
+    # Parse finish position out of also ran
+    if data.get('alsoRan', None) is None:
+        order_of_finish = []
+    elif isinstance(data['alsoRan'], list):
+        order_of_finish = data['alsoRan']
+    elif '  and   ' in data['alsoRan']:
+        first_horses, last_horse = data['alsoRan'].split('  and   ')
+        order_of_finish = first_horses.split(', ')
+        order_of_finish.append(last_horse)
+    else:
+        # Only one horse also ran
+        order_of_finish = [data['alsoRan']]
+
+    # Return names in order of finish
+    return [horse_name.strip().upper() for horse_name in order_of_finish]
+
+
+def create_runner_entity_items_from_drf_data(runners, include_owner=False):
+
+    # Init item lists (lined up with the runners, None where the runner doesn't have the entity)
+    entity_items = {
+        'horse': [],
+        'trainer': [],
+        'jockey': [],
+    }
+    if include_owner:
+        entity_items['owner'] = []
+
+    # Create items for every runner
+    for runner in runners:
+        entity_items['horse'].append(create_horse_item_from_drf_data(runner))
+        entity_items['trainer'].append(create_trainer_item_from_drf_data(runner) or None)
+        entity_items['jockey'].append(create_jockey_item_from_drf_data(runner) or None)
+        if include_owner:
+            if 'ownerFirstName' in runner:
+                entity_items['owner'].append(create_owner_item_from_drf_data(runner))
+            else:
+                entity_items['owner'].append(None)
+
+    # Return items by type
+    return entity_items
+
+
 def create_entry_item_from_drf_data(runner, horse, race, trainer, jockey, owner, finish_position):
 
     # Create Entry Dict
@@ -249,7 +294,7 @@ def create_entry_item_from_drf_data(runner, horse, race, trainer, jockey, owner,
     return item
 
 
-def create_entry_pool_item_from_drf_data(data_pool, entry, scrape_time):
+def create_entry_pool_item_from_drf_data(data_pool, entry_id, scrape_time):
 
     # Odds processing
     odds_split = data_pool['fractionalOdds'].split('-')
@@ -260,7 +305,7 @@ def create_entry_pool_item_from_drf_data(data_pool, entry, scrape_time):
 
     # Create Entry Dict
     item = dict()
-    item['entry_id'] = entry.entry_id
+    item['entry_id'] = entry_id
     item['scrape_time'] = scrape_time
     item['pool_type'] = data_pool['poolTypeName'].strip().upper()
     item['amount'] = float(data_pool['amount'])
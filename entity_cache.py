@@ -0,0 +1,146 @@
+import time
+from collections import OrderedDict
+from threading import RLock
+from sqlalchemy import inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+import settings
+
+# Seconds an entry is trusted for (rows changed by other processes are picked up after this, None keeps entries until
+# they are evicted or invalidated)
+ENTITY_CACHE_TTL = getattr(settings, 'ENTITY_CACHE_TTL', 300)
+
+
+def get_instance_values(instance):
+
+    # Snapshot of every mapped column (plain values, safe to share between sessions and threads)
+    return {
+        column_attribute.key: getattr(instance, column_attribute.key)
+        for column_attribute in inspect(instance).mapper.column_attrs
+    }
+
+
+def get_instance_from_values(model, values, session):
+
+    # Use the sessions own copy if it has a usable one
+    primary_key = tuple(values[column.key] for column in inspect(model).primary_key)
+    instance = session.identity_map.get(identity_key(model, primary_key))
+    if instance is not None:
+        if not inspect(instance).expired or session.is_modified(instance):
+            return instance
+
+    # Build a clean detached copy and attach it without going back to the database
+    instance = model(**values)
+    make_transient_to_detached(instance)
+    return session.merge(instance, load=False)
+
+
+class EntityCache:
+    """Bounded LRU cache of natural key -> row values for entities that repeat across races and polls"""
+
+    def __init__(self, max_size=20000, ttl=None):
+
+        # Settings
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        # Storage
+        self._entries = OrderedDict()  # (item_type, natural_key) -> (model, values, stored at)
+        self._keys_by_identity = dict()  # (item_type, primary_key) -> set of (item_type, natural_key)
+        self._lock = RLock()
+
+    def get(self, item_type, natural_key, session):
+
+        # Look up entry
+        with self._lock:
+            entry = self._entries.get((item_type, natural_key), None)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+                self._remove(item_type, natural_key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return
+            self._entries.move_to_end((item_type, natural_key))
+            self.hits += 1
+
+        # Return an instance attached to the callers session
+        model, values, stored_at = entry
+        return get_instance_from_values(model, values, session)
+
+    def put(self, item_type, natural_key, instance):
+
+        # Snapshot the instance
+        model = type(instance)
+        values = get_instance_values(instance)
+        primary_key = inspect(instance).identity
+
+        # Store it
+        with self._lock:
+            self._entries[(item_type, natural_key)] = (model, values, time.monotonic())
+            self._entries.move_to_end((item_type, natural_key))
+            self._keys_by_identity.setdefault((item_type, primary_key), set()).add((item_type, natural_key))
+
+            # Evict least recently used
+            while len(self._entries) > self.max_size:
+                evicted_type, evicted_key = next(iter(self._entries))
+                self._remove(evicted_type, evicted_key)
+
+    def _remove(self, item_type, natural_key):
+
+        # Drop one key and its identity link (call with the lock held)
+        model, values, stored_at = self._entries.pop((item_type, natural_key))
+        primary_key = tuple(values[column.key] for column in inspect(model).primary_key)
+        natural_keys = self._keys_by_identity.get((item_type, primary_key), set())
+        natural_keys.discard((item_type, natural_key))
+        if len(natural_keys) == 0:
+            self._keys_by_identity.pop((item_type, primary_key), None)
+
+    def invalidate(self, item_type, instance):
+
+        # Drop every key that resolves to this row
+        self.invalidate_primary_key(item_type, inspect(instance).identity)
+
+    def invalidate_primary_key(self, item_type, primary_key):
+
+        # Drop every key that resolves to the row with this primary key tuple (for rows written without an instance)
+        with self._lock:
+            for cache_key in self._keys_by_identity.pop((item_type, primary_key), set()):
+                if self._entries.pop(cache_key, None) is not None:
+                    self.invalidations += 1
+
+    def invalidate_type(self, item_type):
+
+        # Drop every entry of one type (after bulk updates that don't say which rows they touched)
+        with self._lock:
+            for cache_key in [cache_key for cache_key in self._entries if cache_key[0] == item_type]:
+                self._remove(*cache_key)
+                self.invalidations += 1
+
+    def clear(self):
+
+        # Forget everything (used when a transaction rolls back)
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_identity.clear()
+
+    def statistics(self):
+
+        # Return counters
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups > 0 else 0,
+            }
+
+
+# Process wide cache
+entity_cache = EntityCache(ttl=ENTITY_CACHE_TTL)
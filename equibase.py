@@ -1,4 +1,5 @@
 from models import Tracks, Horses, Races, Entries
+from track_registry import get_track_from_race
 from bs4 import BeautifulSoup
 import datetime
 import re
@@ -54,7 +55,7 @@ def get_equibase_result_url_from_params(code, card_date, country, race_number):
 def get_equibase_result_url_from_race(session, race):
 
     # Get associated track
-    track = session.query(Tracks).filter(Tracks.track_id == race.track_id).first()
+    track = get_track_from_race(session, race)
 
     # Call function to assemble url
     return get_equibase_result_url_from_params(track.code, race.card_date, track.country, race.race_number)
@@ -72,7 +73,7 @@ def get_equibase_entry_url_from_params(code, card_date, country, race_number):
 def get_equibase_entry_url_from_race(session, race):
 
     # Get associated track
-    track = session.query(Tracks).filter(Tracks.track_id == race.track_id).first()
+    track = get_track_from_race(session, race)
 
     # Call function to assemble url
     return get_equibase_entry_url_from_params(track.code, race.card_date, track.country, race.race_number)
@@ -90,7 +91,7 @@ def get_equibase_whole_card_entry_url_from_params(code, card_date, country):
 def get_equibase_whole_card_entry_url_from_race(session, race):
 
     # Get associated track
-    track = session.query(Tracks).filter(Tracks.track_id == race.track_id).first()
+    track = get_track_from_race(session, race)
 
     # Call function to assemble url
     return get_equibase_whole_card_entry_url_from_params(track.code, race.card_date, track.country)
@@ -7,6 +7,7 @@ import math
 import json
 from pprint import pprint
 from models import Tracks
+from track_registry import get_track_from_race
 import os
 
 def get_equibase_embedded_chart_link_from_params(track_code, card_date, track_country):
@@ -20,7 +21,7 @@ def get_equibase_embedded_chart_link_from_params(track_code, card_date, track_co
 def get_equibase_embedded_chart_link_from_race(session, race):
 
     # Get associated track
-    track = session.query(Tracks).filter(Tracks.track_id == race.track_id).first()
+    track = get_track_from_race(session, race)
 
     # Call function to assemble url
     return get_equibase_embedded_chart_link_from_params(track.code, race.card_date, track.country)
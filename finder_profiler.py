@@ -0,0 +1,219 @@
+import datetime
+import heapq
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import settings
+
+# Profile the finders behind find_instance_from_item (or pass --profile_finders to import_data.py) and where to write
+# the report
+FINDER_PROFILING = getattr(settings, 'FINDER_PROFILING', False)
+FINDER_PROFILE_PATH = getattr(
+    settings,
+    'FINDER_PROFILE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'finder_profile.txt')
+)
+
+
+def get_percentile(sorted_values, percentile):
+
+    # Nearest rank percentile
+    if len(sorted_values) == 0:
+        return 0
+    rank = max(int(round(percentile / 100 * len(sorted_values))), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def get_statement_kind(statement):
+
+    # 'read' for plain queries, 'write' for anything that changes rows (including data modifying WITH queries) and
+    # None for transaction control and everything else EXPLAIN can't take
+    words = statement.lstrip(' (\n').split(None, 1)
+    first_word = words[0].upper() if len(words) > 0 else ''
+    if first_word in ('INSERT', 'UPDATE', 'DELETE'):
+        return 'write'
+    if first_word == 'WITH' and re.search(r'\b(INSERT|UPDATE|DELETE)\b', statement, re.IGNORECASE):
+        return 'write'
+    if first_word in ('SELECT', 'WITH'):
+        return 'read'
+
+
+def get_explain_prefix(dialect_name, statement_kind):
+
+    # Postgres runs reads for real timings and buffer counts but only plans writes (running them would lock rows, fire
+    # triggers and use up sequence values), sqlite can only show the plan
+    if dialect_name == 'postgresql':
+        return 'EXPLAIN (ANALYZE, BUFFERS) ' if statement_kind == 'read' else 'EXPLAIN '
+    elif dialect_name == 'sqlite':
+        return 'EXPLAIN QUERY PLAN '
+
+
+class FinderProfiler:
+    """Opt in per finder call counts and latencies with the SQL of the slowest calls kept for EXPLAIN"""
+
+    def __init__(self, enabled=False, slow_sample_count=3):
+
+        # Settings
+        self.enabled = False
+        self.slow_sample_count = slow_sample_count
+
+        # Storage
+        self._durations = dict()  # finder -> seconds per call
+        self._slow_samples = dict()  # finder -> min heap of (seconds, sequence, engine, [(statement, parameters)])
+        self._sequence = 0
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._listening = False
+
+        # Start profiling
+        if enabled:
+            self.enable()
+
+    def enable(self):
+
+        # Capture statements from every engine (only while a finder is running on that thread)
+        with self._lock:
+            if not self._listening:
+                event.listen(Engine, 'before_cursor_execute', self._capture_statement)
+                self._listening = True
+            self.enabled = True
+
+    def _capture_statement(self, connection, cursor, statement, parameters, context, executemany):
+
+        # Keep the SQL of every running finder (outer finders include what their inner ones ran)
+        for statements in getattr(self._local, 'statement_stack', ()):
+            statements.append((statement, parameters))
+
+    def profile(self, finder, session):
+        """
+        Context manager that times the code inside it as one call of finder. Profiles can be nested, each call is
+        timed on its own and includes the calls inside it
+        """
+
+        # Nothing to do unless profiling
+        if not self.enabled:
+            return nullcontext()
+
+        # Time it
+        return self._profile(finder, session)
+
+    @contextmanager
+    def _profile(self, finder, session):
+
+        # Collect the SQL of this call on top of any running ones
+        if not hasattr(self._local, 'statement_stack'):
+            self._local.statement_stack = []
+        statements = []
+        self._local.statement_stack.append(statements)
+
+        # Time the finder
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            self._local.statement_stack.pop()
+            self._record(finder, duration, session.get_bind(), statements)
+
+    def _record(self, finder, duration, engine, statements):
+
+        # Store the duration and keep the call if it is one of the slowest
+        with self._lock:
+            self._durations.setdefault(finder, []).append(duration)
+            if len(statements) == 0:
+                return
+            self._sequence += 1
+            slow_samples = self._slow_samples.setdefault(finder, [])
+            sample = (duration, self._sequence, engine, statements)
+            if len(slow_samples) < self.slow_sample_count:
+                heapq.heappush(slow_samples, sample)
+            elif duration > slow_samples[0][0]:
+                heapq.heapreplace(slow_samples, sample)
+
+    def statistics(self):
+
+        # Per finder counts and latencies in milliseconds, busiest first
+        with self._lock:
+            durations = {finder: sorted(values) for finder, values in self._durations.items()}
+        finder_statistics = dict()
+        for finder, values in sorted(durations.items(), key=lambda finder_values: -sum(finder_values[1])):
+            finder_statistics[finder] = {
+                'calls': len(values),
+                'total_ms': round(sum(values) * 1000, 2),
+                'mean_ms': round(sum(values) / len(values) * 1000, 3),
+                'p50_ms': round(get_percentile(values, 50) * 1000, 3),
+                'p95_ms': round(get_percentile(values, 95) * 1000, 3),
+                'p99_ms': round(get_percentile(values, 99) * 1000, 3),
+                'max_ms': round(values[-1] * 1000, 3),
+            }
+        return finder_statistics
+
+    def explain(self, engine, statement, parameters):
+
+        # Only reads and writes can be explained (transaction control and the like are left out)
+        statement_kind = get_statement_kind(statement)
+        if statement_kind is None:
+            return 'not explained'
+
+        # Run EXPLAIN on the captured SQL and parameters (rolled back, only reads are executed)
+        explain_prefix = get_explain_prefix(engine.dialect.name, statement_kind)
+        if explain_prefix is None:
+            return f'EXPLAIN is not supported on {engine.dialect.name}'
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(explain_prefix + statement, parameters)
+            plan = '\n'.join(' '.join(str(value) for value in row) for row in cursor.fetchall())
+            cursor.close()
+            connection.rollback()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as error:
+            plan = f'EXPLAIN failed: {error}'
+        finally:
+            connection.close()
+        return plan
+
+    def write_report(self, report_path=None):
+        """
+        Writes the per finder statistics and the EXPLAIN output of the slowest calls of each finder to report_path
+        (FINDER_PROFILE_PATH by default). Returns the path
+        """
+
+        # Default path
+        if report_path is None:
+            report_path = FINDER_PROFILE_PATH
+
+        # Get everything recorded so far
+        finder_statistics = self.statistics()
+        with self._lock:
+            slow_samples = {finder: sorted(samples, reverse=True) for finder, samples in self._slow_samples.items()}
+
+        # Assemble the report
+        lines = [f'finder profile written {datetime.datetime.utcnow().isoformat()} UTC', '']
+        lines.append(f'{"finder":<24}{"calls":>10}{"total ms":>14}{"mean ms":>10}{"p50 ms":>10}{"p95 ms":>10}'
+                     f'{"p99 ms":>10}{"max ms":>10}')
+        for finder, statistics in finder_statistics.items():
+            lines.append(f'{finder:<24}{statistics["calls"]:>10}{statistics["total_ms"]:>14}'
+                         f'{statistics["mean_ms"]:>10}{statistics["p50_ms"]:>10}{statistics["p95_ms"]:>10}'
+                         f'{statistics["p99_ms"]:>10}{statistics["max_ms"]:>10}')
+        for finder in finder_statistics:
+            for duration, sequence, engine, statements in slow_samples.get(finder, []):
+                lines.extend(['', f'{finder} call took {duration * 1000:.3f} ms'])
+                for statement, parameters in statements:
+                    lines.extend([statement, f'parameters: {parameters}', self.explain(engine, statement, parameters)])
+
+        # Write it
+        with open(report_path, 'w') as report_file:
+            report_file.write('\n'.join(lines) + '\n')
+
+        # Return path
+        return report_path
+
+
+# Process wide profiler
+finder_profiler = FinderProfiler(enabled=FINDER_PROFILING)
@@ -0,0 +1,88 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import settings
+
+# Fetch settings (override any of them in settings.py)
+HTTP_TIMEOUT = getattr(settings, 'HTTP_TIMEOUT', (5, 30))  # (connect, read) seconds
+HTTP_MAX_WORKERS = getattr(settings, 'HTTP_MAX_WORKERS', 8)  # Requests in flight across every host
+HTTP_MAX_PER_HOST = getattr(settings, 'HTTP_MAX_PER_HOST', 4)  # Requests in flight to any one host
+HTTP_RETRIES = getattr(settings, 'HTTP_RETRIES', 2)  # Retries of connection errors and 5xx responses
+
+# Process wide fetch threads and per host limits
+fetch_executor = ThreadPoolExecutor(max_workers=HTTP_MAX_WORKERS, thread_name_prefix='fetch')
+host_semaphores = dict()
+host_semaphores_lock = threading.Lock()
+
+
+def create_http_session():
+
+    # Keep alive connections pooled per host (enough for every fetch thread)
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_MAX_WORKERS,
+        pool_maxsize=HTTP_MAX_WORKERS,
+        max_retries=Retry(
+            total=HTTP_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=(500, 502, 503, 504),
+            method_whitelist=('GET',)
+        )
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    # Ask for compressed responses (requests decodes them)
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+
+    # Return session
+    return session
+
+
+# Process wide HTTP session
+http_session = create_http_session()
+
+
+def get_host_semaphore(url):
+
+    # One semaphore per host
+    host = urlsplit(url).netloc
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(HTTP_MAX_PER_HOST)
+        return host_semaphores[host]
+
+
+def get_json_from_url(url):
+
+    # Fetch through the pooled session without going over the hosts limit
+    with get_host_semaphore(url):
+        response = http_session.get(url, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+
+def fetch_all(function, arguments_list):
+    """
+    Runs function(*arguments) for every entry of arguments_list on the fetch threads and waits for all of them.
+    Returns the results in the same order, with the exception in place of the result for calls that failed
+    """
+
+    # Start every call
+    futures = [fetch_executor.submit(function, *arguments) for arguments in arguments_list]
+
+    # Collect results
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as error:
+            results.append(error)
+
+    # Return results
+    return results
@@ -1,20 +1,26 @@
-import urllib.request
 import json
 import datetime
 import os
 import argparse
 import time
 import random
+import asyncio
 from sqlalchemy import or_, and_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 from db_utils import get_db_session, shutdown_session_and_engine, create_new_instance_from_item, \
-    load_item_into_database, find_instance_from_item, find_horse_instance_from_item_and_race
+    load_item_into_database, find_instance_from_item, find_horse_instance_from_item_and_race, load_items_into_database, \
+    unit_of_work, race_savepoint, upgrade_database_schema, append_items_to_database, get_update_statistics, \
+    dispose_engine, get_ambiguous_initial_statistics, upsert_items_into_database, get_read_session, \
+    upsert_race_from_item, upsert_latest_entry_pools
 from utils import get_list_of_files, remove_empty_folders, get_files_in_folders, str2bool, approved_track, remove_duplicates_preserve_order
 from models import Races, Tracks, Entries, Horses
 import csv
 from drf import create_track_item_from_drf_data, create_race_item_from_drf_data, create_horse_item_from_drf_data, \
     create_jockey_item_from_drf_data, create_trainer_item_from_drf_data, create_entry_item_from_drf_data, \
     create_owner_item_from_drf_data, create_entry_pool_item_from_drf_data, create_base_wager_amount_dict_from_drf_data, \
-    create_payoff_item_from_drf_data, create_probable_item_from_drf_data
+    create_payoff_item_from_drf_data, create_probable_item_from_drf_data, get_also_ran_horse_names_from_drf_data, \
+    create_runner_entity_items_from_drf_data
 from brisnet import scrape_spot_plays, create_track_item_from_brisnet_spot_play, \
     create_race_item_from_brisnet_spot_play, create_horse_item_from_brisnet_spot_play, \
     create_entry_item_from_brisnet_spot_play, create_pick_item_from_brisnet_spot_play
@@ -26,9 +32,19 @@ from equibase_charts import convert_equibase_result_chart_pdf_to_item, get_equib
 from settings import EQUIBASE_PDF_PATH
 from pprint import pprint
 from db_stats import record_all_statistics
+from entity_cache import entity_cache
+from db_async import run_with_db_session
+from db_staging import merge_staging_into_main
+from db_maintenance import backfill_derived_keys, fix_horse_registry, partition_odds_tables, \
+    backfill_latest_entry_pools
+from odds_archive import archive_odds
+from probable_matrices import PROBABLE_MATRICES, create_probable_matrix_items_from_probable_items
+from track_registry import track_registry, get_track_from_race
+from finder_profiler import finder_profiler
+from http_fetch import get_json_from_url, fetch_all, fetch_executor
 
 
-def import_track_codes():
+def import_track_codes(database='main'):
 
     # setup script dir
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -37,7 +53,7 @@ def import_track_codes():
     file_name = os.path.join(script_dir, 'resources', 'track_codes.csv')
 
     # Connect to the database
-    session = get_db_session()
+    session = get_db_session(database=database)
 
     # USA Track Codes
     with open(file_name) as csv_file:
@@ -102,11 +118,41 @@ def import_track_codes():
                 track.time_zone = 'US/Eastern'
                 session.commit()
 
+    # Reload the track registry with the new codes
+    track_registry.invalidate()
+
     # Close everything out
     shutdown_session_and_engine(session)
 
 
-def load_drf_odds_data_into_database(data, scrape_time, session):
+def resolve_drf_runner_entities(runners, session, include_owner=False):
+
+    # Create the items for every runner
+    entity_items = create_runner_entity_items_from_drf_data(runners, include_owner)
+
+    # One lookup (and at most one insert) per entity type, results line up with the runners
+    runner_entities = dict()
+    for item_type, items in entity_items.items():
+        runner_entities[item_type] = load_items_into_database(items, item_type, session)
+
+    # Return instances by type
+    return runner_entities
+
+
+def extend_append_items(append_items, new_append_items):
+
+    # Add rows to a buffer of rows by type
+    for item_type, items in new_append_items.items():
+        append_items.setdefault(item_type, []).extend(items)
+
+
+def load_drf_odds_data_into_database(data, scrape_time, session, append_items=None):
+
+    # Odds snapshots are appended in bulk, either here or by the caller for a whole poll
+    if append_items is None:
+        race_append_items = {'probable': [], 'entry_pool': []}
+    else:
+        race_append_items = {item_type: [] for item_type in append_items}
 
     # Track Info
     track_item = create_track_item_from_drf_data(data)
@@ -118,7 +164,7 @@ def load_drf_odds_data_into_database(data, scrape_time, session):
     race_item = create_race_item_from_drf_data(data, track, scrape_time)
     if race_item is None:
         return
-    race = load_item_into_database(race_item, 'race', session)
+    race = upsert_race_from_item(race_item, session)
     if race is None:
         return
 
@@ -129,47 +175,53 @@ def load_drf_odds_data_into_database(data, scrape_time, session):
             for probable_dict in data['wagerToteProbables'][probable_type]:
                 probable_item = create_probable_item_from_drf_data(probable_dict, race, scrape_time)
 
-                # We're creating a new instance instead of loading the item due to database constraints
+                # Probables are a time series so they are only ever appended
                 if probable_item is not None:
-                    probable = create_new_instance_from_item(probable_item, 'probable', session)
-
-    # Parse Runner Data
-    for runner in data['runners']:
+                    race_append_items['probable'].append(probable_item)
 
-        # Load Horse Data
-        horse_item = create_horse_item_from_drf_data(runner)
-        horse = load_item_into_database(horse_item, 'horse', session)
-        if horse is None:
-            continue
-
-        # Load Trainer Data
-        trainer_item = create_trainer_item_from_drf_data(runner)
-        trainer = load_item_into_database(trainer_item, 'trainer', session)
-        if trainer is None:
-            continue
-
-        # Load Jockey Data
-        jockey_item = create_jockey_item_from_drf_data(runner)
-        jockey = load_item_into_database(jockey_item, 'jockey', session)
-        if jockey is None:
+    # Pack the probables into one row per type (PROBABLE_MATRICES in settings.py)
+    if PROBABLE_MATRICES:
+        race_append_items['probable_matrix'] = create_probable_matrix_items_from_probable_items(
+            race_append_items['probable']
+        )
+        race_append_items['probable'] = []
+
+    # Resolve every horse, trainer and jockey in the race at once
+    runner_entities = resolve_drf_runner_entities(data['runners'], session)
+
+    # Load Entry Data
+    entry_runners = []
+    entry_items = []
+    for runner_index, runner in enumerate(data['runners']):
+        horse = runner_entities['horse'][runner_index]
+        trainer = runner_entities['trainer'][runner_index]
+        jockey = runner_entities['jockey'][runner_index]
+        if horse is None or trainer is None or jockey is None:
             continue
+        entry_runners.append(runner)
+        entry_items.append(create_entry_item_from_drf_data(runner, horse, race, trainer, jockey, None, 0))
+    entry_ids = upsert_items_into_database(entry_items, 'entry', session)
 
-        # Load Owner Data
-        owner = None
-
-        # Load Entry Data
-        entry_item = create_entry_item_from_drf_data(runner, horse, race, trainer, jockey, owner, 0)
-        entry = load_item_into_database(entry_item, 'entry', session)
-        if entry is None:
+    # Load Entry Pool Data
+    for runner, entry_id in zip(entry_runners, entry_ids):
+        if entry_id is None:
             continue
-
-        # Load Entry Pool Data
         if runner['horseDataPools'] is not None:
             for data_pool in runner['horseDataPools']:
-                entry_pool_item = create_entry_pool_item_from_drf_data(data_pool, entry, scrape_time)
+                entry_pool_item = create_entry_pool_item_from_drf_data(data_pool, entry_id, scrape_time)
 
-                # We're creating a new instance instead of loading the item due to database constraints
-                entry_pool = create_new_instance_from_item(entry_pool_item, 'entry_pool', session)
+                # Entry pools are a time series so they are only ever appended
+                race_append_items['entry_pool'].append(entry_pool_item)
+
+    # Keep the current odds table up to date
+    upsert_latest_entry_pools(race_append_items['entry_pool'], session)
+
+    # Hand the rows to the caller or write them now
+    if append_items is None:
+        for item_type, items in race_append_items.items():
+            append_items_to_database(items, item_type, session)
+    else:
+        extend_append_items(append_items, race_append_items)
 
 
 def load_drf_results_data_into_database(data, scrape_time, session):
@@ -182,7 +234,7 @@ def load_drf_results_data_into_database(data, scrape_time, session):
 
     # Race Info
     race_item = create_race_item_from_drf_data(data, track, scrape_time)
-    race = load_item_into_database(race_item, 'race', session)
+    race = upsert_race_from_item(race_item, session)
     if race is None:
         return
 
@@ -192,68 +244,38 @@ def load_drf_results_data_into_database(data, scrape_time, session):
         # Get base amount dictionary
         base_wager_amount_dict = create_base_wager_amount_dict_from_drf_data(data)
 
-        # Loop through payoffs
-        for payoff in data['payoffDTOs']:
-            payoff_item = create_payoff_item_from_drf_data(payoff, race, base_wager_amount_dict)
-            payoff = load_item_into_database(payoff_item, 'payoff', session)
-            if payoff is None:
-                continue
-
-    # Parse Runner Data
-    for runner in data['runners']:
-
-        # Load Horse Data
-        horse_item = create_horse_item_from_drf_data(runner)
-        horse = load_item_into_database(horse_item, 'horse', session)
-        if horse is None:
-            continue
-
-        # Load Trainer Data
-        trainer_item = create_trainer_item_from_drf_data(runner)
-        trainer = load_item_into_database(trainer_item, 'trainer', session)
-        if trainer is None:
-            continue
-
-        # Load Jockey Data
-        jockey_item = create_jockey_item_from_drf_data(runner)
-        jockey = load_item_into_database(jockey_item, 'jockey', session)
-        if jockey is None:
-            continue
-
-        # Load Owner Data
-        owner_item = create_owner_item_from_drf_data(runner)
-        owner = load_item_into_database(owner_item, 'owner', session)
-
-        # Load Entry Data (pools tell order of finish so thats why its zero)
-        entry_item = create_entry_item_from_drf_data(runner, horse, race, trainer, jockey, owner, 0)
-        entry = load_item_into_database(entry_item, 'entry', session)
-        if entry is None:
+        # Load all payoffs at once
+        payoff_items = [
+            create_payoff_item_from_drf_data(payoff, race, base_wager_amount_dict) for payoff in data['payoffDTOs']
+        ]
+        payoffs = load_items_into_database(payoff_items, 'payoff', session)
+
+    # Also rans only come with a name
+    also_ran_runners = [{'horseName': horse_name} for horse_name in get_also_ran_horse_names_from_drf_data(data)]
+
+    # Resolve every horse, trainer, jockey and owner in the race at once
+    runner_entities = resolve_drf_runner_entities(data['runners'] + also_ran_runners, session, include_owner=True)
+
+    # Load Entry Data (pools tell order of finish so thats why its zero)
+    entry_items = []
+    for runner_index, runner in enumerate(data['runners']):
+        horse = runner_entities['horse'][runner_index]
+        trainer = runner_entities['trainer'][runner_index]
+        jockey = runner_entities['jockey'][runner_index]
+        owner = runner_entities['owner'][runner_index]
+        if horse is None or trainer is None or jockey is None:
             continue
+        entry_items.append(create_entry_item_from_drf_data(runner, horse, race, trainer, jockey, owner, 0))
 
-    # Parse finish position out of also ran
-    if data['alsoRan'] is None:
-        order_of_finish = []
-    elif isinstance(data['alsoRan'], list):
-        order_of_finish = data['alsoRan']
-    else:
-        first_horses, last_horse = data['alsoRan'].split('  and   ')
-        order_of_finish = first_horses.split(', ')
-        order_of_finish.append(last_horse)
-
-    for finish_index, horse_name in enumerate(order_of_finish):
-
-        # Load Horse Data
-        runner = {'horseName': horse_name.strip().upper()}
-        horse_item = create_horse_item_from_drf_data(runner)
-        horse = load_item_into_database(horse_item, 'horse', session)
+    # Also ran finish positions start after the top three
+    for finish_index, runner in enumerate(also_ran_runners):
+        horse = runner_entities['horse'][len(data['runners']) + finish_index]
         if horse is None:
             continue
+        entry_items.append(create_entry_item_from_drf_data(runner, horse, race, None, None, None, finish_index+4))
 
-        # Load Entry Data
-        entry_item = create_entry_item_from_drf_data(runner, horse, race, None, None, None, finish_index+4)
-        entry = load_item_into_database(entry_item, 'entry', session)
-        if entry is None:
-            continue
+    # Load them all at once
+    entries = load_items_into_database(entry_items, 'entry', session)
 
 
 def load_drf_entries_data_into_database(data, scrape_time, session):
@@ -276,39 +298,23 @@ def load_drf_entries_data_into_database(data, scrape_time, session):
             return
 
     # Since we haven't had live odds yet, write the info at will
-    race = load_item_into_database(race_item, 'race', session)
+    race = upsert_race_from_item(race_item, session)
     if race is None:
         return
 
-    # Parse Runner Data
-    for runner in data['runners']:
+    # Resolve every horse, trainer and jockey in the race at once
+    runner_entities = resolve_drf_runner_entities(data['runners'], session)
 
-        # Load Horse Data
-        horse_item = create_horse_item_from_drf_data(runner)
-        horse = load_item_into_database(horse_item, 'horse', session)
-        if horse is None:
-            continue
-
-        # Load Trainer Data
-        trainer_item = create_trainer_item_from_drf_data(runner)
-        trainer = load_item_into_database(trainer_item, 'trainer', session)
-        if trainer is None:
-            continue
-
-        # Load Jockey Data
-        jockey_item = create_jockey_item_from_drf_data(runner)
-        jockey = load_item_into_database(jockey_item, 'jockey', session)
-        if jockey is None:
-            continue
-
-        # Load Owner Data
-        owner = None
-
-        # Load Entry Data
-        entry_item = create_entry_item_from_drf_data(runner, horse, race, trainer, jockey, owner, 0)
-        entry = load_item_into_database(entry_item, 'entry', session)
-        if entry is None:
+    # Load Entry Data
+    entry_items = []
+    for runner_index, runner in enumerate(data['runners']):
+        horse = runner_entities['horse'][runner_index]
+        trainer = runner_entities['trainer'][runner_index]
+        jockey = runner_entities['jockey'][runner_index]
+        if horse is None or trainer is None or jockey is None:
             continue
+        entry_items.append(create_entry_item_from_drf_data(runner, horse, race, trainer, jockey, None, 0))
+    entries = load_items_into_database(entry_items, 'entry', session)
 
 
 def get_single_drf_odds_track_data_from_file(filename):
@@ -365,8 +371,7 @@ def get_single_track_data_from_drf(track):
                f'date/{datetime.datetime.now().strftime("%m-%d-%Y")}'
 
     # Get Data
-    with urllib.request.urlopen(race_url) as url:
-        data = json.loads(url.read().decode())
+    data = get_json_from_url(race_url)
 
     data['drf_scrape'] = {
         'time_scrape_utc': datetime.datetime.utcnow().isoformat()
@@ -376,13 +381,82 @@ def get_single_track_data_from_drf(track):
     return data
 
 
+async def fetch_single_track_drf_odds_async(current_track):
+
+    # Fetch on a fetch thread so other tracks keep going
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(fetch_executor, get_single_track_data_from_drf, current_track)
+
+
+def resolve_drf_runner_entities_for_races(race_data_list, session):
+
+    # Every horse, trainer and jockey of every race in one pass
+    runners = [runner for race_data in race_data_list for runner in race_data.get('runners', None) or []]
+    resolve_drf_runner_entities(runners, session)
+
+
+async def load_single_track_drf_odds_async(race_data, database='main'):
+
+    # Write the race in its own session and transaction
+    current_scrape_time = datetime.datetime.fromisoformat(race_data['drf_scrape']['time_scrape_utc'])
+    try:
+        await run_with_db_session(load_drf_odds_data_into_database, race_data, current_scrape_time, database=database)
+    except IntegrityError:
+        # Another track's worker wrote one of the same rows first, the retry finds it
+        await run_with_db_session(load_drf_odds_data_into_database, race_data, current_scrape_time, database=database)
+
+
+def report_async_track_failures(track_list, results, action):
+
+    # Report failures without losing the other tracks (returns the tracks that worked with their results)
+    successes = []
+    for current_track, result in zip(track_list, results):
+        if isinstance(result, Exception):
+            if debug_flag:
+                raise result
+            else:
+                print(f'an exception happened {action} odds for {current_track["trackId"]}: {result!r}')
+        else:
+            successes.append((current_track, result))
+    return successes
+
+
+async def load_drf_odds_tracks_async(track_list, database='main'):
+
+    # Fetch every track concurrently
+    fetch_results = await asyncio.gather(
+        *[fetch_single_track_drf_odds_async(current_track) for current_track in track_list],
+        return_exceptions=True
+    )
+    fetched_tracks = report_async_track_failures(track_list, fetch_results, 'fetching')
+    if len(fetched_tracks) == 0:
+        return
+
+    # Create new horses, trainers and jockeys from one session first so the concurrent writes below only find them
+    race_data_list = [race_data for current_track, race_data in fetched_tracks]
+    try:
+        await run_with_db_session(resolve_drf_runner_entities_for_races, race_data_list, database=database)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except Exception as error:
+        if debug_flag:
+            raise
+        print(f'an exception happened resolving the runners of every track, loading them one by one: {error!r}')
+
+    # Write every track concurrently
+    load_results = await asyncio.gather(
+        *[load_single_track_drf_odds_async(race_data, database) for race_data in race_data_list],
+        return_exceptions=True
+    )
+    report_async_track_failures([current_track for current_track, race_data in fetched_tracks], load_results, 'loading')
+
+
 def get_drf_odds_track_list(request_date):
 
     # Get current track list
     drf_format_date = request_date.strftime("%m-%d-%Y")
     drf_track_url = f'http://www.drf.com/liveOdds/getTrackList/date/{drf_format_date}'
-    with urllib.request.urlopen(drf_track_url) as url:
-        data = json.loads(url.read().decode())
+    data = get_json_from_url(drf_track_url)
 
     # Return track list
     return data
@@ -393,8 +467,7 @@ def get_drf_results_track_list(request_date):
     # Get current track list
     drf_format_date = request_date.strftime("%m-%d-%Y")
     drf_track_url = f'https://www.drf.com/results/raceTracks/page/results/date/{drf_format_date}'
-    with urllib.request.urlopen(drf_track_url) as url:
-        data = json.loads(url.read().decode())
+    data = get_json_from_url(drf_track_url)
 
     # Return track list
     return data
@@ -407,8 +480,7 @@ def get_drf_entries_track_list(request_date):
     # https://www.drf.com/results/raceTracks/page/entries/date/05-08-2020
     # https://www.drf.com/entries/entryDetails/id/GP/country/USA/date/05-07-2020
     drf_track_url = f'https://www.drf.com/results/raceTracks/page/entries/date/{drf_format_date}'
-    with urllib.request.urlopen(drf_track_url) as url:
-        data = json.loads(url.read().decode())
+    data = get_json_from_url(drf_track_url)
 
     # Return track list
     return data
@@ -481,8 +553,7 @@ def get_single_race_day_drf_results(date, track_id, country):
     race_url = f'https://www.drf.com/results/resultDetails/id/{track_id}/country/{country}/date/{drf_format_date}'
 
     # Get Data
-    with urllib.request.urlopen(race_url) as url:
-        data = json.loads(url.read().decode())
+    data = get_json_from_url(race_url)
 
     data['drf_scrape'] = {
         'time_scrape_utc': datetime.datetime.utcnow().isoformat()
@@ -499,8 +570,7 @@ def get_single_race_day_drf_entries(date, track_id, country):
     race_url = f'https://www.drf.com/entries/entryDetails/id/{track_id}/country/{country}/date/{drf_format_date}'
 
     # Get Data
-    with urllib.request.urlopen(race_url) as url:
-        data = json.loads(url.read().decode())
+    data = get_json_from_url(race_url)
 
     data['drf_scrape'] = {
         'time_scrape_utc': datetime.datetime.utcnow().isoformat()
@@ -554,8 +624,9 @@ def save_single_track_drf_results_data_to_file(data, save_dir):
 
 def get_races_with_no_results(session):
 
-    # Query Races
+    # Query Races (with their tracks)
     races = session.query(Races).\
+        options(joinedload(Races.track)).\
         filter_by(drf_results=False, drf_entries=True).\
         filter(Races.post_time <= datetime.datetime.utcnow()).all()
 
@@ -564,7 +635,7 @@ def get_races_with_no_results(session):
     for race in races:
 
         # Get Track Code
-        track = session.query(Tracks).filter_by(track_id=race.track_id).first()
+        track = get_track_from_race(session, race)
 
         # Append to list
         race_list.append({
@@ -629,7 +700,7 @@ def load_equibase_entries_into_database(whole_card_data, session):
         if race is None:
             return
         else:
-            race = load_item_into_database(race_item, 'race', session)
+            race = upsert_race_from_item(race_item, session)
 
         # Entry Info
         for equibase_entry in data['entry_items']:
@@ -670,8 +741,8 @@ def get_equibase_entry_links_for_races_without_entries(session):
     min_entries = today + datetime.timedelta(days=-1)
     max_entries = today + datetime.timedelta(days=2)
 
-    # Query for races
-    races = session.query(Races).filter(
+    # Query for races (with their tracks)
+    races = session.query(Races).options(joinedload(Races.track)).filter(
         Races.equibase_entries.is_(False),
         Races.drf_entries.is_(True),
         Races.card_date <= max_entries,
@@ -756,7 +827,7 @@ def load_equibase_horse_data_into_database(data, session, existing_race=None):
         # Race Info
         race_item = results_item['race_item']
         race_item['track_id'] = track.track_id
-        race = load_item_into_database(race_item, 'race', session)
+        race = upsert_race_from_item(race_item, session)
         if race is None:
             return
 
@@ -802,7 +873,7 @@ def load_equibase_chart_data_into_database(data, session):
         # Race Info
         race_item = data_item['race_item']
         race_item['track_id'] = track.track_id
-        race = load_item_into_database(race_item, 'race', session)
+        race = upsert_race_from_item(race_item, session)
         races.append(race)
         if race is None:
             return
@@ -811,7 +882,7 @@ def load_equibase_chart_data_into_database(data, session):
         # Fractional Times
         for fractional_item in data_item['fractional_data']:
             fractional_item['race_id'] = race.race_id
-            fractional_instance = load_item_into_database(fractional_item, 'fractional_time', session)
+        fractional_instances = load_items_into_database(data_item['fractional_data'], 'fractional_time', session)
 
         # Entries
         for entry_data in data_item['entry_data']:
@@ -838,97 +909,70 @@ def load_equibase_chart_data_into_database(data, session):
             point_of_call_list = entry_data['point_of_call_list']
             for point_of_call_item in point_of_call_list:
                 point_of_call_item['entry_id'] = entry.entry_id
-                point_of_call = load_item_into_database(point_of_call_item, 'point_of_call', session)
+            points_of_call = load_items_into_database(point_of_call_list, 'point_of_call', session)
 
     # return race list so we can check if it finished
     return races
 
 
-def fix_horse_registry(session):
-
-    # Variables
-    registries = ['Q', 'G', 'T', 'K']
-    types = ['MX', 'TB', 'QH']
+def download_problem_equibase_charts(session, browser, read_session=None):
 
-    # Perform query
-    horses = session.query(Horses).all()
+    # Find the backlog on the read session if there is one
+    if read_session is None:
+        read_session = session
 
-    # Iterate all
-    for horse in horses:
-        if horse.equibase_horse_type and horse.equibase_horse_registry:
-            if horse.equibase_horse_type in registries and horse.equibase_horse_registry in types:
-                old_registry = horse.equibase_horse_registry
-                old_type = horse.equibase_horse_type
-                horse.equibase_horse_registry = old_type
-                horse.equibase_horse_type = old_registry
-                print(f'fixing {horse.horse_id}')
-            elif horse.equibase_horse_type in types and horse.equibase_horse_registry in registries:
-                pass
-            else:
-                print(f'{horse.horse_id} is weird with type:'
-                      f'{horse.equibase_horse_type} and reg:{horse.equibase_horse_registry}')
-        else:
-            pass
-
-    session.commit()
-
-
-def download_problem_equibase_charts(session, browser):
-
-    # Query the database for the problem children
-    query = session.query(Races.card_date, Races.track_id).filter(
+    # Query the database for the problem children (with their tracks)
+    races = read_session.query(Races).options(joinedload(Races.track)).filter(
         Races.equibase_chart_download_date < datetime.datetime(year=1910, month=1, day=1),
         Races.equibase_chart_scrape.isnot(True),
         Races.card_date < datetime.date.today()
-    ).group_by(Races.card_date, Races.track_id)
+    ).order_by(Races.card_date, Races.track_id, Races.race_number).all()
 
-    # Loop through missing charts and redownload them
-    for card_date, track_id in query:
-
-        # Get the first race in order to create a link to download
-        race = session.query(Races).filter(
-            Races.card_date == card_date,
-            Races.track_id == track_id
-        ).first()
+    # Create a link for each card from its first race (before any commit expires the races)
+    card_links = dict()
+    for race in races:
+        if (race.card_date, race.track_id) not in card_links:
+            card_links[(race.card_date, race.track_id)] = get_equibase_embedded_chart_link_from_race(read_session, race)
 
-        # If we have a race to download, go for it
-        if race is not None:
+    # Hand the read connection back before the slow downloads
+    if read_session is not session:
+        read_session.close()
 
-            # Create the link
-            chart_link = get_equibase_embedded_chart_link_from_race(session, race)
+    # Loop through missing charts and redownload them
+    for (card_date, track_id), chart_link in card_links.items():
 
-            # Attempt the download
-            pdf_path = None
-            try:
-                pdf_path = get_html_from_page_with_captcha(browser, chart_link, 'object[type][data]')
-            except (KeyboardInterrupt, SystemExit):  # handle control c
+        # Attempt the download
+        pdf_path = None
+        try:
+            pdf_path = get_html_from_page_with_captcha(browser, chart_link, 'object[type][data]')
+        except (KeyboardInterrupt, SystemExit):  # handle control c
+            raise
+        except:
+            if debug_flag:
                 raise
-            except:
-                if debug_flag:
-                    raise
-                else:
-                    print(f'an exception happened during download of {chart_link}')
-                    pdf_path = None
-
-            # Verify file download
-            if pdf_path:
-                if os.path.exists(pdf_path):
-                    download_date = datetime.datetime.now()
-                    print(f'Successfully downloaded {pdf_path}')
-                else:
-                    download_date = datetime.datetime(year=1900, month=1, day=1)
+            else:
+                print(f'an exception happened during download of {chart_link}')
+                pdf_path = None
+
+        # Verify file download
+        if pdf_path:
+            if os.path.exists(pdf_path):
+                download_date = datetime.datetime.now()
+                print(f'Successfully downloaded {pdf_path}')
             else:
                 download_date = datetime.datetime(year=1900, month=1, day=1)
+        else:
+            download_date = datetime.datetime(year=1900, month=1, day=1)
 
-            # Write confirmation of download to database
-            downloaded_races = session.query(Races).filter(Races.card_date == race.card_date,
-                                                           Races.track_id == race.track_id).all()
-            for downloaded_race in downloaded_races:
-                downloaded_race.equibase_chart_download_date = download_date
-                session.commit()
+        # Write confirmation of download to database
+        downloaded_races = session.query(Races).filter(Races.card_date == card_date,
+                                                       Races.track_id == track_id).all()
+        for downloaded_race in downloaded_races:
+            downloaded_race.equibase_chart_download_date = download_date
+            session.commit()
 
-            # Pause because were nice
-            time.sleep(15)
+        # Pause because were nice
+        time.sleep(15)
 
 
 def download_equibase_charts(session, browser):
@@ -940,8 +984,8 @@ def download_equibase_charts(session, browser):
             Races.card_date < datetime.date.today()
     ).count() > 0:
 
-        # Get oldest race
-        race = session.query(Races).filter(
+        # Get oldest race (with its track)
+        race = session.query(Races).options(joinedload(Races.track)).filter(
             Races.equibase_chart_download_date.is_(None),
             Races.equibase_chart_scrape.isnot(True),
             Races.card_date < datetime.date.today()
@@ -1008,7 +1052,8 @@ def scrape_equibase_charts(session):
             pdf_items = convert_equibase_result_chart_pdf_to_item(file)
 
             # load the file in the database
-            updated_races = load_equibase_chart_data_into_database(pdf_items, session)
+            with unit_of_work(session):
+                updated_races = load_equibase_chart_data_into_database(pdf_items, session)
 
         except (KeyboardInterrupt, SystemExit):  # handle control c
             raise
@@ -1091,8 +1136,27 @@ if __name__ == '__main__':
                             default=False,
                             metavar='DEBUG'
                             )
+    arg_parser.add_argument('--database',
+                            help="Database to write to (main or staging, merge staging with the merge_staging mode)",
+                            type=str,
+                            required=False,
+                            default='main',
+                            choices=['main', 'staging'],
+                            metavar='DATABASE'
+                            )
+    arg_parser.add_argument('--profile_finders',
+                            help="Time the finder queries and write a report with EXPLAIN output of the slowest calls",
+                            type=str2bool,
+                            required=False,
+                            default=False,
+                            metavar='PROFILE_FINDERS'
+                            )
     args = arg_parser.parse_args()
 
+    # Handle finder profiling
+    if args.profile_finders:
+        finder_profiler.enable()
+
     # Handle debug
     global debug_flag
     debug_flag = args.debug
@@ -1115,7 +1179,7 @@ if __name__ == '__main__':
         if len(track_data['raceTracks']['allTracks']) > 0:
 
             # Connect to the database
-            db_session = get_db_session()
+            db_session = get_db_session(database=args.database)
 
             for current_track in track_data['raceTracks']['allTracks']:
 
@@ -1147,8 +1211,10 @@ if __name__ == '__main__':
                         current_scrape_time = datetime.datetime.fromisoformat(
                             entry_data['drf_scrape']['time_scrape_utc']
                         )
-                        for index, race_data in enumerate(entry_data['races']):
-                            load_drf_entries_data_into_database(race_data, current_scrape_time, db_session)
+                        with unit_of_work(db_session):
+                            for index, race_data in enumerate(entry_data['races']):
+                                with race_savepoint(db_session, debug_flag):
+                                    load_drf_entries_data_into_database(race_data, current_scrape_time, db_session)
 
             # Close everything out
             shutdown_session_and_engine(db_session)
@@ -1165,9 +1231,10 @@ if __name__ == '__main__':
         if len(track_data) > 0:
 
             # Connect to the database
-            db_session = get_db_session()
+            db_session = get_db_session(database=args.database)
 
             # Iterate through tracks
+            fetch_track_list = []
             for current_track in track_data:
 
                 # Prevent non-US tracks
@@ -1180,27 +1247,71 @@ if __name__ == '__main__':
                         print(f'{current_track["trackId"]} is not approved')
                     continue
 
-                # Get all the data
-                track_data_list.append(get_single_track_data_from_drf(current_track))
+                # Queue the track
+                fetch_track_list.append(current_track)
+
+            # Get all the data at once over the pooled connections
+            fetch_results = fetch_all(
+                get_single_track_data_from_drf,
+                [(current_track,) for current_track in fetch_track_list]
+            )
+            for current_track, fetch_result in zip(fetch_track_list, fetch_results):
+                if isinstance(fetch_result, Exception):
+                    if debug_flag:
+                        raise fetch_result
+                    print(f'an exception happened fetching odds for {current_track["trackId"]}: {fetch_result!r}')
+                else:
+                    track_data_list.append(fetch_result)
 
             # Iterate through tracks
-            for race_data in track_data_list:
-                current_scrape_time = datetime.datetime.fromisoformat(race_data['drf_scrape']['time_scrape_utc'])
-                load_drf_odds_data_into_database(race_data, current_scrape_time, db_session)
+            with unit_of_work(db_session):
+                poll_append_items = {'probable': [], 'entry_pool': []}
+                for race_data in track_data_list:
+                    current_scrape_time = datetime.datetime.fromisoformat(race_data['drf_scrape']['time_scrape_utc'])
+
+                    # Rows of a race only join the poll once its savepoint is released
+                    race_append_items = {item_type: [] for item_type in poll_append_items}
+                    with race_savepoint(
+                        db_session,
+                        debug_flag,
+                        on_commit=lambda: extend_append_items(poll_append_items, race_append_items)
+                    ):
+                        load_drf_odds_data_into_database(race_data, current_scrape_time, db_session, race_append_items)
+
+                # One bulk append per table for the whole poll
+                for item_type, items in poll_append_items.items():
+                    append_items_to_database(items, item_type, db_session)
 
             # Close everything out
             shutdown_session_and_engine(db_session)
 
+    if args.mode in ('drf_odds_async',):
+
+        # Mode Tracking
+        modes_run.append('drf_odds_async')
+
+        # Get currently running tracks (same filters as drf_odds)
+        track_data = get_current_drf_odds_track_list()
+        track_list = [
+            current_track for current_track in track_data
+            if current_track['country'] == 'USA' and approved_track(current_track['trackId'])
+        ]
+
+        # Fetch and load them concurrently
+        asyncio.run(load_drf_odds_tracks_async(track_list, args.database))
+
     if args.mode in ('drf_missing', 'drf', 'all'):
 
         # Mode Tracking
         modes_run.append('drf_missing')
 
         # Connect to the database
-        db_session = get_db_session()
+        db_session = get_db_session(database=args.database)
+        read_session = get_read_session(database=args.database)
 
         # Get missing tracks
-        missing_races = get_races_with_no_results(db_session)
+        missing_races = get_races_with_no_results(read_session)
+        shutdown_session_and_engine(read_session)
 
         # Loop if theres races
         for current_race in missing_races:
@@ -1223,9 +1334,11 @@ if __name__ == '__main__':
                 results_data['drf_scrape']['time_scrape_utc']
             )
             if results_data['isData']:
-                for index, race_data in enumerate(results_data['races']):
-                    race_data['postTimeLong'] = results_data['allRaces'][index]['postTime']
-                    load_drf_results_data_into_database(race_data, current_scrape_time, db_session)
+                with unit_of_work(db_session):
+                    for index, race_data in enumerate(results_data['races']):
+                        race_data['postTimeLong'] = results_data['allRaces'][index]['postTime']
+                        with race_savepoint(db_session, debug_flag):
+                            load_drf_results_data_into_database(race_data, current_scrape_time, db_session)
 
         # Close everything out
         shutdown_session_and_engine(db_session)
@@ -1235,7 +1348,7 @@ if __name__ == '__main__':
         # Mode Tracking
         modes_run.append('track_codes')
 
-        import_track_codes()
+        import_track_codes(args.database)
 
     # Check mode
     if args.mode in ('brisnet_spot_plays', 'all', 'outside_picks'):
@@ -1247,7 +1360,7 @@ if __name__ == '__main__':
         pick_data = scrape_spot_plays()
 
         # Connect to the database
-        db_session = get_db_session()
+        db_session = get_db_session(database=args.database)
 
         for current_pick in pick_data:
             load_brisnet_spot_play_into_database(current_pick, db_session)
@@ -1265,7 +1378,7 @@ if __name__ == '__main__':
         browser = initialize_stealth_browser()
 
         # Connect to the database
-        db_session = get_db_session()
+        db_session = get_db_session(database=args.database)
 
         # Get HTML for entries page
         html = get_html_from_page_with_captcha(
@@ -1281,7 +1394,8 @@ if __name__ == '__main__':
             print(f'getting {equibase_link_url}')
             whole_card_html = get_html_from_page_with_captcha(browser, equibase_link_url, 'div.race-nav.center')
             db_items = get_db_items_from_equibase_whole_card_entry_html(whole_card_html)
-            load_equibase_entries_into_database(db_items, db_session)
+            with unit_of_work(db_session):
+                load_equibase_entries_into_database(db_items, db_session)
             sleep_number = random.randrange(10, 25)
             print(f'Sleeping {sleep_number} seconds')
             time.sleep(sleep_number)
@@ -1297,10 +1411,12 @@ if __name__ == '__main__':
         modes_run.append('equibase_horse_details')
 
         # Connect to the database
-        db_session = get_db_session()
+        db_session = get_db_session(database=args.database)
+        read_session = get_read_session(database=args.database)
 
         # Get links
-        equibase_link_list = get_equibase_horse_links_for_entry_horses_without_details(db_session)
+        equibase_link_list = get_equibase_horse_links_for_entry_horses_without_details(read_session)
+        shutdown_session_and_engine(read_session)
         print(f'Running for {len(equibase_link_list)} links')
 
         # Initialize browser
@@ -1325,7 +1441,7 @@ if __name__ == '__main__':
         modes_run.append('find_equibase_horse_ids')
 
         # Connect to the database
-        db_session = get_db_session()
+        db_session = get_db_session(database=args.database)
 
         # Initialize browser
         browser = initialize_stealth_browser()
@@ -1343,11 +1459,94 @@ if __name__ == '__main__':
         modes_run.append('reset_tables')
 
         # Connect and destroy tables
-        db_session = get_db_session(destroy_flag=True)
+        db_session = get_db_session(destroy_flag=True, database=args.database)
         shutdown_session_and_engine(db_session)
 
         # Import Tracks
-        import_track_codes()
+        import_track_codes(args.database)
+
+    if args.mode in ('merge_staging',):
+
+        # Mode Tracking
+        modes_run.append('merge_staging')
+
+        # Move everything staged into the main database
+        skipped_count = merge_staging_into_main()
+        if skipped_count > 0:
+            print(f'{skipped_count} staged rows were skipped, fix them in staging and run merge_staging again')
+
+    if args.mode in ('upgrade_database',):
+
+        # Mode Tracking
+        modes_run.append('upgrade_database')
+
+        # Get database (without the schema check, this adds what it would complain about)
+        db_session = get_db_session(database=args.database, check_schema=False)
+
+        # Create missing columns and indexes
+        upgrade_database_schema(db_session.get_bind())
+
+        # Fill the new lookup columns on existing rows
+        backfill_derived_keys(db_session)
+
+        # Close everything out
+        shutdown_session_and_engine(db_session)
+
+    if args.mode in ('partition_odds_tables',):
+
+        # Mode Tracking
+        modes_run.append('partition_odds_tables')
+
+        # Get database
+        db_session = get_db_session(database=args.database)
+
+        # Partition the odds tables (first run) and create the coming month partitions
+        partition_odds_tables(db_session.get_bind())
+
+        # Close everything out
+        shutdown_session_and_engine(db_session)
+
+    if args.mode in ('archive_odds',):
+
+        # Mode Tracking
+        modes_run.append('archive_odds')
+
+        # Get database
+        db_session = get_db_session(database=args.database)
+
+        # Move old odds snapshots to parquet
+        archive_odds(db_session)
+
+        # Close everything out
+        shutdown_session_and_engine(db_session)
+
+    if args.mode in ('fix_horse_registry',):
+
+        # Mode Tracking
+        modes_run.append('fix_horse_registry')
+
+        # Get database
+        db_session = get_db_session(database=args.database)
+
+        # Swap scrambled registries and report the rest
+        fix_horse_registry(db_session)
+
+        # Close everything out
+        shutdown_session_and_engine(db_session)
+
+    if args.mode in ('backfill_latest_entry_pools',):
+
+        # Mode Tracking
+        modes_run.append('backfill_latest_entry_pools')
+
+        # Get database
+        db_session = get_db_session(database=args.database)
+
+        # Fill the current odds table from entry_pools
+        backfill_latest_entry_pools(db_session)
+
+        # Close everything out
+        shutdown_session_and_engine(db_session)
 
     if args.mode in ('download_equibase_charts', 'all'):
 
@@ -1355,7 +1554,7 @@ if __name__ == '__main__':
         modes_run.append('download_equibase_charts')
 
         # Get database
-        db_session = get_db_session()
+        db_session = get_db_session(database=args.database)
 
         # Initialize browser
         browser = initialize_stealth_browser()
@@ -1373,7 +1572,7 @@ if __name__ == '__main__':
         modes_run.append('scrape_equibase_charts')
 
         # Get database
-        db_session = get_db_session()
+        db_session = get_db_session(database=args.database)
 
         # run code
         scrape_equibase_charts(db_session)
@@ -1387,12 +1586,14 @@ if __name__ == '__main__':
         modes_run.append('record_statistics')
 
         # Get database
-        db_session = get_db_session()
+        db_session = get_db_session(database=args.database)
+        read_session = get_read_session(database=args.database)
 
         # run code
-        record_all_statistics(db_session)
+        record_all_statistics(db_session, read_session)
 
         # close database
+        shutdown_session_and_engine(read_session)
         shutdown_session_and_engine(db_session)
 
     if args.mode in ('retry_equibase_chart_backlog'):
@@ -1401,15 +1602,17 @@ if __name__ == '__main__':
         modes_run.append('retry_equibase_chart_backlog')
 
         # Get database
-        db_session = get_db_session()
+        db_session = get_db_session(database=args.database)
+        read_session = get_read_session(database=args.database)
 
         # Initialize browser
         browser = initialize_stealth_browser()
 
         # run code
-        download_problem_equibase_charts(db_session, browser)
+        download_problem_equibase_charts(db_session, browser, read_session)
 
         # shut things down
+        shutdown_session_and_engine(read_session)
         shutdown_session_and_engine(db_session)
         shutdown_stealth_browser(browser)
 
@@ -1417,6 +1620,19 @@ if __name__ == '__main__':
 
         pass
 
+    # Cache and update effectiveness
+    if debug_flag:
+        print(f'entity cache statistics: {entity_cache.statistics()}')
+        print(f'update statistics: {get_update_statistics()}')
+        print(f'ambiguous initial statistics: {get_ambiguous_initial_statistics()}')
+
+    # Finder profile (before the engines are closed, the report runs EXPLAIN)
+    if finder_profiler.enabled:
+        print(f'finder profile written to {finder_profiler.write_report()}')
+
+    # Close the connection pool
+    dispose_engine()
+
     if len(modes_run) == 0:
 
         print(f'"{args.mode}" is not a valid operational mode!')
@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, DateTime, Float, ForeignKey, Boolean, Date
+from sqlalchemy import Column, Integer, String, DateTime, Float, ForeignKey, Boolean, Date, Index, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
 
 # Setup base
 base = declarative_base()
@@ -8,6 +9,10 @@ base = declarative_base()
 class Tracks(base):
     """Sqlalchemy Races model"""
     __tablename__ = "tracks"
+    __table_args__ = (
+        Index('ix_tracks_code', 'code'),
+        Index('ix_tracks_name', 'name'),
+    )
 
     track_id = Column(Integer, primary_key=True)
     code = Column('code', String)
@@ -17,46 +22,76 @@ class Tracks(base):
     rp_track_code = Column('rp_track_code', Integer)
     equibase_chart_name = Column('equibase_chart_name', String)
 
+    # Relationships
+    races = relationship('Races', back_populates='track')
+
 
 class Jockeys(base):
     """Sqlalchemy Jockey model"""
     __tablename__ = "jockeys"
+    __table_args__ = (
+        Index('ix_jockeys_last_name_first_name', 'last_name', 'first_name'),
+        Index('ix_jockeys_last_name_key_first_initial', 'last_name_key', 'first_initial'),
+    )
     jockey_id = Column('jockey_id', Integer, primary_key=True)
     first_name = Column('first_name', String)
     last_name = Column('last_name', String)
+    first_initial = Column('first_initial', String)
+    last_name_key = Column('last_name_key', String)
     drf_jockey_id = Column('drf_jockey_id', Integer)
     drf_jockey_type = Column('drf_jockey_type', String)
     alias = Column('alias', String)
     equibase_jockey_id = Column('equibase_jockey_id', Integer)
     equibase_jockey_type = Column('equibase_jockey_type', String)
 
+    # Relationships
+    entries = relationship('Entries', back_populates='jockey')
+
 
 class Trainers(base):
     """Sqlalchemy Jockey model"""
     __tablename__ = "trainers"
+    __table_args__ = (
+        Index('ix_trainers_last_name_first_name', 'last_name', 'first_name'),
+        Index('ix_trainers_last_name_key_first_initial', 'last_name_key', 'first_initial'),
+    )
     trainer_id = Column('trainer_id', Integer, primary_key=True)
     first_name = Column('first_name', String)
     last_name = Column('last_name', String)
+    first_initial = Column('first_initial', String)
+    last_name_key = Column('last_name_key', String)
     drf_trainer_id = Column('drf_trainer_id', Integer)
     drf_trainer_type = Column('drf_trainer_type', String)
     alias = Column('alias', String)
     equibase_trainer_id = Column('equibase_trainer_id', Integer)
     equibase_trainer_type = Column('equibase_trainer_type', String)
 
+    # Relationships
+    entries = relationship('Entries', back_populates='trainer')
+
 
 class Owners(base):
     """Sqlalchemy Jockey model"""
     __tablename__ = "owners"
+    __table_args__ = (
+        Index('ix_owners_last_name_first_name', 'last_name', 'first_name'),
+    )
     owner_id = Column('owner_id', Integer, primary_key=True)
     first_name = Column('first_name', String)
     last_name = Column('last_name', String)
     equibase_owner_id = Column('equibase_owner_id', Integer)
     equibase_owner_type = Column('equibase_owner_type', String)
 
+    # Relationships
+    entries = relationship('Entries', back_populates='owner')
+
 
 class Races(base):
     """Sqlalchemy Races model"""
     __tablename__ = "races"
+    __table_args__ = (
+        Index('ix_races_natural_key', 'track_id', 'race_number', 'card_date', unique=True),
+    )
 
     race_id = Column(Integer, primary_key=True)
 
@@ -99,15 +134,24 @@ class Races(base):
     # Scraping Info
     latest_scrape_time = Column('latest_scrape_time', DateTime)  # UTC
 
+    # Relationships
+    track = relationship('Tracks', back_populates='races')
+    entries = relationship('Entries', back_populates='race')
+
 
 class Horses(base):
     """Sqlalchemy Races model"""
     __tablename__ = "horses"
+    __table_args__ = (
+        Index('ix_horses_horse_name', 'horse_name'),
+        Index('ix_horses_horse_name_key', 'horse_name_key'),
+    )
 
     horse_id = Column('horse_id', Integer, primary_key=True)
 
     # Identifying Info
     horse_name = Column('horse_name', String)
+    horse_name_key = Column('horse_name_key', String)
     equibase_horse_id = Column('equibase_horse_id', Integer)
     equibase_horse_type = Column('equibase_horse_type', String)
     equibase_horse_registry = Column('equibase_horse_registry', String)
@@ -119,11 +163,18 @@ class Horses(base):
     horse_type = Column('horse_type', String)
     equibase_horse_detail_scrape_date = Column('equibase_horse_detail_scrape_date', DateTime)
 
+    # Relationships
+    entries = relationship('Entries', back_populates='horse')
+
 
 class Entries(base):
 
     """Sqlalchemy Races model"""
     __tablename__ = "entries"
+    __table_args__ = (
+        Index('ix_entries_natural_key', 'race_id', 'horse_id', unique=True),
+        Index('ix_entries_horse_id', 'horse_id'),
+    )
 
     entry_id = Column('entry_id', Integer, primary_key=True)
     race_id = Column('race_id', Integer, ForeignKey('races.race_id'))
@@ -146,11 +197,21 @@ class Entries(base):
     equibase_speed_figure = Column('equibase_speed_figure', Integer, nullable=True)
     equibase_history_scrape = Column('equibase_history_scrape', Boolean, default=False)
 
+    # Relationships
+    race = relationship('Races', back_populates='entries')
+    horse = relationship('Horses', back_populates='entries')
+    trainer = relationship('Trainers', back_populates='entries')
+    jockey = relationship('Jockeys', back_populates='entries')
+    owner = relationship('Owners', back_populates='entries')
+
 
 class EntryPools(base):
 
     """Sqlalchemy Races model"""
     __tablename__ = "entry_pools"
+    __table_args__ = (
+        Index('ix_entry_pools_natural_key', 'entry_id', 'scrape_time', 'pool_type', unique=True),
+    )
 
     entry_pool_id = Column('entry_pool_id', Integer, primary_key=True)
     entry_id = Column('entry_id', ForeignKey('entries.entry_id'))
@@ -161,9 +222,24 @@ class EntryPools(base):
     dollar = Column('dollar', Float, nullable=True)
 
 
+class LatestEntryPools(base):
+    """Newest entry_pools snapshot of each entry and pool type (kept up to date by the odds loader)"""
+    __tablename__ = "latest_entry_pools"
+
+    entry_id = Column('entry_id', ForeignKey('entries.entry_id'), primary_key=True)
+    pool_type = Column('pool_type', String, primary_key=True)
+    scrape_time = Column('scrape_time', DateTime)
+    amount = Column('amount', Float)
+    odds = Column('odds', Float, nullable=True)
+    dollar = Column('dollar', Float, nullable=True)
+
+
 class Payoffs(base):
     """Sqlalchemy Races model"""
     __tablename__ = "payoffs"
+    __table_args__ = (
+        Index('ix_payoffs_natural_key', 'race_id', 'wager_type', unique=True),
+    )
 
     payoff_id = Column('entry_pool_id', Integer, primary_key=True)
     race_id = Column('race_id', Integer, ForeignKey('races.race_id'))
@@ -179,6 +255,9 @@ class Payoffs(base):
 class Probables(base):
     """Sqlalchemy Races model"""
     __tablename__ = "probables"
+    __table_args__ = (
+        Index('ix_probables_natural_key', 'race_id', 'scrape_time', 'probable_type', 'program_numbers', unique=True),
+    )
 
     probable_id = Column('entry_pool_id', Integer, primary_key=True)
     race_id = Column('race_id', Integer, ForeignKey('races.race_id'))
@@ -189,8 +268,29 @@ class Probables(base):
     probable_pool_amount = Column('probable_pool_amount', Float)
 
 
+class ProbableMatrices(base):
+    """Every probable of one type in one scrape packed into a single row (see probable_matrices.py)"""
+    __tablename__ = "probable_matrices"
+    __table_args__ = (
+        Index('ix_probable_matrices_natural_key', 'race_id', 'scrape_time', 'probable_type', unique=True),
+    )
+
+    probable_matrix_id = Column('probable_matrix_id', Integer, primary_key=True)
+    race_id = Column('race_id', Integer, ForeignKey('races.race_id'))
+    scrape_time = Column('scrape_time', DateTime)
+    probable_type = Column('probable_type', String)
+    leg_program_numbers = Column('leg_program_numbers', String)  # Axis labels, legs split by | and numbers by ,
+    probable_values = Column('probable_values', LargeBinary)  # Little endian float32 (dense up to two legs)
+    probable_combinations = Column('probable_combinations', LargeBinary, nullable=True)  # uint8 axis indexes if packed
+    probable_pool_amount = Column('probable_pool_amount', Float)
+
+
 class Picks(base):
     __tablename__ = "picks"
+    __table_args__ = (
+        Index('ix_picks_natural_key', 'race_id', 'bettor_family', 'bettor_name', 'bet_type', 'bet_win_text',
+              unique=True),
+    )
     pick_id = Column('pick_id', Integer, primary_key=True)
     bettor_family = Column('bettor_family', String)
     bettor_name = Column('bettor_name', String)
@@ -205,6 +305,10 @@ class Picks(base):
 class BettingResults(base):
     """Sqlalchemy Races model"""
     __tablename__ = "betting_results"
+    __table_args__ = (
+        Index('ix_betting_results_natural_key', 'track_id', 'strategy', 'bet_type_text', 'time_frame_text',
+              unique=True),
+    )
 
     betting_result_id = Column('betting_result_id', Integer, primary_key=True)
     strategy = Column('strategy', String)
@@ -221,6 +325,9 @@ class BettingResults(base):
 
 class Workouts(base):
     __tablename__ = "workouts"
+    __table_args__ = (
+        Index('ix_workouts_natural_key', 'horse_id', 'workout_date', 'track_id', unique=True),
+    )
 
     workout_id = Column('workout_id', Integer, primary_key=True)
     horse_id = Column('horse_id', Integer, ForeignKey('horses.horse_id'))
@@ -236,6 +343,9 @@ class Workouts(base):
 
 class AnalysisProbabilities(base):
     __tablename__ = "analysis_probabilities"
+    __table_args__ = (
+        Index('ix_analysis_probabilities_natural_key', 'entry_id', 'analysis_type', 'finish_place', unique=True),
+    )
 
     probability_id = Column('probability_id', Integer, primary_key=True)
     entry_id = Column('entry_id', ForeignKey('entries.entry_id'))
@@ -246,6 +356,9 @@ class AnalysisProbabilities(base):
 
 class FractionalTimes(base):
     __tablename__ = "fractional_times"
+    __table_args__ = (
+        Index('ix_fractional_times_natural_key', 'race_id', 'point', unique=True),
+    )
 
     fractional_id = Column('fractional_id', Integer, primary_key=True)
     race_id = Column('race_id', Integer, ForeignKey('races.race_id'))
@@ -257,6 +370,9 @@ class FractionalTimes(base):
 
 class PointsOfCall(base):
     __tablename__ = "points_of_call"
+    __table_args__ = (
+        Index('ix_points_of_call_natural_key', 'entry_id', 'point', unique=True),
+    )
 
     point_of_call_id = Column('fractional_id', Integer, primary_key=True)
     entry_id = Column('entry_id', Integer, ForeignKey('entries.entry_id'))
@@ -269,6 +385,9 @@ class PointsOfCall(base):
 
 class DatabaseStatistics(base):
     __tablename__ = "database_statistics"
+    __table_args__ = (
+        Index('ix_database_statistics_natural_key', 'statistic_name', 'statistic_date', unique=True),
+    )
 
     database_statistic_id = Column('database_statistic_id', Integer, primary_key=True)
     statistic_name = Column('statistic_name', String)
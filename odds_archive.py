@@ -0,0 +1,299 @@
+import datetime
+import glob
+import os
+import pyarrow
+import pyarrow.parquet
+from sqlalchemy import select, Integer, Float, String, DateTime, Boolean, Date
+import settings
+from db_utils import get_model_from_item_type
+from models import EntryPools, Probables, Entries, Races
+
+# Where archived odds go (override with ODDS_ARCHIVE_PATH in settings.py)
+ODDS_ARCHIVE_PATH = getattr(
+    settings,
+    'ODDS_ARCHIVE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'odds_archive')
+)
+
+
+def get_archived_table_models():
+
+    # Odds snapshots that are rarely read once the season is over
+    return [EntryPools, Probables]
+
+
+def get_archive_from_clause(model):
+
+    # Join each row to its race (entry pools get there through their entry)
+    table = model.__table__
+    races = Races.__table__
+    if 'race_id' in table.columns:
+        return table.join(races, table.c.race_id == races.c.race_id)
+    entries = Entries.__table__
+    return table.join(entries, table.c.entry_id == entries.c.entry_id).join(races, entries.c.race_id == races.c.race_id)
+
+
+def get_archive_columns(model):
+
+    # Table columns plus race_id (so archived entry pools can be found by race too)
+    columns = list(model.__table__.columns)
+    if 'race_id' not in model.__table__.columns:
+        columns.append(Entries.__table__.c.race_id)
+    return columns
+
+
+def get_arrow_type(column):
+
+    # Parquet type for a column
+    if isinstance(column.type, Boolean):
+        return pyarrow.bool_()
+    elif isinstance(column.type, Integer) or len(column.foreign_keys) > 0:
+        return pyarrow.int64()
+    elif isinstance(column.type, Float):
+        return pyarrow.float64()
+    elif isinstance(column.type, DateTime):
+        return pyarrow.timestamp('us')
+    elif isinstance(column.type, Date):
+        return pyarrow.date32()
+    elif isinstance(column.type, String):
+        return pyarrow.string()
+    else:
+        raise ValueError(f'no parquet type for {column.name} ({column.type})')
+
+
+def get_archive_directory(table_name, card_date):
+
+    # One directory per table and card date
+    return os.path.join(ODDS_ARCHIVE_PATH, table_name, f'card_date={card_date.isoformat()}')
+
+
+def get_archive_schema(columns):
+
+    # Parquet schema for the archive columns
+    return pyarrow.schema([(column.name, get_arrow_type(column)) for column in columns])
+
+
+def conform_archive_table(arrow_table, schema):
+
+    # Files written before a column was added get it as nulls
+    arrays = []
+    for field in schema:
+        if field.name in arrow_table.column_names:
+            arrays.append(arrow_table.column(field.name).cast(field.type))
+        else:
+            arrays.append(pyarrow.chunked_array([pyarrow.nulls(arrow_table.num_rows, field.type)], field.type))
+    return pyarrow.Table.from_arrays(arrays, schema=schema)
+
+
+def get_archive_key_names(model):
+
+    # Archived rows are told apart by their natural key (sqlite hands the ids of deleted rows out again)
+    for index in model.__table__.indexes:
+        if index.unique:
+            return [column.name for column in index.columns]
+
+
+def deduplicate_archive_table(arrow_table, key_names):
+
+    # Keep the last copy of each row (later archives of the same row win)
+    seen_keys = set()
+    keep_indexes = []
+    keys = list(zip(*[arrow_table.column(key_name).to_pylist() for key_name in key_names]))
+    for index in range(len(keys) - 1, -1, -1):
+        if keys[index] not in seen_keys:
+            seen_keys.add(keys[index])
+            keep_indexes.append(index)
+    if len(keep_indexes) == len(keys):
+        return arrow_table
+    return arrow_table.take(pyarrow.array(sorted(keep_indexes), pyarrow.int64()))
+
+
+def get_archive_file_path(table_name, card_date):
+
+    # One file per table and card date
+    return os.path.join(get_archive_directory(table_name, card_date), f'{table_name}-{card_date.isoformat()}.parquet')
+
+
+def write_archive_file(table_name, card_date, columns, rows, key_names):
+
+    # Build the columnar table
+    schema = get_archive_schema(columns)
+    arrow_table = pyarrow.Table.from_pydict(
+        {column.name: [row[index] for row in rows] for index, column in enumerate(columns)},
+        schema=schema
+    )
+
+    # Merge with whatever is already archived for the card (rows archived again replace their old copies)
+    directory = get_archive_directory(table_name, card_date)
+    existing_file_paths = get_archive_file_paths(table_name, card_date)
+    if len(existing_file_paths) > 0:
+        arrow_table = deduplicate_archive_table(pyarrow.concat_tables(
+            [conform_archive_table(pyarrow.parquet.read_table(file_path), schema) for file_path in existing_file_paths]
+            + [arrow_table]
+        ), key_names)
+
+    # Replace the cards file in one step
+    os.makedirs(directory, exist_ok=True)
+    file_path = get_archive_file_path(table_name, card_date)
+    pyarrow.parquet.write_table(arrow_table, file_path + '.tmp')
+    os.replace(file_path + '.tmp', file_path)
+
+    # Older files are merged into it now
+    for existing_file_path in existing_file_paths:
+        if existing_file_path != file_path:
+            os.remove(existing_file_path)
+
+    # Return path
+    return file_path
+
+
+def archive_odds_table(session, model, cutoff_date, batch_size=1000):
+
+    # Table info
+    table = model.__table__
+    races = Races.__table__
+    from_clause = get_archive_from_clause(model)
+    columns = get_archive_columns(model)
+    primary_key = list(table.primary_key.columns)[0]
+
+    # Cards before the cutoff that still have rows in the database
+    card_dates = [card_date for card_date, in session.execute(
+        select([races.c.card_date]).select_from(from_clause).where(
+            races.c.card_date < cutoff_date
+        ).distinct().order_by(races.c.card_date)
+    )]
+
+    # One card date at a time
+    archived_count = 0
+    for card_date in card_dates:
+
+        # Get the rows
+        rows = session.execute(
+            select(columns).select_from(from_clause).where(races.c.card_date == card_date)
+        ).fetchall()
+
+        # Write them out before they are deleted
+        file_path = write_archive_file(table.name, card_date, columns, rows, get_archive_key_names(model))
+
+        # Delete them from the database
+        primary_keys = [row[primary_key] for row in rows]
+        for batch_start in range(0, len(primary_keys), batch_size):
+            session.execute(table.delete().where(primary_key.in_(primary_keys[batch_start:batch_start + batch_size])))
+        session.commit()
+
+        # Report
+        archived_count += len(rows)
+        print(f'archived {len(rows)} {table.name} rows from {card_date} to {file_path}')
+
+    # Return count
+    return archived_count
+
+
+def archive_odds(session, cutoff_date=None):
+    """
+    Moves entry_pools and probables rows of races carded before cutoff_date (ODDS_ARCHIVE_DAYS ago by default) into
+    parquet files partitioned by card date and deletes them from the database
+    """
+
+    # Default cutoff
+    if cutoff_date is None:
+        cutoff_date = datetime.date.today() - datetime.timedelta(days=getattr(settings, 'ODDS_ARCHIVE_DAYS', 365))
+
+    # Archive each table
+    for model in get_archived_table_models():
+        archive_odds_table(session, model, cutoff_date)
+
+
+def get_archive_file_paths(table_name, card_date):
+
+    # Every file written for the card (archives from before the one file per card layout can have several)
+    return sorted(glob.glob(os.path.join(get_archive_directory(table_name, card_date), '*.parquet')))
+
+
+def read_archive_table(model, card_date, columns=None):
+
+    # Every file of the card as one table with each row once (None if the card has no files)
+    table_name = model.__table__.name
+    file_paths = get_archive_file_paths(table_name, card_date)
+    if len(file_paths) == 0:
+        return
+    schema = get_archive_schema(get_archive_columns(model))
+    arrow_table = pyarrow.concat_tables([
+        conform_archive_table(pyarrow.parquet.read_table(file_path), schema) for file_path in file_paths
+    ])
+    arrow_table = deduplicate_archive_table(arrow_table, get_archive_key_names(model))
+
+    # Only the columns asked for
+    if columns is not None:
+        arrow_table = pyarrow.Table.from_arrays(
+            [arrow_table.column(column_name) for column_name in columns],
+            names=list(columns)
+        )
+    return arrow_table
+
+
+def get_odds_rows_for_race(session, race, item_type):
+    """
+    Returns every entry_pool or probable row of a race as dicts of table columns plus race_id, ordered by scrape time,
+    whether the rows are still in the database or already archived
+    """
+
+    # Table info
+    model = get_model_from_item_type(item_type)
+    table = model.__table__
+    columns = get_archive_columns(model)
+    column_names = [column.name for column in columns]
+    primary_key_name = list(table.primary_key.columns)[0].name
+    key_names = get_archive_key_names(model)
+
+    # Archived rows
+    rows = dict()
+    arrow_table = read_archive_table(model, race.card_date)
+    if arrow_table is not None:
+        data = arrow_table.to_pydict()
+        for index, race_id in enumerate(data['race_id']):
+            if race_id == race.race_id:
+                row = {column_name: data[column_name][index] for column_name in column_names}
+                rows[tuple(row[key_name] for key_name in key_names)] = row
+
+    # Rows still in the database (win over archived copies)
+    for row in session.execute(
+            select(columns).select_from(get_archive_from_clause(model)).where(Races.__table__.c.race_id == race.race_id)
+    ):
+        row = dict(zip(column_names, row))
+        rows[tuple(row[key_name] for key_name in key_names)] = row
+
+    # Return rows in scrape order
+    return sorted(rows.values(), key=lambda row: (row['scrape_time'], row[primary_key_name]))
+
+
+def read_archived_odds(item_type, start_date, end_date, columns=None):
+    """
+    Columnar read of the archived rows for cards from start_date through end_date as one pyarrow Table, for backtests
+    that would otherwise scan the whole table
+    """
+
+    # Table info
+    model = get_model_from_item_type(item_type)
+    table_name = model.__table__.name
+
+    # Read each card date that has files
+    arrow_tables = []
+    for directory in sorted(glob.glob(os.path.join(ODDS_ARCHIVE_PATH, table_name, 'card_date=*'))):
+        card_date = datetime.date.fromisoformat(os.path.basename(directory).split('=', 1)[1])
+        if start_date <= card_date <= end_date:
+            arrow_table = read_archive_table(model, card_date, columns)
+            if arrow_table is not None:
+                arrow_tables.append(arrow_table)
+
+    # Return one table
+    if len(arrow_tables) == 0:
+        archive_columns = get_archive_columns(model)
+        if columns is not None:
+            archive_columns_by_name = {column.name: column for column in archive_columns}
+            archive_columns = [archive_columns_by_name[column_name] for column_name in columns]
+        return pyarrow.Table.from_pydict(
+            {column.name: [] for column in archive_columns},
+            schema=pyarrow.schema([(column.name, get_arrow_type(column)) for column in archive_columns])
+        )
+    return pyarrow.concat_tables(arrow_tables)
@@ -0,0 +1,210 @@
+import re
+import numpy
+import settings
+from models import ProbableMatrices
+
+# Store probables as one packed row per race, type and scrape instead of a row per combination (opt in with
+# PROBABLE_MATRICES = True in settings.py)
+PROBABLE_MATRICES = getattr(settings, 'PROBABLE_MATRICES', False)
+
+# Probables with up to this many legs are stored as a dense matrix, longer ones as packed combinations
+DENSE_MAX_LEGS = 2
+
+# Storage types
+VALUE_DTYPE = numpy.dtype('<f4')
+COMBINATION_DTYPE = numpy.dtype('u1')
+
+
+def get_program_number_sort_key(program_number):
+
+    # Numeric order with coupled entries after their number (1, 1A, 2, ..., 10)
+    program_number_search = re.match(r'(\d+)(.*)', program_number)
+    if program_number_search is None:
+        return 1000, program_number
+    return int(program_number_search.group(1)), program_number_search.group(2)
+
+
+def split_program_numbers(program_numbers):
+
+    # One program number per leg ("3-7" -> ['3', '7'])
+    return [program_number.strip() for program_number in program_numbers.split('-')]
+
+
+def join_leg_program_numbers(leg_program_numbers):
+
+    # Axis labels as stored (legs split by | and program numbers by ,)
+    return '|'.join(','.join(program_numbers) for program_numbers in leg_program_numbers)
+
+
+def split_leg_program_numbers(leg_program_numbers):
+
+    # Stored axis labels back into a list per leg
+    return [program_numbers.split(',') if program_numbers else [] for program_numbers in leg_program_numbers.split('|')]
+
+
+def create_probable_matrix_item_from_probable_items(probable_items):
+
+    # Every item is one combination of the same race, type and scrape
+    first_item = probable_items[0]
+    combinations = [split_program_numbers(item['program_numbers']) for item in probable_items]
+    leg_count = len(combinations[0])
+    if any(len(combination) != leg_count for combination in combinations):
+        print(f'{first_item["probable_type"]} probables for race {first_item["race_id"]} mix leg counts, skipping')
+        return
+
+    # Axis labels for each leg
+    leg_program_numbers = [
+        sorted(set(combination[leg] for combination in combinations), key=get_program_number_sort_key)
+        for leg in range(leg_count)
+    ]
+    leg_indexes = [
+        {program_number: index for index, program_number in enumerate(program_numbers)}
+        for program_numbers in leg_program_numbers
+    ]
+    combination_indexes = numpy.array([
+        [leg_indexes[leg][combination[leg]] for leg in range(leg_count)] for combination in combinations
+    ], dtype=COMBINATION_DTYPE)
+    values = numpy.array([
+        numpy.nan if item['probable_value'] is None else item['probable_value'] for item in probable_items
+    ], dtype=VALUE_DTYPE)
+
+    # Dense matrix (missing combinations are NaN) or packed combinations
+    if leg_count <= DENSE_MAX_LEGS:
+        matrix = numpy.full([len(program_numbers) for program_numbers in leg_program_numbers], numpy.nan, VALUE_DTYPE)
+        matrix[tuple(combination_indexes.T)] = values
+        probable_values = matrix.tobytes()
+        probable_combinations = None
+    else:
+        probable_values = values.tobytes()
+        probable_combinations = combination_indexes.tobytes()
+
+    # Pool amount is the same on every combination
+    pool_amounts = [item['probable_pool_amount'] for item in probable_items if item['probable_pool_amount'] is not None]
+
+    # Return item
+    return {
+        'race_id': first_item['race_id'],
+        'scrape_time': first_item['scrape_time'],
+        'probable_type': first_item['probable_type'],
+        'leg_program_numbers': join_leg_program_numbers(leg_program_numbers),
+        'probable_values': probable_values,
+        'probable_combinations': probable_combinations,
+        'probable_pool_amount': max(pool_amounts) if len(pool_amounts) > 0 else None,
+    }
+
+
+def create_probable_matrix_items_from_probable_items(probable_items):
+    """
+    Packs probable items (one per combination) into probable_matrix items, one per race, probable type and scrape time
+    """
+
+    # Group the combinations
+    grouped_items = dict()
+    for item in probable_items:
+        if item is None:
+            continue
+        group_key = (item['race_id'], item['probable_type'], item['scrape_time'])
+        grouped_items.setdefault(group_key, dict())[item['program_numbers']] = item
+
+    # Pack each group
+    matrix_items = []
+    for group_items in grouped_items.values():
+        matrix_item = create_probable_matrix_item_from_probable_items(list(group_items.values()))
+        if matrix_item is not None:
+            matrix_items.append(matrix_item)
+
+    # Return items
+    return matrix_items
+
+
+def get_probable_combinations(probable_matrix):
+    """
+    Returns (program numbers per leg, combination axis indexes as an int array of shape (combinations, legs), values)
+    for the combinations that have a value
+    """
+
+    # Axis labels
+    leg_program_numbers = split_leg_program_numbers(probable_matrix.leg_program_numbers)
+    values = numpy.frombuffer(probable_matrix.probable_values, dtype=VALUE_DTYPE)
+
+    # Packed combinations are stored as they are
+    if probable_matrix.probable_combinations is not None:
+        combination_indexes = numpy.frombuffer(probable_matrix.probable_combinations, dtype=COMBINATION_DTYPE)
+        combination_indexes = combination_indexes.reshape(len(values), len(leg_program_numbers)).astype(int)
+        return leg_program_numbers, combination_indexes, values
+
+    # Dense matrices keep the cells that are filled
+    matrix = values.reshape([len(program_numbers) for program_numbers in leg_program_numbers])
+    combination_indexes = numpy.argwhere(~numpy.isnan(matrix))
+    return leg_program_numbers, combination_indexes, matrix[tuple(combination_indexes.T)]
+
+
+def get_probable_array(probable_matrix):
+    """
+    Returns (program numbers per leg, dense float32 array with one axis per leg) for a probable matrix, NaN where the
+    combination has no probable
+    """
+
+    # Dense matrices read straight from the buffer
+    leg_program_numbers = split_leg_program_numbers(probable_matrix.leg_program_numbers)
+    shape = [len(program_numbers) for program_numbers in leg_program_numbers]
+    if probable_matrix.probable_combinations is None:
+        return leg_program_numbers, numpy.frombuffer(probable_matrix.probable_values, dtype=VALUE_DTYPE).reshape(shape)
+
+    # Packed combinations get spread out
+    leg_program_numbers, combination_indexes, values = get_probable_combinations(probable_matrix)
+    array = numpy.full(shape, numpy.nan, VALUE_DTYPE)
+    array[tuple(combination_indexes.T)] = values
+    return leg_program_numbers, array
+
+
+def get_probable_matrices_for_race(session, race_id, probable_type=None):
+
+    # Every stored snapshot in scrape order
+    query = session.query(ProbableMatrices).filter(ProbableMatrices.race_id == race_id)
+    if probable_type is not None:
+        query = query.filter(ProbableMatrices.probable_type == probable_type)
+    return query.order_by(ProbableMatrices.probable_type, ProbableMatrices.scrape_time).all()
+
+
+def get_probable_series_for_race(session, race_id, probable_type):
+    """
+    Reads every snapshot of one probable type for a race at once. Returns (scrape times, program numbers per leg,
+    float32 array shaped (snapshots, legs...)), runners missing from a snapshot (scratches) are NaN
+    """
+
+    # Get the snapshots
+    probable_matrices = get_probable_matrices_for_race(session, race_id, probable_type)
+    if len(probable_matrices) == 0:
+        return [], [], numpy.empty((0,), dtype=VALUE_DTYPE)
+
+    # Axis labels that cover every snapshot
+    snapshots = [get_probable_array(probable_matrix) for probable_matrix in probable_matrices]
+    leg_count = max(len(leg_program_numbers) for leg_program_numbers, array in snapshots)
+    leg_program_numbers = [
+        sorted(
+            set(program_number for snapshot_legs, array in snapshots if len(snapshot_legs) > leg
+                for program_number in snapshot_legs[leg]),
+            key=get_program_number_sort_key
+        )
+        for leg in range(leg_count)
+    ]
+    leg_indexes = [
+        {program_number: index for index, program_number in enumerate(program_numbers)}
+        for program_numbers in leg_program_numbers
+    ]
+
+    # Place each snapshot on the common axes
+    series = numpy.full(
+        [len(snapshots)] + [len(program_numbers) for program_numbers in leg_program_numbers], numpy.nan, VALUE_DTYPE
+    )
+    for snapshot_index, (snapshot_legs, array) in enumerate(snapshots):
+        if len(snapshot_legs) != leg_count:
+            continue
+        positions = numpy.ix_(*[
+            [leg_indexes[leg][program_number] for program_number in snapshot_legs[leg]] for leg in range(leg_count)
+        ])
+        series[snapshot_index][positions] = array
+
+    # Return series
+    return [probable_matrix.scrape_time for probable_matrix in probable_matrices], leg_program_numbers, series
@@ -0,0 +1,59 @@
+import os
+import sys
+import types
+import pytest
+
+# Import the modules from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The modules import settings.py (not checked in), the tests only need it to exist since they build their own engines
+try:
+    import settings
+except ImportError:
+    settings = types.ModuleType('settings')
+    settings.DATABASE = {'drivername': 'sqlite', 'database': ':memory:'}
+    sys.modules['settings'] = settings
+
+from db_utils import db_connect, create_drf_live_table, session_factory
+from entity_cache import entity_cache
+
+# Postgres tests run against this database (every table in it is dropped and recreated) and are skipped without it
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+
+
+@pytest.fixture
+def sqlite_session(tmp_path):
+
+    # Fresh file database set up like the main one
+    engine = db_connect({'drivername': 'sqlite', 'database': str(tmp_path / 'test.db')}, {})
+    create_drf_live_table(engine, False)
+    entity_cache.clear()
+    session = session_factory(bind=engine, info={'database': 'test'})
+    yield session
+    session.close()
+    engine.dispose()
+    entity_cache.clear()
+
+
+@pytest.fixture
+def postgresql_session():
+
+    # Empty schema on the test database
+    if TEST_DATABASE_URL is None:
+        pytest.skip('set TEST_DATABASE_URL to run the postgres tests')
+    from sqlalchemy import create_engine
+    engine = create_engine(TEST_DATABASE_URL)
+    create_drf_live_table(engine, True)
+    entity_cache.clear()
+    session = session_factory(bind=engine, info={'database': 'test'})
+    yield session
+    session.close()
+    engine.dispose()
+    entity_cache.clear()
+
+
+@pytest.fixture(params=['sqlite', 'postgresql'])
+def any_session(request):
+
+    # Runs the test on each backend
+    return request.getfixturevalue(f'{request.param}_session')
@@ -0,0 +1,92 @@
+import datetime
+import pytest
+from sqlalchemy.exc import IntegrityError
+from db_utils import append_items_to_database, race_savepoint, unit_of_work
+from models import Tracks, Races, Horses, Entries, EntryPools
+
+
+def create_entry(session):
+
+    # One runner in one race
+    track = Tracks(code='TST', name='Test Park')
+    session.add(track)
+    session.flush()
+    race = Races(track_id=track.track_id, race_number=1, card_date=datetime.date(2020, 1, 2))
+    horse = Horses(horse_name='SEA BISCUIT', horse_name_key='SEABISCUIT')
+    session.add_all([race, horse])
+    session.flush()
+    entry = Entries(race_id=race.race_id, horse_id=horse.horse_id)
+    session.add(entry)
+    session.commit()
+    return entry
+
+
+def get_entry_pool_items(entry, minutes):
+
+    # Win and place snapshots of the entry at each minute
+    scrape_time = datetime.datetime(2020, 1, 2, 18)
+    return [
+        {
+            'entry_id': entry.entry_id,
+            'scrape_time': scrape_time + datetime.timedelta(minutes=minute),
+            'pool_type': pool_type,
+            'amount': float(minute),
+        }
+        for minute in minutes for pool_type in ('WIN', 'PLACE')
+    ]
+
+
+def test_replayed_rows_are_skipped(any_session):
+
+    entry = create_entry(any_session)
+
+    assert append_items_to_database(get_entry_pool_items(entry, [0, 1]), 'entry_pool', any_session) == 4
+    assert append_items_to_database(get_entry_pool_items(entry, [1, 2]), 'entry_pool', any_session) == 2
+    assert any_session.query(EntryPools).count() == 6
+
+
+def test_appends_to_one_table_share_a_transaction(any_session):
+
+    entry = create_entry(any_session)
+    with unit_of_work(any_session):
+        append_items_to_database(get_entry_pool_items(entry, [0]), 'entry_pool', any_session)
+        append_items_to_database(get_entry_pool_items(entry, [1]), 'entry_pool', any_session)
+
+    assert any_session.query(EntryPools).count() == 4
+
+
+def test_failed_copy_raises_its_own_error(postgresql_session):
+
+    entry = create_entry(postgresql_session)
+    orphan_items = [dict(item, entry_id=entry.entry_id + 1) for item in get_entry_pool_items(entry, [0])]
+
+    with pytest.raises(IntegrityError):
+        append_items_to_database(orphan_items, 'entry_pool', postgresql_session)
+    postgresql_session.rollback()
+
+    # The staging table went with the rollback
+    assert append_items_to_database(get_entry_pool_items(entry, [0]), 'entry_pool', postgresql_session) == 2
+
+
+def test_savepoint_only_reports_released_races(sqlite_session):
+
+    committed = []
+    with unit_of_work(sqlite_session):
+        with race_savepoint(sqlite_session, on_commit=lambda: committed.append('first')):
+            sqlite_session.add(Tracks(code='ONE', name='One Park'))
+        with race_savepoint(sqlite_session, on_commit=lambda: committed.append('second')):
+            sqlite_session.add(Tracks(code='TWO', name='Two Park'))
+            raise ValueError('bad race')
+
+    assert committed == ['first']
+    assert [track.code for track in sqlite_session.query(Tracks)] == ['ONE']
+
+
+def test_savepoint_raises_when_asked(sqlite_session):
+
+    committed = []
+    with pytest.raises(ValueError):
+        with race_savepoint(sqlite_session, raise_errors=True, on_commit=lambda: committed.append('race')):
+            raise ValueError('bad race')
+
+    assert committed == []
@@ -0,0 +1,26 @@
+import asyncio
+import db_utils
+from db_async import run_with_db_session, async_load_item_into_database
+from db_utils import db_connect, create_drf_live_table
+
+
+def test_async_writes_go_to_the_chosen_database(tmp_path, monkeypatch):
+
+    # Separate main and staging engines
+    engines = {
+        database: db_connect({'drivername': 'sqlite', 'database': str(tmp_path / f'{database}.db')}, {})
+        for database in ('main', 'staging')
+    }
+    for engine in engines.values():
+        create_drf_live_table(engine, False)
+    monkeypatch.setattr(db_utils, 'process_engines', dict(engines))
+    monkeypatch.setattr(db_utils, 'schema_checked', set())
+
+    bind = asyncio.run(run_with_db_session(lambda session: session.get_bind(), database='staging'))
+    asyncio.run(async_load_item_into_database({'code': 'STG', 'name': 'Staging Park'}, 'track', database='staging'))
+
+    assert bind is engines['staging']
+    assert engines['staging'].execute('SELECT count(*) FROM tracks').scalar() == 1
+    assert engines['main'].execute('SELECT count(*) FROM tracks').scalar() == 0
+    for engine in engines.values():
+        engine.dispose()
@@ -0,0 +1,24 @@
+import datetime
+from db_stats import record_all_statistics
+from models import Tracks, Races, Horses, Entries, DatabaseStatistics
+
+
+def test_record_all_statistics_counts_the_detail_scrape_backlog(any_session):
+
+    # A horse that was never detail scraped running today
+    track = Tracks(code='TST', name='Test Park')
+    any_session.add(track)
+    any_session.flush()
+    race = Races(track_id=track.track_id, race_number=1, card_date=datetime.date.today(), drf_entries=True)
+    horse = Horses(horse_name='HORSE', horse_name_key='HORSE', equibase_horse_id=1)
+    any_session.add_all([race, horse])
+    any_session.flush()
+    any_session.add(Entries(race_id=race.race_id, horse_id=horse.horse_id, scratch_indicator='N'))
+    any_session.commit()
+
+    record_all_statistics(any_session)
+
+    statistic = any_session.query(DatabaseStatistics).filter(
+        DatabaseStatistics.statistic_name == 'detail_scrape_backlog'
+    ).one()
+    assert statistic.statistic_value == 1
@@ -0,0 +1,26 @@
+from drf import get_also_ran_horse_names_from_drf_data
+
+
+def test_also_ran_text_is_split_in_order_of_finish():
+
+    data = {'alsoRan': 'Sea Biscuit, War Admiral , Seabiscuit Jr  and   Man O War'}
+
+    assert get_also_ran_horse_names_from_drf_data(data) == ['SEA BISCUIT', 'WAR ADMIRAL', 'SEABISCUIT JR', 'MAN O WAR']
+
+
+def test_also_ran_with_one_horse():
+
+    assert get_also_ran_horse_names_from_drf_data({'alsoRan': 'Sea Biscuit '}) == ['SEA BISCUIT']
+
+
+def test_also_ran_list_is_kept_in_order():
+
+    data = {'alsoRan': ['War Admiral', ' sea biscuit']}
+
+    assert get_also_ran_horse_names_from_drf_data(data) == ['WAR ADMIRAL', 'SEA BISCUIT']
+
+
+def test_missing_also_ran_is_empty():
+
+    assert get_also_ran_horse_names_from_drf_data({'alsoRan': None}) == []
+    assert get_also_ran_horse_names_from_drf_data({}) == []
@@ -0,0 +1,106 @@
+import entity_cache as entity_cache_module
+from db_utils import load_items_into_database, get_entity_cache_type, get_entity_cache_key_from_item
+from entity_cache import EntityCache, entity_cache
+from models import Horses, Owners
+
+
+def create_horses(session, count):
+
+    # Stored horses to cache
+    horses = [Horses(horse_name=f'HORSE {index}', horse_name_key=f'HORSE{index}') for index in range(count)]
+    session.add_all(horses)
+    session.commit()
+    return horses
+
+
+def test_least_recently_used_entries_are_evicted(sqlite_session):
+
+    cache = EntityCache(max_size=2)
+    horses = create_horses(sqlite_session, 3)
+    cache.put('horse', 'HORSE0', horses[0])
+    cache.put('horse', 'HORSE1', horses[1])
+    assert cache.get('horse', 'HORSE0', sqlite_session) is horses[0]
+    cache.put('horse', 'HORSE2', horses[2])
+
+    assert cache.get('horse', 'HORSE1', sqlite_session) is None
+    assert cache.get('horse', 'HORSE0', sqlite_session) is horses[0]
+    assert cache.get('horse', 'HORSE2', sqlite_session) is horses[2]
+    assert cache.statistics()['size'] == 2
+    assert ('horse', (horses[1].horse_id,)) not in cache._keys_by_identity
+
+
+def test_invalidate_drops_every_key_of_the_row(sqlite_session):
+
+    cache = EntityCache()
+    horses = create_horses(sqlite_session, 2)
+    cache.put('horse', ('horse_id', horses[0].horse_id), horses[0])
+    cache.put('horse', ('horse_name_key', 'HORSE0'), horses[0])
+    cache.put('horse', ('horse_name_key', 'HORSE1'), horses[1])
+    cache.invalidate('horse', horses[0])
+
+    assert cache.get('horse', ('horse_id', horses[0].horse_id), sqlite_session) is None
+    assert cache.get('horse', ('horse_name_key', 'HORSE0'), sqlite_session) is None
+    assert cache.get('horse', ('horse_name_key', 'HORSE1'), sqlite_session) is horses[1]
+    assert cache.statistics()['invalidations'] == 2
+
+
+def test_invalidate_type_drops_only_that_type(sqlite_session):
+
+    cache = EntityCache()
+    horses = create_horses(sqlite_session, 1)
+    owner = Owners(first_name='JANE', last_name='DOE')
+    sqlite_session.add(owner)
+    sqlite_session.commit()
+    cache.put('horse', 'HORSE0', horses[0])
+    cache.put('owner', ('JANE', 'DOE'), owner)
+    cache.invalidate_type('horse')
+
+    assert cache.get('horse', 'HORSE0', sqlite_session) is None
+    assert cache.get('owner', ('JANE', 'DOE'), sqlite_session) is owner
+
+
+def test_entries_expire_after_the_ttl(sqlite_session, monkeypatch):
+
+    cache = EntityCache(ttl=60)
+    horses = create_horses(sqlite_session, 1)
+    monkeypatch.setattr(entity_cache_module.time, 'monotonic', lambda: 1000.0)
+    cache.put('horse', 'HORSE0', horses[0])
+    monkeypatch.setattr(entity_cache_module.time, 'monotonic', lambda: 1059.0)
+    assert cache.get('horse', 'HORSE0', sqlite_session) is horses[0]
+    monkeypatch.setattr(entity_cache_module.time, 'monotonic', lambda: 1061.0)
+
+    assert cache.get('horse', 'HORSE0', sqlite_session) is None
+    assert cache.statistics()['size'] == 0
+
+
+def get_cached_horse(session, horse_name):
+
+    # What the loaders would get from the cache
+    item = {'horse_name': horse_name}
+    return entity_cache.get(
+        get_entity_cache_type('horse', session), get_entity_cache_key_from_item(item, 'horse'), session
+    )
+
+
+def test_orm_updates_invalidate_cached_rows(sqlite_session):
+
+    horse = load_items_into_database([{'horse_name': 'SEA BISCUIT'}], 'horse', sqlite_session)[0]
+    load_items_into_database([{'horse_name': 'SEA BISCUIT'}], 'horse', sqlite_session)
+    assert get_cached_horse(sqlite_session, 'SEA BISCUIT') is horse
+
+    horse.horse_color = 'BAY'
+    sqlite_session.flush()
+
+    assert get_cached_horse(sqlite_session, 'SEA BISCUIT') is None
+
+
+def test_bulk_updates_invalidate_the_type(sqlite_session):
+
+    load_items_into_database([{'horse_name': 'SEA BISCUIT'}], 'horse', sqlite_session)
+    load_items_into_database([{'horse_name': 'SEA BISCUIT'}], 'horse', sqlite_session)
+    assert get_cached_horse(sqlite_session, 'SEA BISCUIT') is not None
+
+    sqlite_session.query(Horses).update({'horse_color': 'BAY'}, synchronize_session=False)
+
+    assert get_cached_horse(sqlite_session, 'SEA BISCUIT') is None
+
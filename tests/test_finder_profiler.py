@@ -0,0 +1,62 @@
+import pytest
+from finder_profiler import FinderProfiler, get_statement_kind
+from models import Tracks
+
+
+def test_nested_profiles_are_timed_separately_and_outer_calls_include_inner_sql(sqlite_session):
+
+    profiler = FinderProfiler(enabled=True)
+    with profiler.profile('outer', sqlite_session):
+        sqlite_session.query(Tracks).all()
+        with profiler.profile('inner', sqlite_session):
+            sqlite_session.query(Tracks).filter(Tracks.code == 'TST').all()
+
+    statistics = profiler.statistics()
+    assert statistics['outer']['calls'] == 1 and statistics['inner']['calls'] == 1
+    assert statistics['outer']['total_ms'] >= statistics['inner']['total_ms']
+    outer_statements = profiler._slow_samples['outer'][0][3]
+    inner_statements = profiler._slow_samples['inner'][0][3]
+    assert len(inner_statements) == 1 and outer_statements[-1] == inner_statements[0]
+    assert len(outer_statements) > len(inner_statements)
+
+
+def test_disabled_profiler_records_nothing(sqlite_session):
+
+    profiler = FinderProfiler()
+    with profiler.profile('finder', sqlite_session):
+        sqlite_session.query(Tracks).all()
+
+    assert profiler.statistics() == dict()
+
+
+@pytest.mark.parametrize('statement, statement_kind', [
+    ('SELECT tracks.track_id FROM tracks', 'read'),
+    ('WITH recent AS (SELECT 1) SELECT * FROM recent', 'read'),
+    ('INSERT INTO tracks (code) VALUES (%(code)s) ON CONFLICT DO NOTHING', 'write'),
+    ('UPDATE races SET off_time = %(off_time)s', 'write'),
+    ('WITH upserted_race AS (INSERT INTO races (race_number) VALUES (1) RETURNING *) SELECT * FROM upserted_race',
+     'write'),
+    ('BEGIN IMMEDIATE', None),
+    ('SAVEPOINT sa_savepoint_1', None),
+    ('RELEASE SAVEPOINT sa_savepoint_1', None),
+])
+def test_statement_kinds(statement, statement_kind):
+
+    assert get_statement_kind(statement) == statement_kind
+
+
+def test_writes_are_only_planned_on_postgres(postgresql_session):
+
+    profiler = FinderProfiler()
+    engine = postgresql_session.get_bind()
+    insert_statement = 'INSERT INTO tracks (code, name) VALUES (%(code)s, %(name)s) RETURNING track_id'
+
+    plan = profiler.explain(engine, insert_statement, {'code': 'TST', 'name': 'Test Park'})
+    assert 'Insert on tracks' in plan and 'actual time' not in plan
+    assert profiler.explain(engine, 'SAVEPOINT sa_savepoint_1', {}) == 'not explained'
+    assert 'actual time' in profiler.explain(engine, 'SELECT track_id FROM tracks', {})
+
+    # Nothing was written and no id was used up
+    postgresql_session.add(Tracks(code='TST', name='Test Park'))
+    postgresql_session.commit()
+    assert postgresql_session.query(Tracks.track_id).scalar() == 1
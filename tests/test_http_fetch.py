@@ -0,0 +1,28 @@
+import time
+from http_fetch import fetch_all
+
+
+def fetch_after(delay, value):
+
+    # Later arguments finish first
+    time.sleep(delay)
+    if isinstance(value, Exception):
+        raise value
+    return value
+
+
+def test_fetch_all_returns_results_in_argument_order():
+
+    arguments_list = [(0.05, 'first'), (0.03, 'second'), (0.01, 'third'), (0, 'fourth')]
+
+    assert fetch_all(fetch_after, arguments_list) == ['first', 'second', 'third', 'fourth']
+
+
+def test_fetch_all_puts_errors_in_place_of_failed_results():
+
+    error = ValueError('bad response')
+
+    results = fetch_all(fetch_after, [(0.02, 'first'), (0, error), (0, 'third')])
+
+    assert results == ['first', error, 'third']
+    assert fetch_all(fetch_after, []) == []
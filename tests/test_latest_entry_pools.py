@@ -0,0 +1,50 @@
+import datetime
+from db_utils import upsert_latest_entry_pools
+from models import Tracks, Races, Horses, Entries, LatestEntryPools
+
+
+def create_entry(session):
+
+    # One runner in one race
+    track = Tracks(code='TST', name='Test Park')
+    session.add(track)
+    session.flush()
+    race = Races(track_id=track.track_id, race_number=1, card_date=datetime.date(2020, 1, 2))
+    horse = Horses(horse_name='HORSE', horse_name_key='HORSE')
+    session.add_all([race, horse])
+    session.flush()
+    entry = Entries(race_id=race.race_id, horse_id=horse.horse_id)
+    session.add(entry)
+    session.commit()
+    return entry
+
+
+def get_pool_item(entry_id, minute, odds, pool_type='WN'):
+
+    # Snapshot taken minute minutes after the first poll
+    return {
+        'entry_id': entry_id,
+        'pool_type': pool_type,
+        'scrape_time': datetime.datetime(2020, 1, 2, 18, 0) + datetime.timedelta(minutes=minute),
+        'amount': 100.0,
+        'odds': odds,
+    }
+
+
+def test_only_newer_snapshots_replace_the_latest_row(any_session):
+
+    entry_id = create_entry(any_session).entry_id
+
+    # The newest of each pool type in a batch is written
+    written_count = upsert_latest_entry_pools([
+        get_pool_item(entry_id, 1, 3.0), None, get_pool_item(entry_id, 2, 2.5), get_pool_item(entry_id, 1, 9.0, 'PL')
+    ], any_session)
+    assert written_count == 2
+    assert any_session.query(LatestEntryPools).get((entry_id, 'WN')).odds == 2.5
+
+    # Late and replayed polls are ignored, newer ones replace the row
+    assert upsert_latest_entry_pools([get_pool_item(entry_id, 0, 5.0), get_pool_item(entry_id, 1, 9.0, 'PL')],
+                                     any_session) == 0
+    assert upsert_latest_entry_pools([get_pool_item(entry_id, 3, 2.0)], any_session) == 1
+    latest_pools = {latest_pool.pool_type: latest_pool for latest_pool in any_session.query(LatestEntryPools)}
+    assert latest_pools['WN'].odds == 2.0 and latest_pools['PL'].odds == 9.0
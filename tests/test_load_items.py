@@ -0,0 +1,70 @@
+import datetime
+import db_utils
+from db_utils import load_items_into_database, get_natural_key_from_item
+from models import Tracks, Races
+
+
+def create_track(session):
+
+    # Track the races hang off
+    track = Tracks(code='TST', name='Test Park')
+    session.add(track)
+    session.commit()
+    return track
+
+
+def test_natural_key_values_are_converted_to_column_types(any_session):
+
+    track = create_track(any_session)
+    item = {'track_id': str(track.track_id), 'race_number': '3', 'card_date': '2020-01-02'}
+
+    assert get_natural_key_from_item(item, 'race') == (track.track_id, 3, datetime.date(2020, 1, 2))
+
+
+def test_text_key_values_match_existing_rows(any_session):
+
+    track = create_track(any_session)
+    race = Races(track_id=track.track_id, race_number=3, card_date=datetime.date(2020, 1, 2))
+    any_session.add(race)
+    any_session.commit()
+
+    instances = load_items_into_database(
+        [{'track_id': track.track_id, 'race_number': '3', 'card_date': '2020-01-02', 'distance': 6.0}],
+        'race',
+        any_session
+    )
+
+    assert instances[0].race_id == race.race_id
+    assert any_session.query(Races).count() == 1
+    assert any_session.query(Races).one().distance == 6.0
+
+
+def test_rows_inserted_since_the_lookup_are_updated(any_session, monkeypatch):
+
+    track = create_track(any_session)
+    race = Races(track_id=track.track_id, race_number=1, card_date=datetime.date(2020, 1, 2))
+    any_session.add(race)
+    any_session.commit()
+
+    # The first lookup misses the row like it would if another process inserted it right after
+    find_instances_from_natural_keys = db_utils.find_instances_from_natural_keys
+    lookups = []
+
+    def find_instances_after_first_lookup(natural_keys, item_type, session, batch_size=500):
+        lookups.append(natural_keys)
+        if len(lookups) == 1:
+            return dict()
+        return find_instances_from_natural_keys(natural_keys, item_type, session, batch_size)
+
+    monkeypatch.setattr(db_utils, 'find_instances_from_natural_keys', find_instances_after_first_lookup)
+    items = [
+        {'track_id': track.track_id, 'race_number': 1, 'card_date': datetime.date(2020, 1, 2), 'distance': 8.0},
+        {'track_id': track.track_id, 'race_number': 2, 'card_date': datetime.date(2020, 1, 2), 'distance': 6.0},
+    ]
+    instances = load_items_into_database(items, 'race', any_session)
+
+    assert instances[0].race_id == race.race_id
+    assert instances[1] is not None and instances[1].race_id != race.race_id
+    assert any_session.query(Races).count() == 2
+    any_session.expire_all()
+    assert any_session.query(Races).get(race.race_id).distance == 8.0
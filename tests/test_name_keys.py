@@ -0,0 +1,103 @@
+import datetime
+import pytest
+from sqlalchemy import create_engine
+from db_utils import find_horse_instance_from_item, find_horse_instance_from_item_and_race, load_items_into_database, \
+    is_initial_only_item, check_database_schema, create_drf_live_table
+from models import Tracks, Races, Horses, Entries, Jockeys
+from utils import get_name_key, get_first_initial, get_horse_name_key
+
+
+def test_name_keys_ignore_case_spacing_and_punctuation():
+
+    assert get_name_key("O'Neill") == 'ONEILL'
+    assert get_name_key('de la Cruz') == 'DELACRUZ'
+    assert get_name_key('Smith Jr.') == 'SMITHJR'
+    assert get_name_key(None) is None
+
+
+def test_names_without_letters_or_digits_have_no_key():
+
+    assert get_name_key('') is None
+    assert get_name_key(' .-') is None
+    assert get_horse_name_key('') is None
+    assert get_horse_name_key('DQ-') is None
+    assert get_first_initial('') is None
+
+
+def test_horse_name_keys_drop_the_dq_prefix_and_origin_suffix():
+
+    assert get_horse_name_key('Sea Biscuit') == 'SEABISCUIT'
+    assert get_horse_name_key('DQ-Sea Biscuit') == 'SEABISCUIT'
+    assert get_horse_name_key('Sea-Biscuit (IRE)') == 'SEABISCUIT'
+    assert get_horse_name_key(' sea biscuit (KY) ') == 'SEABISCUIT'
+    assert get_horse_name_key('Seabiscuit 2') == 'SEABISCUIT2'
+
+
+def test_first_initials():
+
+    assert get_first_initial('john') == 'J'
+    assert get_first_initial("'Tex'") == 'T'
+    assert get_first_initial(None) is None
+
+
+def test_horses_are_matched_on_the_key(sqlite_session):
+
+    horse = load_items_into_database([{'horse_name': 'SEA BISCUIT'}], 'horse', sqlite_session)[0]
+
+    assert find_horse_instance_from_item({'horse_name': "Sea-Biscuit (IRE)"}, sqlite_session) is horse
+    assert load_items_into_database([{'horse_name': 'SEABISCUIT'}], 'horse', sqlite_session)[0] is horse
+    assert horse.horse_name == 'SEA BISCUIT'
+
+
+def test_horses_without_a_key_only_match_their_own_name(sqlite_session):
+
+    track = Tracks(code='TST', name='Test Park')
+    sqlite_session.add(track)
+    sqlite_session.flush()
+    race = Races(track_id=track.track_id, race_number=1, card_date=datetime.date(2020, 1, 2))
+    blank_horse = Horses(horse_name='', horse_name_key=None)
+    dash_horse = Horses(horse_name='-', horse_name_key=None)
+    sqlite_session.add_all([race, blank_horse, dash_horse])
+    sqlite_session.flush()
+    sqlite_session.add(Entries(race_id=race.race_id, horse_id=dash_horse.horse_id))
+    sqlite_session.commit()
+
+    assert find_horse_instance_from_item({'horse_name': '-'}, sqlite_session) is dash_horse
+    assert find_horse_instance_from_item({'horse_name': '.'}, sqlite_session) is None
+    assert find_horse_instance_from_item_and_race({'horse_name': '-'}, race, sqlite_session) is dash_horse
+    assert find_horse_instance_from_item_and_race({'horse_name': ''}, race, sqlite_session) is None
+    assert load_items_into_database([{'horse_name': '.'}], 'horse', sqlite_session)[0] not in (blank_horse, dash_horse)
+
+
+def test_initials_without_a_last_name_key_are_matched_exactly(sqlite_session):
+
+    assert is_initial_only_item({'first_name': 'J', 'last_name': 'SMITH'}, 'jockey')
+    assert not is_initial_only_item({'first_name': 'J', 'last_name': '.'}, 'jockey')
+    assert not is_initial_only_item({'first_name': 'J', 'last_name': None}, 'jockey')
+
+    first = load_items_into_database([{'first_name': 'J', 'last_name': '.'}], 'jockey', sqlite_session)[0]
+    second = load_items_into_database([{'first_name': 'J', 'last_name': '.'}], 'jockey', sqlite_session)[0]
+    assert first is second
+    assert sqlite_session.query(Jockeys).count() == 1
+
+
+def test_schema_check_names_missing_columns(tmp_path):
+
+    engine = create_engine(f'sqlite:///{tmp_path / "old.db"}')
+    engine.execute('CREATE TABLE horses (horse_id INTEGER PRIMARY KEY, horse_name VARCHAR)')
+    create_drf_live_table(engine, False)
+
+    with pytest.raises(RuntimeError) as error:
+        check_database_schema(engine)
+    assert 'horses.horse_name_key' in str(error.value)
+    assert '--mode upgrade_database' in str(error.value)
+    engine.dispose()
+
+
+def test_schema_check_passes_on_a_current_database(tmp_path):
+
+    engine = create_engine(f'sqlite:///{tmp_path / "new.db"}')
+    create_drf_live_table(engine, False)
+
+    check_database_schema(engine)
+    engine.dispose()
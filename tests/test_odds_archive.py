@@ -0,0 +1,111 @@
+import datetime
+import os
+import pytest
+from db_utils import append_items_to_database
+from models import Tracks, Races, Horses, Entries, EntryPools
+
+pyarrow = pytest.importorskip('pyarrow')
+import pyarrow.parquet  # noqa: E402
+import odds_archive  # noqa: E402
+
+
+@pytest.fixture
+def archive_path(tmp_path, monkeypatch):
+
+    # Archive into the test directory
+    monkeypatch.setattr(odds_archive, 'ODDS_ARCHIVE_PATH', str(tmp_path / 'archive'))
+    return tmp_path / 'archive'
+
+
+def create_entry(session, card_date):
+
+    # One runner in one race on the card
+    track = session.query(Tracks).first()
+    if track is None:
+        track = Tracks(code='TST', name='Test Park')
+        session.add(track)
+        session.flush()
+    race = Races(track_id=track.track_id, race_number=1, card_date=card_date)
+    horse = Horses(horse_name='SEA BISCUIT', horse_name_key='SEABISCUIT')
+    session.add_all([race, horse])
+    session.flush()
+    entry = Entries(race_id=race.race_id, horse_id=horse.horse_id)
+    session.add(entry)
+    session.commit()
+    return entry
+
+
+def append_entry_pools(session, entry, card_date, minutes):
+
+    # Win snapshots of the entry at each minute after noon
+    append_items_to_database([
+        {
+            'entry_id': entry.entry_id,
+            'scrape_time': datetime.datetime.combine(card_date, datetime.time(12, minute)),
+            'pool_type': 'WIN',
+            'amount': float(minute),
+        }
+        for minute in minutes
+    ], 'entry_pool', session)
+
+
+def test_archiving_a_card_again_merges_into_one_file(sqlite_session, archive_path):
+
+    card_date = datetime.date(2019, 1, 2)
+    entry = create_entry(sqlite_session, card_date)
+    append_entry_pools(sqlite_session, entry, card_date, [0, 1])
+    odds_archive.archive_odds_table(sqlite_session, EntryPools, datetime.date(2020, 1, 1))
+
+    # Late rows get archived into the same file (sqlite gives the late row the id of a deleted one)
+    append_entry_pools(sqlite_session, entry, card_date, [2])
+    odds_archive.archive_odds_table(sqlite_session, EntryPools, datetime.date(2020, 1, 1))
+
+    file_paths = odds_archive.get_archive_file_paths('entry_pools', card_date)
+    assert [os.path.basename(file_path) for file_path in file_paths] == ['entry_pools-2019-01-02.parquet']
+    assert pyarrow.parquet.read_table(file_paths[0]).column('amount').to_pylist() == [0.0, 1.0, 2.0]
+    assert sqlite_session.query(EntryPools).count() == 0
+    rows = odds_archive.get_odds_rows_for_race(sqlite_session, entry.race, 'entry_pool')
+    assert [row['amount'] for row in rows] == [0.0, 1.0, 2.0]
+
+
+def test_rows_archived_twice_are_stored_once(archive_path):
+
+    card_date = datetime.date(2019, 1, 2)
+    columns = odds_archive.get_archive_columns(EntryPools)
+    rows = [
+        (entry_pool_id, 7, datetime.datetime(2019, 1, 2, 12, entry_pool_id), 'WIN', float(entry_pool_id), None, None,
+         3)
+        for entry_pool_id in range(1, 4)
+    ]
+
+    # A crash between writing and deleting archives the same rows again
+    odds_archive.write_archive_file('entry_pools', card_date, columns, rows[:2], ['entry_id', 'scrape_time', 'pool_type'])
+    odds_archive.write_archive_file('entry_pools', card_date, columns, rows, ['entry_id', 'scrape_time', 'pool_type'])
+
+    arrow_table = odds_archive.read_archive_table(EntryPools, card_date)
+    assert arrow_table.column('entry_pool_id').to_pylist() == [1, 2, 3]
+    assert len(odds_archive.get_archive_file_paths('entry_pools', card_date)) == 1
+
+
+def test_old_directories_with_several_files_are_read_once_per_row(archive_path):
+
+    card_date = datetime.date(2019, 1, 2)
+    directory = odds_archive.get_archive_directory('entry_pools', card_date)
+    os.makedirs(directory)
+    schema = odds_archive.get_archive_schema(odds_archive.get_archive_columns(EntryPools))
+    for file_name, entry_pool_ids in (('20200101000000000000.parquet', [1, 2]), ('20200102000000000000.parquet', [2, 3])):
+        pyarrow.parquet.write_table(pyarrow.Table.from_pydict({
+            'entry_pool_id': entry_pool_ids,
+            'entry_id': [7] * len(entry_pool_ids),
+            'scrape_time': [datetime.datetime(2019, 1, 2, 12, index) for index in entry_pool_ids],
+            'pool_type': ['WIN'] * len(entry_pool_ids),
+            'amount': [float(index) for index in entry_pool_ids],
+            'odds': [None] * len(entry_pool_ids),
+            'dollar': [None] * len(entry_pool_ids),
+            'race_id': [3] * len(entry_pool_ids),
+        }, schema=schema), os.path.join(directory, file_name))
+
+    archived = odds_archive.read_archived_odds('entry_pool', card_date, card_date, ['entry_pool_id', 'amount'])
+
+    assert archived.column_names == ['entry_pool_id', 'amount']
+    assert archived.column('entry_pool_id').to_pylist() == [1, 2, 3]
@@ -0,0 +1,68 @@
+import datetime
+import logging
+from sqlalchemy import create_engine
+from conftest import TEST_DATABASE_URL
+from db_maintenance import partition_odds_tables
+from db_utils import is_partitioned_table, get_missing_columns
+from models import Tracks, Races, Horses, Entries, EntryPools, Probables
+
+
+def test_odds_tables_are_partitioned_with_the_old_rows_attached(postgresql_session, caplog):
+
+    session = postgresql_session
+    track = Tracks(code='TST', name='Test Park')
+    session.add(track)
+    session.flush()
+    race = Races(track_id=track.track_id, race_number=1, card_date=datetime.date(2020, 1, 2))
+    horse = Horses(horse_name='SEA BISCUIT', horse_name_key='SEABISCUIT')
+    session.add_all([race, horse])
+    session.flush()
+    entry = Entries(race_id=race.race_id, horse_id=horse.horse_id)
+    session.add(entry)
+    session.flush()
+    old_scrape_time = datetime.datetime(2020, 1, 2, 18)
+    session.add(EntryPools(entry_id=entry.entry_id, scrape_time=old_scrape_time, pool_type='WIN', amount=1.0))
+    session.add(Probables(race_id=race.race_id, scrape_time=old_scrape_time, probable_type='EX',
+                          program_numbers='1-2', probable_value=3.0))
+    session.commit()
+    entry_id = entry.entry_id
+    session.close()
+    engine = session.get_bind()
+
+    # Converting twice only adds partitions the second time (with postgres' debug messages showing what it scanned)
+    caplog.set_level(logging.INFO, logger='sqlalchemy.dialects.postgresql')
+    debug_engine = create_engine(TEST_DATABASE_URL, connect_args={'options': '-c client_min_messages=debug1'})
+    partition_odds_tables(debug_engine, months_ahead=2)
+    partition_odds_tables(debug_engine, months_ahead=2)
+    debug_engine.dispose()
+
+    # The old rows were only read by the online check validation, the conversion reused the check and indexes
+    messages = caplog.messages
+    assert any('"entry_pools_legacy.scrape_time" are sufficient to prove' in message for message in messages)
+    assert any('table "entry_pools_legacy" is implied by existing constraints' in message for message in messages)
+    assert not any(
+        'table "entry_pools_legacy"' in message and ('building index' in message or 'verifying table' in message or
+                                                     'rewriting table' in message)
+        for message in messages
+    )
+
+    with engine.connect() as connection:
+        assert is_partitioned_table(connection, 'entry_pools')
+        assert is_partitioned_table(connection, 'probables')
+        legacy_constraints = dict(connection.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = CAST('entry_pools_legacy' AS regclass)"
+        ).fetchall())
+        assert legacy_constraints['entry_pools_legacy_pkey'] == 'PRIMARY KEY (entry_pool_id, scrape_time)'
+        assert 'entry_pools_legacy_scrape_time_check' not in legacy_constraints
+        assert connection.execute('SELECT count(*) FROM entry_pools_legacy').scalar() == 1
+    assert get_missing_columns(engine) == []
+
+    # New rows go through the parent (the old table takes the rest of this and next month, the month after that has
+    # its partition)
+    later_month = datetime.datetime.utcnow().replace(day=1) + datetime.timedelta(days=63)
+    session.add(EntryPools(entry_id=entry_id, scrape_time=later_month, pool_type='WIN', amount=2.0))
+    session.commit()
+    assert session.query(EntryPools).count() == 2
+    assert session.execute('SELECT count(*) FROM entry_pools_legacy').scalar() == 1
+    assert session.execute(f'SELECT count(*) FROM entry_pools_{later_month:%Y_%m}').scalar() == 1
@@ -0,0 +1,126 @@
+import datetime
+import numpy
+from db_utils import load_items_into_database
+from models import Tracks, Races, ProbableMatrices
+from probable_matrices import create_probable_matrix_items_from_probable_items, get_probable_array, \
+    get_probable_combinations, get_probable_series_for_race, get_program_number_sort_key
+
+SCRAPE_TIME = datetime.datetime(2020, 1, 2, 18)
+
+
+def get_probable_items(probable_values, race_id=1, probable_type='EX', scrape_time=SCRAPE_TIME, pool_amount=500.0):
+
+    # One probable item per combination ('1-2' -> 3.5)
+    return [
+        {
+            'race_id': race_id,
+            'scrape_time': scrape_time,
+            'probable_type': probable_type,
+            'program_numbers': program_numbers,
+            'probable_value': probable_value,
+            'probable_pool_amount': pool_amount,
+        }
+        for program_numbers, probable_value in probable_values.items()
+    ]
+
+
+def create_matrix(matrix_item):
+
+    # Unsaved row as the loader stores it
+    return ProbableMatrices(**matrix_item)
+
+
+def test_program_numbers_sort_numerically_with_coupled_entries_after():
+
+    program_numbers = ['10', '2', '1A', '1', 'X']
+
+    assert sorted(program_numbers, key=get_program_number_sort_key) == ['1', '1A', '2', '10', 'X']
+
+
+def test_exacta_round_trip_leaves_missing_combinations_empty():
+
+    probable_values = {'1-2': 3.5, '2-1': 4.0, '1-10': 12.0, '10-2': None}
+    matrix_items = create_probable_matrix_items_from_probable_items(get_probable_items(probable_values) + [None])
+
+    assert len(matrix_items) == 1
+    matrix = create_matrix(matrix_items[0])
+    assert matrix.probable_combinations is None and matrix.probable_pool_amount == 500.0
+    leg_program_numbers, array = get_probable_array(matrix)
+    assert leg_program_numbers == [['1', '2', '10'], ['1', '2', '10']]
+    assert array.shape == (3, 3)
+    assert array[0, 1] == 3.5 and array[1, 0] == 4.0 and array[0, 2] == 12.0
+    assert numpy.isnan(array[2, 1]) and numpy.isnan(array[0, 0]) and numpy.isnan(array[1, 2])
+
+    # Only the filled cells come back as combinations
+    leg_program_numbers, combination_indexes, values = get_probable_combinations(matrix)
+    combinations = {
+        '-'.join(leg_program_numbers[leg][index] for leg, index in enumerate(indexes)): value
+        for indexes, value in zip(combination_indexes, values)
+    }
+    assert combinations == {'1-2': 3.5, '2-1': 4.0, '1-10': 12.0}
+
+
+def test_trifecta_round_trip_is_packed():
+
+    probable_values = {'1-2-3': 20.0, '3-2-1': 31.5, '2-1-4': 18.25}
+    probable_items = get_probable_items(probable_values, probable_type='TR')
+    matrix = create_matrix(create_probable_matrix_items_from_probable_items(probable_items)[0])
+
+    assert matrix.probable_combinations is not None
+    leg_program_numbers, combination_indexes, values = get_probable_combinations(matrix)
+    assert leg_program_numbers == [['1', '2', '3'], ['1', '2'], ['1', '3', '4']]
+    assert combination_indexes.shape == (3, 3)
+    unpacked = {
+        '-'.join(leg_program_numbers[leg][index] for leg, index in enumerate(indexes)): float(value)
+        for indexes, value in zip(combination_indexes, values)
+    }
+    assert unpacked == probable_values
+
+    # The dense view puts them back in place
+    leg_program_numbers, array = get_probable_array(matrix)
+    assert array.shape == (3, 2, 3)
+    assert array[2, 1, 0] == 31.5 and numpy.count_nonzero(~numpy.isnan(array)) == 3
+
+
+def test_mixed_leg_counts_are_skipped():
+
+    probable_items = get_probable_items({'1-2': 3.5, '1-2-3': 20.0})
+
+    assert create_probable_matrix_items_from_probable_items(probable_items) == []
+
+
+def test_series_reads_back_snapshots_stored_by_earlier_polls(sqlite_session):
+
+    track = Tracks(code='TST', name='Test Park')
+    sqlite_session.add(track)
+    sqlite_session.flush()
+    race = Races(track_id=track.track_id, race_number=1, card_date=datetime.date(2020, 1, 2))
+    sqlite_session.add(race)
+    sqlite_session.commit()
+    race_id = race.race_id
+
+    # First poll has three runners, the second has a scratch and a late addition
+    first_poll = get_probable_items({'1-2': 3.5, '2-1': 4.0, '1-3': 9.0}, race_id=race_id)
+    second_poll = get_probable_items({'1-2': 3.0, '2-1': 4.5, '1-4': 7.0}, race_id=race_id,
+                                     scrape_time=SCRAPE_TIME + datetime.timedelta(minutes=1))
+    for poll_items in (first_poll, second_poll):
+        load_items_into_database(create_probable_matrix_items_from_probable_items(poll_items), 'probable_matrix',
+                                 sqlite_session)
+    sqlite_session.commit()
+    sqlite_session.expunge_all()
+
+    scrape_times, leg_program_numbers, series = get_probable_series_for_race(sqlite_session, race_id, 'EX')
+
+    assert scrape_times == [SCRAPE_TIME, SCRAPE_TIME + datetime.timedelta(minutes=1)]
+    assert leg_program_numbers == [['1', '2'], ['1', '2', '3', '4']]
+    assert series.shape == (2, 2, 4) and series.dtype == numpy.float32
+    assert series[0, 0, 1] == 3.5 and series[1, 0, 1] == 3.0
+    assert series[0, 0, 2] == 9.0 and numpy.isnan(series[1, 0, 2])
+    assert numpy.isnan(series[0, 0, 3]) and series[1, 0, 3] == 7.0
+
+
+def test_series_for_a_race_without_snapshots_is_empty(sqlite_session):
+
+    scrape_times, leg_program_numbers, series = get_probable_series_for_race(sqlite_session, 1, 'EX')
+
+    assert scrape_times == [] and leg_program_numbers == [] and series.shape == (0,)
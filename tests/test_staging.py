@@ -0,0 +1,74 @@
+import datetime
+import pytest
+import db_utils
+from db_staging import merge_staging_into_main
+from db_utils import db_connect, create_drf_live_table, session_factory
+from models import Tracks, Races, Horses, Entries
+
+
+@pytest.fixture
+def staging_and_main_sessions(tmp_path, monkeypatch):
+
+    # Separate staging and main databases behind get_db_session
+    engines = {
+        database: db_connect({'drivername': 'sqlite', 'database': str(tmp_path / f'{database}.db')}, {})
+        for database in ('main', 'staging')
+    }
+    for engine in engines.values():
+        create_drf_live_table(engine, False)
+    monkeypatch.setattr(db_utils, 'process_engines', dict(engines))
+    monkeypatch.setattr(db_utils, 'schema_checked', set())
+    sessions = {
+        database: session_factory(bind=engine, info={'database': database}) for database, engine in engines.items()
+    }
+    yield sessions['staging'], sessions['main']
+    for database, session in sessions.items():
+        session.close()
+        engines[database].dispose()
+
+
+def stage_race_with_entries(session, missing_horse_id):
+
+    # A race with one good entry and one pointing at a horse that never made it into staging
+    track = Tracks(code='TST', name='Test Park')
+    horse = Horses(horse_name='HORSE', horse_name_key='HORSE')
+    session.add_all([track, horse])
+    session.flush()
+    race = Races(track_id=track.track_id, race_number=1, card_date=datetime.date(2020, 1, 2))
+    session.add(race)
+    session.flush()
+    session.add_all([
+        Entries(race_id=race.race_id, horse_id=horse.horse_id, program_number='1'),
+        Entries(race_id=race.race_id, horse_id=missing_horse_id, program_number='2'),
+    ])
+    session.commit()
+
+
+def test_merge_clears_staging_when_everything_is_merged(staging_and_main_sessions):
+
+    staging_session, main_session = staging_and_main_sessions
+    stage_race_with_entries(staging_session, None)
+    staging_session.query(Entries).filter(Entries.horse_id.is_(None)).delete()
+    staging_session.commit()
+
+    assert merge_staging_into_main() == 0
+    assert main_session.query(Entries).count() == 1
+    assert staging_session.query(Races).count() == 0 and staging_session.query(Tracks).count() == 0
+
+
+def test_merge_keeps_skipped_rows_and_what_they_point_at(staging_and_main_sessions):
+
+    staging_session, main_session = staging_and_main_sessions
+    stage_race_with_entries(staging_session, 999)
+
+    assert merge_staging_into_main() == 1
+    assert main_session.query(Entries).one().program_number == '1'
+    assert [entry.program_number for entry in staging_session.query(Entries)] == ['2']
+    assert staging_session.query(Races).count() == 1 and staging_session.query(Tracks).count() == 1
+    assert staging_session.query(Horses).count() == 0
+
+    # Running it again merges nothing new (after letting go of the sqlite locks the checks took)
+    staging_session.rollback()
+    main_session.rollback()
+    assert merge_staging_into_main() == 1
+    assert main_session.query(Entries).count() == 1 and main_session.query(Races).count() == 1
@@ -0,0 +1,55 @@
+import datetime
+from sqlalchemy.sql import null
+from sqlalchemy.sql.elements import Null
+from db_utils import update_instance_from_item, load_items_into_database, get_update_statistics
+from models import Races, Horses
+
+
+def test_same_values_are_not_a_change():
+
+    race = Races(track_id=1, race_number=2, card_date=datetime.date(2020, 1, 2), distance=6.0, purse=None)
+
+    assert not update_instance_from_item(race, {'race_number': 2, 'distance': 6.0}, 'race')
+    assert not update_instance_from_item(race, {'purse': null()}, 'race')
+    assert not update_instance_from_item(race, {'purse': None}, 'race')
+
+
+def test_different_values_are_applied():
+
+    race = Races(track_id=1, race_number=2, card_date=datetime.date(2020, 1, 2), distance=6.0, purse=50000)
+
+    assert update_instance_from_item(race, {'distance': 8.0, 'purse': null()}, 'race')
+    assert race.distance == 8.0
+    assert isinstance(race.purse, Null)
+
+
+def test_off_time_only_moves_earlier():
+
+    off_time = datetime.datetime(2020, 1, 2, 18, 5)
+    race = Races(off_time=off_time)
+
+    assert not update_instance_from_item(race, {'off_time': off_time + datetime.timedelta(minutes=2)}, 'race')
+    assert race.off_time == off_time
+    assert update_instance_from_item(race, {'off_time': off_time - datetime.timedelta(minutes=2)}, 'race')
+    assert race.off_time == off_time - datetime.timedelta(minutes=2)
+
+
+def test_other_spellings_of_a_horse_name_are_not_a_change():
+
+    horse = Horses(horse_name="Sea Biscuit", horse_name_key='SEABISCUIT')
+
+    assert not update_instance_from_item(horse, {'horse_name': 'SEABISCUIT'}, 'horse')
+    assert horse.horse_name == 'Sea Biscuit'
+
+
+def test_unchanged_items_are_counted_as_skipped(sqlite_session):
+
+    item = {'horse_name': 'SEA BISCUIT', 'horse_color': 'BAY'}
+    load_items_into_database([dict(item)], 'horse', sqlite_session)
+    skipped = get_update_statistics().get('horse', {}).get('skipped', 0)
+    applied = get_update_statistics().get('horse', {}).get('applied', 0)
+
+    load_items_into_database([dict(item)], 'horse', sqlite_session)
+    assert get_update_statistics()['horse']['skipped'] == skipped + 1
+    load_items_into_database([dict(item, horse_color='GRAY')], 'horse', sqlite_session)
+    assert get_update_statistics()['horse']['applied'] == applied + 1
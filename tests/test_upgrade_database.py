@@ -0,0 +1,45 @@
+import datetime
+from db_utils import upgrade_database_schema, is_invalid_index
+from models import Tracks, Races, Payoffs
+
+
+def get_index_tables(session, index_name):
+
+    # Tables that have an index by that name
+    return [row[0] for row in session.execute(
+        'SELECT indrelid::regclass::text FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid '
+        'WHERE pg_class.relname = :index_name',
+        {'index_name': index_name}
+    )]
+
+
+def test_failed_unique_index_build_is_cleaned_up(postgresql_session):
+
+    session = postgresql_session
+    track = Tracks(code='TST', name='Test Park')
+    session.add(track)
+    session.flush()
+    race = Races(track_id=track.track_id, race_number=1, card_date=datetime.date(2020, 1, 2))
+    session.add(race)
+    session.flush()
+    session.execute('DROP INDEX ix_payoffs_natural_key')
+    session.add_all([Payoffs(race_id=race.race_id, wager_type='WN'), Payoffs(race_id=race.race_id, wager_type='WN')])
+    session.commit()
+
+    upgrade_database_schema(session.get_bind())
+
+    # The duplicates stop the build and the invalid index it left is gone
+    assert get_index_tables(session, 'ix_payoffs_natural_key') == []
+    assert not is_invalid_index(session.get_bind(), 'ix_payoffs_natural_key')
+
+
+def test_index_name_taken_by_another_index_is_left_alone(postgresql_session):
+
+    session = postgresql_session
+    session.execute('DROP INDEX ix_payoffs_natural_key')
+    session.execute('CREATE INDEX ix_payoffs_natural_key ON tracks (code)')
+    session.commit()
+
+    upgrade_database_schema(session.get_bind())
+
+    assert get_index_tables(session, 'ix_payoffs_natural_key') == ['tracks']
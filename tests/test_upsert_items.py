@@ -0,0 +1,131 @@
+import datetime
+import db_utils
+from db_utils import upsert_items_into_database, has_unique_index, upsert_race_from_item
+from models import Tracks, Races, Horses, Entries
+
+
+def create_race_and_horses(session, horse_count):
+
+    # One race and the horses that run in it
+    track = Tracks(code='TST', name='Test Park')
+    session.add(track)
+    session.flush()
+    race = Races(track_id=track.track_id, race_number=1, card_date=datetime.date(2020, 1, 2))
+    horses = [Horses(horse_name=f'HORSE {index}', horse_name_key=f'HORSE{index}') for index in range(horse_count)]
+    session.add_all([race] + horses)
+    session.commit()
+    return race, horses
+
+
+def test_entries_are_upserted_and_ids_returned_in_item_order(any_session):
+
+    race, horses = create_race_and_horses(any_session, 2)
+    items = [
+        {'race_id': race.race_id, 'horse_id': horses[0].horse_id, 'program_number': '1'},
+        None,
+        {'race_id': race.race_id, 'horse_id': horses[1].horse_id, 'program_number': '2'},
+        {'race_id': race.race_id, 'horse_id': horses[0].horse_id, 'program_number': '1A'},
+    ]
+
+    entry_ids = upsert_items_into_database(items, 'entry', any_session)
+    assert entry_ids[1] is None
+    assert entry_ids[0] == entry_ids[3] and entry_ids[0] != entry_ids[2]
+    assert any_session.query(Entries).get(entry_ids[0]).program_number == '1A'
+
+    # Unchanged rows aren't written but still come back
+    assert upsert_items_into_database(items, 'entry', any_session) == entry_ids
+
+
+def test_missing_unique_index_falls_back_to_the_orm(postgresql_session, monkeypatch):
+
+    session = postgresql_session
+    monkeypatch.setattr(db_utils, 'checked_unique_indexes', dict())
+    race, horses = create_race_and_horses(session, 1)
+    session.execute('DROP INDEX ix_entries_natural_key')
+    session.commit()
+    assert not has_unique_index(session, 'ix_entries_natural_key')
+
+    item = {'race_id': race.race_id, 'horse_id': horses[0].horse_id, 'program_number': '1'}
+    first_ids = upsert_items_into_database([dict(item)], 'entry', session)
+    second_ids = upsert_items_into_database([dict(item, program_number='1A')], 'entry', session)
+
+    assert first_ids == second_ids
+    assert session.query(Entries).count() == 1
+    assert session.query(Entries).one().program_number == '1A'
+
+
+def test_unique_index_is_found(postgresql_session, monkeypatch):
+
+    monkeypatch.setattr(db_utils, 'checked_unique_indexes', dict())
+
+    assert has_unique_index(postgresql_session, 'ix_entries_natural_key')
+
+
+def get_race_item(track_id, **values):
+
+    # Race 1 on the test card
+    return dict({'track_id': track_id, 'race_number': 1, 'card_date': datetime.date(2020, 1, 2)}, **values)
+
+
+def get_row_version(session, race_id):
+
+    # xmin changes whenever postgres writes the row
+    return session.execute('SELECT xmin FROM races WHERE race_id = :race_id', {'race_id': race_id}).scalar()
+
+
+def test_race_upsert_only_moves_off_time_earlier(postgresql_session):
+
+    session = postgresql_session
+    track = Tracks(code='TST', name='Test Park')
+    session.add(track)
+    session.commit()
+    off_time = datetime.datetime(2020, 1, 2, 18, 0)
+
+    race = upsert_race_from_item(get_race_item(track.track_id, off_time=off_time), session)
+    later_race = upsert_race_from_item(get_race_item(track.track_id, off_time=off_time + datetime.timedelta(minutes=5)),
+                                       session)
+    assert later_race.race_id == race.race_id and later_race.off_time == off_time
+
+    earlier_race = upsert_race_from_item(
+        get_race_item(track.track_id, off_time=off_time - datetime.timedelta(minutes=5)), session
+    )
+    assert earlier_race.off_time == off_time - datetime.timedelta(minutes=5)
+
+
+def test_race_upsert_skips_unchanged_rows_and_matches_normalized_keys(postgresql_session):
+
+    session = postgresql_session
+    track = Tracks(code='TST', name='Test Park')
+    session.add(track)
+    session.commit()
+    race = upsert_race_from_item(get_race_item(track.track_id, distance=6.0, purse=None), session)
+    row_version = get_row_version(session, race.race_id)
+
+    # Same values (key given as strings) come back without a write
+    unchanged_race = upsert_race_from_item(
+        {'track_id': str(track.track_id), 'race_number': '1', 'card_date': '2020-01-02', 'distance': 6.0, 'purse': None},
+        session
+    )
+    assert unchanged_race.race_id == race.race_id
+    assert get_row_version(session, race.race_id) == row_version
+
+    # A change is written
+    changed_race = upsert_race_from_item(get_race_item(track.track_id, distance=8.0), session)
+    assert changed_race.race_id == race.race_id and changed_race.distance == 8.0
+    assert get_row_version(session, race.race_id) != row_version
+
+
+def test_race_upsert_without_unique_index_uses_the_orm(postgresql_session, monkeypatch):
+
+    session = postgresql_session
+    monkeypatch.setattr(db_utils, 'checked_unique_indexes', dict())
+    track = Tracks(code='TST', name='Test Park')
+    session.add(track)
+    session.execute('DROP INDEX ix_races_natural_key')
+    session.commit()
+
+    race = upsert_race_from_item(get_race_item(track.track_id, distance=6.0), session)
+    changed_race = upsert_race_from_item(get_race_item(track.track_id, distance=8.0), session)
+
+    assert changed_race.race_id == race.race_id
+    assert session.query(Races).one().distance == 8.0
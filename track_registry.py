@@ -0,0 +1,96 @@
+import threading
+from sqlalchemy import inspect
+from models import Tracks
+from entity_cache import get_instance_values, get_instance_from_values
+
+
+def normalize_equibase_chart_name(equibase_chart_name):
+
+    # Chart names show up with and without apostrophes and ampersands
+    return equibase_chart_name.replace("'", '').replace('&', '')
+
+
+class TrackRegistry:
+    """In memory copy of the tracks table indexed by every way the scrapers refer to a track"""
+
+    def __init__(self):
+
+        # Storage (database -> index name -> value -> track values)
+        self._indexes = dict()
+        self._lock = threading.RLock()
+
+    def load(self, session):
+
+        # Build every index from one query (lowest track_id wins like the old .first() lookups did)
+        indexes = {
+            'track_id': dict(),
+            'code': dict(),
+            'name': dict(),
+            'equibase_chart_name': dict(),
+            'rp_track_code': dict(),
+        }
+        for track in session.query(Tracks).order_by(Tracks.track_id):
+            values = get_instance_values(track)
+            for index_name, index in indexes.items():
+                value = values[index_name]
+                if value is None:
+                    continue
+                if index_name == 'equibase_chart_name':
+                    value = normalize_equibase_chart_name(value)
+                index.setdefault(value, values)
+
+        # Store indexes for this database
+        with self._lock:
+            self._indexes[session.info.get('database', 'main')] = indexes
+
+        # Return indexes
+        return indexes
+
+    def invalidate(self, database=None):
+
+        # Reload on the next lookup
+        with self._lock:
+            if database is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(database, None)
+
+    def get(self, session, index_name, value):
+
+        # Nothing to look up
+        if value is None:
+            return
+
+        # Load once per process (and again after an invalidation)
+        with self._lock:
+            indexes = self._indexes.get(session.info.get('database', 'main'), None)
+            if indexes is None:
+                indexes = self.load(session)
+
+        # Normalize chart names the same way the index was built
+        if index_name == 'equibase_chart_name':
+            value = normalize_equibase_chart_name(value)
+
+        # Return track attached to the callers session
+        values = indexes[index_name].get(value, None)
+        if values is None:
+            return
+        return get_instance_from_values(Tracks, values, session)
+
+
+# Process wide registry
+track_registry = TrackRegistry()
+
+
+def get_track_from_track_id(session, track_id):
+
+    # Return track
+    return track_registry.get(session, 'track_id', track_id)
+
+
+def get_track_from_race(session, race):
+
+    # Use the track eager loaded with the race if the query brought it along, never lazy load one per race
+    if 'track' not in inspect(race).unloaded:
+        return race.track
+    return get_track_from_track_id(session, race.track_id)
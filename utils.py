@@ -305,6 +305,40 @@ def get_horse_origin_from_name(horse_name_with_origin):
     return horse_name, country, state
 
 
+def get_name_key(name):
+
+    # Upper case letters and digits only so spacing and punctuation differences (O'NEILL vs ONEILL) still match
+    if name is None:
+        return None
+    name_key = re.sub(r'[^A-Z0-9]', '', name.upper())
+
+    # Names without a letter or digit have no key (an empty key would match every other one)
+    if name_key == '':
+        return None
+    return name_key
+
+
+def get_first_initial(first_name):
+
+    # First letter of the first name
+    name_key = get_name_key(first_name)
+    if not name_key:
+        return None
+    return name_key[0]
+
+
+def get_horse_name_key(horse_name):
+
+    # Strip the DQ- prefix and country/state suffix the sources add, then the punctuation and spacing
+    if horse_name is None:
+        return None
+    horse_name = horse_name.strip().upper()
+    if horse_name[0:3] == 'DQ-':
+        horse_name = horse_name[3:]
+    horse_name = re.sub(r'\s*\([A-Z]+\)\s*$', '', horse_name)
+    return get_name_key(horse_name)
+
+
 def usa_state_dict():
 
     return {